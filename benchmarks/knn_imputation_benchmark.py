@@ -0,0 +1,78 @@
+"""
+Scaling benchmark of the KNN imputation engines on synthetic cohorts.
+
+The cohorts are drawn from data/cleaned_data.csv (rows resampled with replacement,
+observed values slightly jittered, missingness patterns kept as they are), scaled as
+in knn_imputation.feature_scaling, and imputed with k=29 and distance weighting by:
+    - sklearn's KNNImputer
+    - BlockedKNNImputer, exact brute-force search
+    - BlockedKNNImputer, kd_tree search over complete-case donors
+
+Usage (from the repository root):
+    python benchmarks/knn_imputation_benchmark.py --rows 1000 3000 10000 30000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+from sklearn.impute import KNNImputer  # noqa: E402
+from knn_imputation import feature_scaling, targets  # noqa: E402
+from knn_engine import BlockedKNNImputer  # noqa: E402
+
+
+def synthetic_features(n_rows, seed=0):
+    df = pd.read_csv(os.path.join(ROOT, 'data', 'cleaned_data.csv'))
+    scaled, _ = feature_scaling(df)
+    X = scaled[[col for col in scaled.columns if col not in targets]].to_numpy(dtype=np.float64)
+
+    rng = np.random.RandomState(seed)
+    X = X[rng.randint(X.shape[0], size=n_rows)]
+    return X + rng.normal(scale=0.01, size=X.shape)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 3000, 10000])
+    parser.add_argument('--n-jobs', type=int, default=-1)
+    parser.add_argument('--skip-sklearn-above', type=int, default=30000,
+                        help='row count above which the sklearn baseline is not run')
+    args = parser.parse_args()
+
+    engines = {
+        'sklearn KNNImputer': lambda: KNNImputer(n_neighbors=29, weights='distance'),
+        'blocked brute': lambda: BlockedKNNImputer(search='brute', n_jobs=args.n_jobs),
+        'blocked kd_tree': lambda: BlockedKNNImputer(search='kd_tree', n_jobs=args.n_jobs),
+    }
+
+    rows = []
+    for n_rows in args.rows:
+        X = synthetic_features(n_rows)
+        reference = None
+
+        for name, make_imputer in engines.items():
+            if name.startswith('sklearn') and n_rows > args.skip_sklearn_above:
+                continue
+
+            start = time.perf_counter()
+            imputed = make_imputer().fit_transform(X)
+            elapsed = time.perf_counter() - start
+
+            if reference is None:
+                reference = imputed
+            rows.append({'rows': n_rows, 'engine': name, 'seconds': round(elapsed, 3),
+                         'rows/sec': int(n_rows / elapsed),
+                         'max abs diff': float(np.abs(imputed - reference).max())})
+
+    print(pd.DataFrame(rows).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+"""
+Per-stage benchmark of the preprocessing pipeline and of the multilabel splitters
+on synthetic cohorts (see synthetic_cohort.py).
+
+For every cohort size, the stages run in pipeline order on the output of the
+previous one:
+    load_and_basic_data_cleaning, zero_variance_drop, corr_based_drop, low_variance_aggr,
+    log_transform, feature_scaling, KNN_imputing, median_freq_imputing,
+    isolation_forest_anomaly_detection, restore_clinical_units,
+    MultilabelStratifiedKFold, RepeatedMultilabelStratifiedKFold, MultilabelStratifiedShuffleSplit
+and each records its wall time, rows/sec and peak RSS (reset before every stage on Linux,
+otherwise the process peak). KNN_imputing (sklearn's KNNImputer, quadratic in the rows)
+is skipped above --knn-max-rows.
+
+The results can be stored as a baseline and later runs compared against it: a stage
+regresses when its time (beyond a noise floor) or its peak RSS grows by more than
+--tolerance, and the run then exits with status 1.
+
+Usage (from the repository root):
+    python benchmarks/pipeline_benchmark.py --rows 1000 10000 100000 --save-baseline
+    python benchmarks/pipeline_benchmark.py --rows 1000 10000 100000
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+from data_cleaning import (load_and_basic_data_cleaning, zero_variance_drop, corr_based_drop,  # noqa: E402
+                           low_variance_aggr, log_transform)
+from knn_imputation import feature_scaling, KNN_imputing, targets  # noqa: E402
+from median_and_freq_imputation import median_freq_imputing  # noqa: E402
+from imputation_helpers import isolation_forest_anomaly_detection, restore_clinical_units  # noqa: E402
+from utils.ml_stratifiers import (MultilabelStratifiedKFold, RepeatedMultilabelStratifiedKFold,  # noqa: E402
+                                  MultilabelStratifiedShuffleSplit)
+from utils.telemetry import reset_peak_rss, peak_rss_mb  # noqa: E402
+from synthetic_cohort import write_raw_cohort  # noqa: E402
+
+CACHE_DIR = os.path.join(ROOT, 'benchmarks', '.cache')
+BASELINE_PATH = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+
+#time differences below this many seconds are noise, not regressions
+MIN_REGRESSION_SECONDS = 0.05
+
+
+class StageTimer:
+
+    def __init__(self, n_rows):
+        self.n_rows = n_rows
+        self.results = []
+
+    def run(self, stage, func, *args, rows=None):
+        rows = self.n_rows if rows is None else rows
+        reset_peak_rss()
+        start = time.perf_counter()
+        #the stages report their progress with print, which would flood the benchmark output
+        with contextlib.redirect_stdout(io.StringIO()):
+            out = func(*args)
+        elapsed = time.perf_counter() - start
+
+        self.results.append({'rows': self.n_rows, 'stage': stage, 'seconds': round(elapsed, 4),
+                             'rows/sec': int(rows / elapsed) if elapsed else None,
+                             'peak_rss_mb': round(peak_rss_mb(), 1)})
+        return out
+
+
+def _split_all(cv, y):
+    return sum(1 for _ in cv.split(np.zeros((y.shape[0], 1)), y))
+
+
+def benchmark_cohort(n_rows, seed=0, knn_max_rows=20_000, cache_dir=CACHE_DIR):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, f'cohort_{n_rows}_{seed}.csv')
+    if not os.path.exists(path):
+        write_raw_cohort(path, n_rows, seed)
+
+    timer = StageTimer(n_rows)
+    data = timer.run('load_and_basic_data_cleaning', load_and_basic_data_cleaning, path)
+    for step in (zero_variance_drop, corr_based_drop, low_variance_aggr, log_transform):
+        data = timer.run(step.__name__, step, data, rows=data.shape[0])
+    n_clean = data.shape[0]
+
+    y = data[targets].to_numpy(dtype=int)
+    for cv in (MultilabelStratifiedKFold(n_splits=5, shuffle=True, random_state=0),
+               RepeatedMultilabelStratifiedKFold(n_splits=5, n_repeats=2, random_state=0),
+               MultilabelStratifiedShuffleSplit(n_splits=5, test_size=0.2, random_state=0)):
+        timer.run(type(cv).__name__, _split_all, cv, y, rows=n_clean)
+
+    scaled_data, _ = timer.run('feature_scaling', feature_scaling, data, rows=n_clean)
+    if n_clean <= knn_max_rows:
+        timer.run('KNN_imputing', KNN_imputing, scaled_data, rows=n_clean)
+
+    imputed_data = timer.run('median_freq_imputing', median_freq_imputing, data.copy(), rows=n_clean)
+    scaled_imputed_data, scaler = feature_scaling(imputed_data)
+    analyzed_data = timer.run('isolation_forest_anomaly_detection', isolation_forest_anomaly_detection,
+                              scaled_imputed_data, rows=n_clean)
+    timer.run('restore_clinical_units', restore_clinical_units, analyzed_data, scaler, rows=n_clean)
+
+    return timer.results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Flag the stages slower or heavier than in the baseline by more than tolerance
+    """
+    regressions = []
+    for row in results:
+        base = baseline.get(f"{row['stage']}@{row['rows']}")
+        if base is None:
+            continue
+        slower = (row['seconds'] > base['seconds'] * (1 + tolerance)
+                  and row['seconds'] - base['seconds'] > MIN_REGRESSION_SECONDS)
+        heavier = row['peak_rss_mb'] > base['peak_rss_mb'] * (1 + tolerance)
+        if slower or heavier:
+            regressions.append({'stage': row['stage'], 'rows': row['rows'],
+                                'seconds': f"{base['seconds']} -> {row['seconds']}",
+                                'peak_rss_mb': f"{base['peak_rss_mb']} -> {row['peak_rss_mb']}"})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--knn-max-rows', type=int, default=20000,
+                        help='row count above which KNN_imputing is not run')
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help='where the synthetic cohorts are written')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true', help='store this run as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--output', help='JSON file for the results of this run')
+    args = parser.parse_args()
+
+    results = []
+    for n_rows in args.rows:
+        results += benchmark_cohort(n_rows, args.seed, args.knn_max_rows, args.cache_dir)
+    print(pd.DataFrame(results).to_string(index=False))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update({f"{row['stage']}@{row['rows']}": row for row in results})
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print("\nRegressions against the baseline:")
+            print(pd.DataFrame(regressions).to_string(index=False))
+            sys.exit(1)
+        print("\nNo regressions against the baseline.")
+
+
+if __name__ == '__main__':
+    main()
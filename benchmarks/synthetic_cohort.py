@@ -0,0 +1,74 @@
+"""
+Synthetic raw cohorts with the schema of data/raw.csv, from 10^3 to 10^7 rows.
+
+Rows are drawn with replacement from raw.csv, so the '?' missingness patterns
+(whole rows of unanswered STD questions, the >90% missing diagnosis times, ...)
+and the joint distribution of the four targets (their imbalance and co-occurrence)
+are those of the real data. Observed values are jittered (Age and counts by a few
+units, years/packs multiplicatively), so that duplicated draws do not collapse
+in the duplicate removal of load_and_basic_data_cleaning.
+
+Usage (from the repository root):
+    python benchmarks/synthetic_cohort.py --rows 1000000 --output data/synthetic_1M.csv
+"""
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RAW_DATA_PATH = os.path.join(ROOT, 'data', 'raw.csv')
+
+COUNT_COLS = ["Number of sexual partners", "First sexual intercourse", "Num of pregnancies"]
+CONTINUOUS_COLS = ["Smokes (years)", "Smokes (packs/year)", "Hormonal Contraceptives (years)", "IUD (years)"]
+
+
+def generate_raw_cohort(n_rows, seed=0, chunk_size=1_000_000, raw_path=RAW_DATA_PATH):
+    """
+    Yield the synthetic cohort in chunks of at most chunk_size rows (NaN where raw.csv has '?')
+    """
+    template = pd.read_csv(raw_path, na_values='?')
+    rng = np.random.default_rng(seed)
+
+    for start in range(0, n_rows, chunk_size):
+        n = min(chunk_size, n_rows - start)
+        chunk = template.iloc[rng.integers(template.shape[0], size=n)].reset_index(drop=True)
+
+        chunk['Age'] = np.clip(chunk['Age'] + rng.integers(-2, 3, size=n), 13, 84)
+
+        for col in COUNT_COLS:
+            values = chunk[col].to_numpy()
+            jitter = np.where(values > 0, rng.integers(-1, 2, size=n), 0)
+            chunk[col] = np.where(np.isnan(values), np.nan, np.maximum(values + jitter, np.minimum(values, 1)))
+
+        for col in CONTINUOUS_COLS:
+            values = chunk[col].to_numpy()
+            chunk[col] = np.where(values > 0, values * rng.lognormal(0, 0.1, size=n), values)
+
+        yield chunk
+
+
+def write_raw_cohort(path, n_rows, seed=0, chunk_size=1_000_000):
+    """
+    Write a synthetic cohort as a raw export, with '?' for the missing values
+    """
+    for i, chunk in enumerate(generate_raw_cohort(n_rows, seed, chunk_size)):
+        chunk.to_csv(path, mode='w' if i == 0 else 'a', header=i == 0, index=False, na_rep='?')
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, required=True)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', required=True)
+    args = parser.parse_args()
+
+    write_raw_cohort(args.output, args.rows, args.seed)
+    print(f"{args.rows} synthetic rows written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+import joblib
+import numpy as np
+from joblib import Parallel, delayed
+from sklearn.ensemble import IsolationForest
+
+
+class AnomalyScorer:
+    """
+    Isolation Forest anomaly scoring with a single traversal of the forest per row:
+    the anomaly label is derived from the decision function (-1 where it is negative,
+    as IsolationForest.predict does) instead of being computed by a second pass.
+    Rows are scored in chunks spread over n_jobs threads, the fitted forest can be
+    saved and loaded, and new batches or streamed chunks are scored against it
+    without refitting.
+    """
+
+    def __init__(self, n_estimators=100, contamination='auto', random_state=42, n_jobs=-1, chunk_size=10_000):
+        self.n_estimators = n_estimators
+        self.contamination = contamination
+        self.random_state = random_state
+        self.n_jobs = n_jobs
+        self.chunk_size = chunk_size
+
+    def fit(self, X):
+        self.feature_names_ = list(X.columns) if hasattr(X, 'columns') else None
+        self.forest_ = IsolationForest(n_estimators=self.n_estimators, contamination=self.contamination,
+                                       random_state=self.random_state, n_jobs=self.n_jobs)
+        self.forest_.fit(self._as_array(X))
+        return self
+
+    def decision_function(self, X):
+        X = self._as_array(X)
+        if X.shape[0] <= self.chunk_size:
+            return self.forest_.decision_function(X)
+
+        chunks = [X[start:start + self.chunk_size] for start in range(0, X.shape[0], self.chunk_size)]
+        scores = Parallel(n_jobs=self.n_jobs, prefer="threads")(
+            delayed(self.forest_.decision_function)(chunk) for chunk in chunks)
+        return np.concatenate(scores)
+
+    def score(self, X):
+        """
+        Return the anomaly labels (1 inlier, -1 outlier) and scores of X
+        """
+        scores = self.decision_function(X)
+        labels = np.where(scores < 0, -1, 1)
+        return labels, scores
+
+    def score_chunks(self, chunks, features):
+        """
+        Score a stream of DataFrame chunks (e.g. new intake batches),
+        yielding each chunk with its anomaly_label and anomaly_score columns
+        """
+        for chunk in chunks:
+            chunk = chunk.copy()
+            chunk['anomaly_label'], chunk['anomaly_score'] = self.score(chunk[features])
+            yield chunk
+
+    def _as_array(self, X):
+        #the forest works on float32 arrays, DataFrame columns are checked against the fitted features
+        if hasattr(X, 'columns'):
+            if self.feature_names_ is not None and list(X.columns) != self.feature_names_:
+                raise ValueError("The columns do not match the features the forest was fitted on")
+            return X.to_numpy(dtype=np.float32)
+        return np.asarray(X, dtype=np.float32)
+
+    def save(self, path):
+        joblib.dump(self, path)
+
+    @staticmethod
+    def load(path):
+        return joblib.load(path)
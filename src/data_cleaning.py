@@ -1,36 +1,376 @@
+import csv
+import hashlib
+import io
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
+from utils.columnar_store import write_columnar
+from utils.paths import DATA_DIR
+from utils.telemetry import instrument
+from utils.streaming_stats import compute_statistics
 
 
-RAW_DATA_PATH = 'C:\\unibo-dtm-ml-2526-cervical-cancer-predictor\\data\\raw.csv'
-PROCESSED_DATA_PATH = 'C:\\unibo-dtm-ml-2526-cervical-cancer-predictor\\data\\cleaned_data.csv'
+RAW_DATA_PATH = os.path.join(DATA_DIR, 'raw.csv')
+PROCESSED_DATA_PATH = os.path.join(DATA_DIR, 'cleaned_data')
+PROCESSED_CSV_PATH = os.path.join(DATA_DIR, 'cleaned_data.csv')
+#row-hash index and file manifest of the multi-site ingestion, kept between runs
+INGEST_INDEX_DIR = os.path.join(DATA_DIR, 'ingest_index')
 
-def load_and_basic_data_cleaning(file_name = RAW_DATA_PATH):  
+#the stages hand data over in the columnar format of utils/columnar_store.py, CSV is only an export
+EXPORT_CSV = True
+
+#declared compact schema of the raw export, used by both load_and_basic_data_cleaning and the streaming reader:
+#years and packs are continuous (Float64: in float32 the parsed or log-transformed values are rounded, and the
+#rounding changes the KNN donors downstream), every other column is a small count or a 0/1 flag (uint8, max 84 in EDA).
+#The pandas masked dtypes keep the missing values in a separate boolean mask, so a flag takes 2 bytes instead
+#of the 9 of the Int64/Float64 columns of convert_dtypes, and the columnar store bit-packs flags and masks on disk
+CONTINUOUS_RAW_COLS = ["Smokes (years)", "Smokes (packs/year)", "Hormonal Contraceptives (years)", "IUD (years)"]
+COUNT_RAW_COLS = ["Age", "Number of sexual partners", "First sexual intercourse", "Num of pregnancies",
+                  "STDs (number)", "STDs: Number of diagnosis", "STDs: Time since first diagnosis",
+                  "STDs: Time since last diagnosis"]
+RAW_COLS = ["Age", "Number of sexual partners", "First sexual intercourse", "Num of pregnancies",
+            "Smokes", "Smokes (years)", "Smokes (packs/year)", "Hormonal Contraceptives",
+            "Hormonal Contraceptives (years)", "IUD", "IUD (years)", "STDs", "STDs (number)",
+            "STDs:condylomatosis", "STDs:cervical condylomatosis", "STDs:vaginal condylomatosis",
+            "STDs:vulvo-perineal condylomatosis", "STDs:syphilis", "STDs:pelvic inflammatory disease",
+            "STDs:genital herpes", "STDs:molluscum contagiosum", "STDs:AIDS", "STDs:HIV",
+            "STDs:Hepatitis B", "STDs:HPV", "STDs: Number of diagnosis", "STDs: Time since first diagnosis",
+            "STDs: Time since last diagnosis", "Dx:Cancer", "Dx:CIN", "Dx:HPV", "Dx",
+            "Hinselmann", "Schiller", "Citology", "Biopsy"]
+CONTINUOUS_DTYPE, COUNT_DTYPE, FLAG_DTYPE = "Float64", "UInt8", "UInt8"
+RAW_SCHEMA = {col: CONTINUOUS_DTYPE if col in CONTINUOUS_RAW_COLS else COUNT_DTYPE if col in COUNT_RAW_COLS
+              else FLAG_DTYPE for col in RAW_COLS}
+
+#number of raw rows parsed at a time in streaming mode
+CHUNK_SIZE = 100_000
+#block size of the reads fingerprinting the raw exports
+FINGERPRINT_BLOCK_SIZE = 1 << 20
+
+targets = ["Hinselmann", "Schiller", "Citology", "Biopsy"]
+
+#feature decisions taken in EDA, shared by the cleaning functions below and by preprocessing.py
+#(derive_drop_sets recomputes the dropping decisions from the data itself)
+HIGH_MISSINGNESS_COLS = ['STDs: Time since first diagnosis', 'STDs: Time since last diagnosis']
+HIGH_CORR_COLS = ["STDs", "STDs:vulvo-perineal condylomatosis", "STDs: Number of diagnosis", "Dx:HPV"]
+REDUNDANT_COLS = ["Smokes", "Hormonal Contraceptives", "IUD"]
+VIRAL_GROUP = ['STDs:genital herpes', 'STDs:Hepatitis B', 'STDs:HPV']
+BACTERIAL_GROUP = ['STDs:pelvic inflammatory disease', 'STDs:molluscum contagiosum', 'STDs:vaginal condylomatosis']
+LOG_TRANSFORM_COLS = ["Number of sexual partners", "Smokes (years)", 
+                      "Smokes (packs/year)", "Hormonal Contraceptives (years)", "IUD (years)"]
+
+@instrument
+def load_and_basic_data_cleaning(file_name = RAW_DATA_PATH, chunksize = None):  
     """
     Initial cleaning steps based on EDA findings
-    
+    If chunksize is given, the data is ingested through stream_basic_data_cleaning
     """
+    if chunksize is not None:
+        return pd.concat(stream_basic_data_cleaning(file_name, chunksize=chunksize))
+
     #load the data and immediately proceed with "?" values conversion to NaN
     df = pd.read_csv(file_name, na_values='?')
 
     #remove the 23 duplicates found in EDA
     df.drop_duplicates(inplace=True)
 
-    #conversion of the columns containing NaN values to numeric type
-    df = df.apply(pd.to_numeric, errors="coerce").convert_dtypes()
+    #conversion of the columns containing NaN values to numeric type, then to the compact schema
+    #(a value out of the range of its declared type raises instead of being wrapped)
+    df = df.apply(pd.to_numeric, errors="coerce")
+    df = df.astype({col: dtype for col, dtype in RAW_SCHEMA.items() if col in df.columns})
 
     return df
 
-def zero_variance_drop(df):
+#128-bit row keys: the row hash of pandas, and a second one independent of it (the field names
+#differ from the ones of the earlier keys, whose low half was not independent, so their indexes are not loaded)
+ROW_KEY_DTYPE = np.dtype([('high', np.uint64), ('keyed_low', np.uint64)])
+#hash key of the string columns in the low half (the high half uses the default key of pandas)
+ROW_KEY_HASH_KEY = '5f1c9e27b04d83a6'
+
+def row_keys(chunk):
+    """
+    128-bit key of every row of a typed chunk. The high half is hash_pandas_object's row hash;
+    the low half hashes the string columns with another key, re-mixes every column hash with a salt
+    of its own (numeric column hashes are injective, so the salt decorrelates them from the high half)
+    and XORs them, so the two halves are independent 64-bit hashes. The deduplication trusts the keys:
+    for n rows, two different ones share a key with probability about n^2 / 2^129 (1e-21 at a billion rows)
+    """
+    keys = np.empty(chunk.shape[0], dtype=ROW_KEY_DTYPE)
+    keys['high'] = pd.util.hash_pandas_object(chunk, index=False).to_numpy()
+    salts = pd.util.hash_array(np.arange(chunk.shape[1], dtype=np.uint64), hash_key=ROW_KEY_HASH_KEY)
+    low = np.zeros(chunk.shape[0], dtype=np.uint64)
+    for salt, col in zip(salts, chunk.columns):
+        column_hash = pd.util.hash_pandas_object(chunk[col], index=False, hash_key=ROW_KEY_HASH_KEY).to_numpy()
+        low ^= pd.util.hash_array(column_hash ^ salt)
+    keys['keyed_low'] = low
+    return keys
+
+def _sorted_run(high, low):
+    #runs are sorted on the high hash only: keys sharing it are told apart by their low hash
+    order = np.argsort(high, kind='stable')
+    return high[order], low[order]
+
+def _merge_runs(run, other):
+    """Merge two sorted runs in linear time"""
+    (high, low), (other_high, other_low) = run, other
+    positions = np.searchsorted(high, other_high) + np.arange(other_high.shape[0])
+    is_other = np.zeros(high.shape[0] + other_high.shape[0], dtype=bool)
+    is_other[positions] = True
+    merged_high, merged_low = np.empty(is_other.shape[0], np.uint64), np.empty(is_other.shape[0], np.uint64)
+    merged_high[positions], merged_high[~is_other] = other_high, high
+    merged_low[positions], merged_low[~is_other] = other_low, low
+    return merged_high, merged_low
+
+def _contains(run, high, low):
+    """Mask of the keys found in a sorted run, searched by their high hash and checked on the low one"""
+    run_high, run_low = run
+    start = np.searchsorted(run_high, high, side='left')
+    stop = np.searchsorted(run_high, high, side='right')
+    found = stop > start
+    found[found] = run_low[start[found]] == low[found]
+    #keys sharing their high hash with several keys of the run (practically never)
+    for i in np.flatnonzero(stop - start > 1):
+        found[i] = (run_low[start[i]:stop[i]] == low[i]).any()
+    return found
+
+class RowHashIndex:
+    """
+    Index of the 128-bit keys (see row_keys) of the rows seen so far, so that duplicates
+    can be removed across chunks without holding the rows themselves (16 bytes per unique row).
+    The keys are kept as sorted runs: each batch adds a run, and runs of similar sizes are
+    merged, so there are O(log n) runs to search and every key is merged O(log n) times
+    """
+
+    def __init__(self, keys=None):
+        #every run is a (high, low) pair of uint64 arrays, sorted on high
+        self.runs = []
+        if keys is not None and len(keys):
+            self.add(keys)
+
+    def __len__(self):
+        return sum(high.shape[0] for high, _ in self.runs)
+
+    def add(self, keys):
+        """
+        Add the keys to the index and return the mask of the ones that were new
+        (first occurrence within the batch, and not seen in previous batches)
+        """
+        high = np.ascontiguousarray(keys['high'])
+        low = np.ascontiguousarray(keys['keyed_low'])
+        #first occurrence of every key within the batch: the first of its sorted group (stable sort)
+        order = np.lexsort((np.arange(high.shape[0]), low, high))
+        first = np.ones(high.shape[0], dtype=bool)
+        first[1:] = (high[order[1:]] != high[order[:-1]]) | (low[order[1:]] != low[order[:-1]])
+        first = order[first]
+
+        seen = np.zeros(first.shape[0], dtype=bool)
+        for run in self.runs:
+            seen |= _contains(run, high[first], low[first])
+        first = first[~seen]
+
+        is_new = np.zeros(high.shape[0], dtype=bool)
+        is_new[first] = True
+
+        if first.shape[0]:
+            self.runs.append(_sorted_run(high[first], low[first]))
+            while len(self.runs) > 1 and self.runs[-2][0].shape[0] <= 2 * self.runs[-1][0].shape[0]:
+                last = self.runs.pop()
+                self.runs[-1] = _merge_runs(self.runs[-1], last)
+
+        return is_new
+
+    @property
+    def keys(self):
+        """All the keys, sorted on their high hash"""
+        while len(self.runs) > 1:
+            last = self.runs.pop()
+            self.runs[-1] = _merge_runs(self.runs[-1], last)
+        keys = np.empty(len(self), dtype=ROW_KEY_DTYPE)
+        if self.runs:
+            keys['high'], keys['keyed_low'] = self.runs[0]
+        return keys
+
+    def save(self, path):
+        #written aside and then renamed, so that an interrupted run never leaves a truncated index
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, self.keys)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        """Index saved by save, or an empty one if there is none yet"""
+        if not os.path.exists(path):
+            return cls()
+        keys = np.load(path)
+        if keys.dtype != ROW_KEY_DTYPE:
+            #the keys of an older index cannot be recomputed without the rows
+            raise ValueError(f"{path} holds {keys.dtype} row hashes, not the current 128-bit row keys: "
+                             "remove the index directory and ingest the exports again")
+        return cls(keys)
+
+
+@instrument
+def stream_basic_data_cleaning(file_name = RAW_DATA_PATH, chunksize = CHUNK_SIZE, schema = RAW_SCHEMA, index = None):
+    """
+    Streaming counterpart of load_and_basic_data_cleaning: the raw export is read
+    in chunks of at most chunksize rows, parsed straight into the declared schema
+    ("?" becoming NaN in the typed columns), and each cleaned chunk is yielded to
+    the downstream stages. Duplicates are removed across chunks through a row-hash
+    index, so peak memory is bounded by the chunk size rather than the file size.
+    """
+    if index is None:
+        index = RowHashIndex()
+
+    reader = pd.read_csv(file_name, na_values='?', usecols=list(schema), dtype=schema, chunksize=chunksize)
+
+    for chunk in reader:
+        #keeping the declared column order, whatever the order of the export
+        chunk = chunk[list(schema)]
+
+        #hashing the typed rows and keeping only the ones never seen before
+        chunk = chunk[index.add(row_keys(chunk))]
+
+        if not chunk.empty:
+            yield chunk
+
+def _scan_export(file_name, record):
+    """
+    Fingerprint a raw export in one read: the digest of the prefix ingested last time (to check
+    the file was only appended to since), the offset/digest of the prefix up to its last newline
+    and of the whole file, and whether the file stayed the same while it was read
+    """
+    before = os.stat(file_name)
+    hasher = hashlib.blake2b()
+    previous = record['offset'] if record else None
+    prefix_digest = None
+    checkpoint = (hasher.copy(), b'', 0)
+    position = 0
+
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(FINGERPRINT_BLOCK_SIZE), b''):
+            if previous is not None and position <= previous < position + len(block):
+                prefix_hasher = hasher.copy()
+                prefix_hasher.update(block[:previous - position])
+                prefix_digest = prefix_hasher.hexdigest()
+            if b'\n' in block:
+                checkpoint = (hasher.copy(), block, position)
+            hasher.update(block)
+            position += len(block)
+
+    if previous is not None and previous == position:
+        prefix_digest = hasher.hexdigest()
+    after = os.stat(file_name)
+    stable = (before.st_size, before.st_mtime_ns) == (after.st_size, after.st_mtime_ns) and after.st_size == position
+
+    line_hasher, block, start = checkpoint
+    line_hasher.update(block[:block.rfind(b'\n') + 1])
+    offset = start + block.rfind(b'\n') + 1 if block else 0
+    return (prefix_digest, {'offset': offset, 'digest': line_hasher.hexdigest()},
+            {'offset': position, 'digest': hasher.hexdigest()}, stable)
+
+def _parse_new_rows(file_name, record, schema):
+    """
+    Parse the rows of a raw export not ingested yet: the whole file, or only the part
+    appended since the last run if the previously ingested prefix is unchanged
+    """
+    prefix_digest, lines_record, file_record, stable = _scan_export(file_name, record)
+    offset = record['offset'] if record and prefix_digest == record['digest'] else 0
+    header = pd.read_csv(file_name, nrows=0).columns.tolist()
+
+    #the end of the file ends its last row as well, newline or not, unless the row is still
+    #being written: the file changed while it was read, or the row misses some fields.
+    #Such a row is left for the next run
+    new_record = file_record
+    if file_record['offset'] > lines_record['offset']:
+        with open(file_name, 'rb') as f:
+            f.seek(lines_record['offset'])
+            tail = f.read().decode(errors='replace')
+        if not stable or len(next(csv.reader([tail]))) != len(header):
+            new_record = lines_record
+
+    end = new_record['offset']
+    if end <= offset:
+        return pd.DataFrame(columns=list(schema)).astype(schema), new_record
+
+    with open(file_name, 'rb') as f:
+        f.seek(offset)
+        new_rows = io.BytesIO(f.read(end - offset))
+    #same parsing as stream_basic_data_cleaning: "?" becomes NaN, values are typed by the schema
+    chunk = pd.read_csv(new_rows, header=0 if offset == 0 else None, names=header, na_values='?',
+                        usecols=list(schema), dtype=schema)
+
+    return chunk[list(schema)], new_record
+
+@instrument
+def ingest_site_exports(file_names, index_dir = INGEST_INDEX_DIR, schema = RAW_SCHEMA, n_jobs = None):
+    """
+    Multi-site ingestion: the raw exports of several clinics are parsed concurrently
+    (n_jobs threads) with the parsing of stream_basic_data_cleaning, and the rows are
+    deduplicated across files, and across runs, against the persistent row-hash index in index_dir.
+    A manifest of the ingested files records how far each was read, so re-ingesting after
+    a new export only parses the new files and the rows appended to the old ones.
+    One cleaned frame of new rows is yielded per file, in the given order; the index and
+    the manifest are saved once all of them have been consumed (index_dir=None: no persistence)
+    """
+    index_path = manifest_path = None
+    manifest = {}
+    if index_dir is not None:
+        os.makedirs(index_dir, exist_ok=True)
+        index_path = os.path.join(index_dir, 'row_hashes.npy')
+        manifest_path = os.path.join(index_dir, 'files.json')
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+    index = RowHashIndex.load(index_path) if index_path else RowHashIndex()
+
+    n_jobs = n_jobs or os.cpu_count() or 1
+    with ThreadPoolExecutor(n_jobs) as executor:
+        pending = []
+        #the None sentinel flushes the files still in flight (at most 2 * n_jobs)
+        for key in [os.path.abspath(file_name) for file_name in file_names] + [None]:
+            if key is not None:
+                pending.append((key, executor.submit(_parse_new_rows, key, manifest.get(key), schema)))
+
+            #deduplicating in file order keeps the result independent of the parsing order
+            while pending and (key is None or len(pending) >= 2 * n_jobs):
+                parsed_key, future = pending.pop(0)
+                chunk, manifest[parsed_key] = future.result()
+                chunk = chunk[index.add(row_keys(chunk))]
+                if not chunk.empty:
+                    yield chunk
+
+    if index_dir is not None:
+        index.save(index_path)
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+def derive_drop_sets(file_name = RAW_DATA_PATH, chunksize = CHUNK_SIZE, n_jobs = None):
+    """
+    Derive the dropping decisions of zero_variance_drop and corr_based_drop from the data,
+    instead of the lists fixed in EDA: one streaming pass over the cleaned chunks
+    accumulates the missing counts, variances and pairwise correlations (see utils/streaming_stats.py),
+    from which the zero-variance, >90% missing and >0.80 / 0.70-0.80 correlated columns follow
+    """
+    stats = compute_statistics(stream_basic_data_cleaning(file_name, chunksize=chunksize), n_jobs=n_jobs)
+    return stats.drop_sets(targets)
+
+@instrument
+def zero_variance_drop(df, drop_sets = None):
     """
     Drop the columns with zero variance, 
     as they do not provide any useful information for the model.
     Drop cols with too many missing values as well
+    drop_sets: optional output of derive_drop_sets, replacing the variance computation and the EDA list
     """
 
     #calculating the variance of each column and identifying those with zero variance
-    variances = df.var()
-    zero_var_cols = variances[variances == 0].index.tolist()
+    if drop_sets is None:
+        variances = df.var()
+        zero_var_cols = variances[variances == 0].index.tolist()
+    else:
+        zero_var_cols = [col for col in drop_sets['zero_variance'] if col in df.columns]
 
     #dropping the zero-variance columns and printing their names
     if zero_var_cols:
@@ -41,23 +381,25 @@ def zero_variance_drop(df):
         print("No zero-variance columns detected.")
 
     #dropping the two columns with more than 90% of missing values
-    df = df.drop(columns=['STDs: Time since first diagnosis', 'STDs: Time since last diagnosis'], errors='ignore')
+    high_missingness_cols = HIGH_MISSINGNESS_COLS if drop_sets is None else drop_sets['high_missingness']
+    df = df.drop(columns=high_missingness_cols, errors='ignore')
     
     return df
 
-def corr_based_drop(df):
+@instrument
+def corr_based_drop(df, drop_sets = None):
 
     #dropping features with high correlation (corr >0.80) with other features, as identified in EDA
-    high_corr_cols = ["STDs", "STDs:vulvo-perineal condylomatosis", "STDs: Number of diagnosis", "Dx:HPV"]
-    df = df.drop(columns=high_corr_cols, errors='ignore')
+    #(or as derived from the data by derive_drop_sets)
+    df = df.drop(columns=HIGH_CORR_COLS if drop_sets is None else drop_sets['high_correlation'], errors='ignore')
 
     #dropping other columns, characterized by less correlation (0.7 < corr < 0.80)
     #but still providing redundant information, as identified in EDA
-    redundant_cols= ["Smokes", "Hormonal Contraceptives", "IUD"]
-    df = df.drop(columns=redundant_cols, errors='ignore')
+    df = df.drop(columns=REDUNDANT_COLS if drop_sets is None else drop_sets['redundant'], errors='ignore')
 
     return df 
 
+@instrument
 def low_variance_aggr(df):
     """
     Aggregate low-variance features (all specific forms of STDs, as EDA unveiled)
@@ -65,12 +407,12 @@ def low_variance_aggr(df):
     """
 
     #lists of specific STDs to be aggregated into the two new columns, based on their nature (viral or bacterial)
-    viral_group = [col for col in ['STDs:genital herpes', 'STDs:Hepatitis B', 'STDs:HPV'] if col in df.columns]
-    bact_inf_group = [col for col in ['STDs:pelvic inflammatory disease', 'STDs:molluscum contagiosum', 'STDs:vaginal condylomatosis'] if col in df.columns]
+    viral_group = [col for col in VIRAL_GROUP if col in df.columns]
+    bact_inf_group = [col for col in BACTERIAL_GROUP if col in df.columns]
     
     #creating the new aggregated columns by summing the values of the specific STD columns
-    df['STDs: Viral group'] = df[viral_group].sum(axis=1)
-    df['STDs: Bacterial group'] = df[bact_inf_group].sum(axis=1)
+    df['STDs: Viral group'] = df[viral_group].sum(axis=1).astype(COUNT_DTYPE)
+    df['STDs: Bacterial group'] = df[bact_inf_group].sum(axis=1).astype(COUNT_DTYPE)
 
     #moving the two new columns to more logical positions in the dataset
     df.insert(9, 'STDs: Viral group', df.pop('STDs: Viral group'))  
@@ -81,19 +423,18 @@ def low_variance_aggr(df):
 
     return df
 
+@instrument
 def log_transform(df):
     """
     Apply log transformation to the columns found in EDA to be right-skewed, 
     in order to reduce skewness and make the data more normally distributed.
     """
 
-    cols_to_transform = ["Number of sexual partners", "Smokes (years)", 
-                         "Smokes (packs/year)", "Hormonal Contraceptives (years)", "IUD (years)"]
-    
-    for col in cols_to_transform: 
+    for col in LOG_TRANSFORM_COLS: 
         if col in df.columns:
             #using log1p to handle zero values in the columns, and very small numbers
-            df[col] = np.log1p(df[col]) 
+            #(counts are widened to CONTINUOUS_DTYPE, the dtype of the continuous columns)
+            df[col] = np.log1p(df[col].astype(CONTINUOUS_DTYPE))
     return df 
 
 if __name__ == "__main__":
@@ -126,5 +467,9 @@ if __name__ == "__main__":
     data = log_transform(data)
     print("Log transformation applied to the right-skewed features.")
 
-    data.to_csv(PROCESSED_DATA_PATH, index=False)
-    print(f"Cleaned data saved to {PROCESSED_DATA_PATH}")
\ No newline at end of file
+    write_columnar(data, PROCESSED_DATA_PATH)
+    print(f"Cleaned data saved to {PROCESSED_DATA_PATH}")
+
+    if EXPORT_CSV:
+        data.to_csv(PROCESSED_CSV_PATH, index=False)
+        print(f"Cleaned data exported to {PROCESSED_CSV_PATH}")
\ No newline at end of file
@@ -0,0 +1,172 @@
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.impute import KNNImputer, SimpleImputer
+from sklearn.preprocessing import MinMaxScaler
+
+from imputation_helpers import restore_clinical_units
+from median_and_freq_imputation import MEDIAN_IMPUTED_COLS
+
+
+#default memory budget of an imputation cache
+DEFAULT_MAX_BYTES = 512 * 2 ** 20
+
+
+class ImputationCache:
+    """
+    LRU cache of fitted imputations and imputed matrices, evicting the least
+    recently used entries once the stored arrays exceed max_bytes
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key][0]
+
+    def put(self, key, value, n_bytes):
+        if key in self.entries:
+            self.n_bytes -= self.entries.pop(key)[1]
+
+        self.entries[key] = (value, n_bytes)
+        self.n_bytes += n_bytes
+
+        while self.n_bytes > self.max_bytes and len(self.entries) > 1:
+            _, (_, evicted_bytes) = self.entries.popitem(last=False)
+            self.n_bytes -= evicted_bytes
+
+    def clear(self):
+        self.entries.clear()
+        self.n_bytes = 0
+
+
+#caches are looked up by name, since sklearn's clone deep-copies the estimator parameters
+_CACHES = {}
+
+
+def get_cache(name="default"):
+    if name not in _CACHES:
+        _CACHES[name] = ImputationCache()
+    return _CACHES[name]
+
+
+def set_cache_budget(max_bytes, name="default"):
+    get_cache(name).max_bytes = max_bytes
+
+
+def _data_key(df):
+    digest = hashlib.sha1()
+    digest.update(repr(list(df.columns)).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+class FoldImputer(TransformerMixin, BaseEstimator):
+    """
+    In-fold imputation stage, to be put in front of the classifiers of the modeling
+    pipelines (e.g. Pipeline([('imputer', FoldImputer()), ('scaler', MinMaxScaler()), ...])),
+    so that the imputation is fitted on the training indices of each fold only and
+    static, pre-CV imputation no longer leaks information from the test folds.
+
+    strategy='knn' replays knn_imputation.py (MinMaxScaler, KNNImputer with distance
+    weighting, restore_clinical_units); strategy='median_freq' replays
+    median_and_freq_imputation.py (median / most frequent SimpleImputers, restore_clinical_units).
+
+    Fitted imputations and imputed matrices are memoized in the named ImputationCache,
+    keyed by the content of the training (and transformed) rows and by the imputer
+    parameters: all the candidates of a search evaluated on the same fold share one
+    imputation. The cache lives in the process, so searches should run with n_jobs=1
+    or a threading backend to share it across candidates.
+    X must be a DataFrame holding the (incomplete) features of cleaned_data.
+    """
+
+    def __init__(self, strategy="knn", n_neighbors=29, cache="default"):
+        self.strategy = strategy
+        self.n_neighbors = n_neighbors
+        self.cache = cache
+
+    def _params_key(self):
+        return (self.strategy, self.n_neighbors) if self.strategy == "knn" else (self.strategy,)
+
+    def fit(self, X, y=None):
+        if self.strategy not in ("knn", "median_freq"):
+            raise ValueError(f"strategy must be 'knn' or 'median_freq', got {self.strategy!r}")
+
+        cache = get_cache(self.cache)
+        data_key = _data_key(X)
+        self.fit_key_ = ("fit", self._params_key(), data_key)
+
+        fitted = cache.get(self.fit_key_)
+        if fitted is None:
+            fitted = self._fit_imputation(X)
+            cache.put(self.fit_key_, fitted, X.memory_usage(index=False).sum())
+
+            #the imputed training matrix is stored as well, for fit_transform
+            train_out = self._impute(X, fitted)
+            cache.put(("transform", self.fit_key_, data_key), train_out, train_out.nbytes)
+
+        self.fitted_ = fitted
+        self.feature_names_in_ = np.asarray(X.columns, dtype=object)
+        return self
+
+    def transform(self, X):
+        cache = get_cache(self.cache)
+        key = ("transform", self.fit_key_, _data_key(X))
+
+        out = cache.get(key)
+        if out is None:
+            out = self._impute(X, self.fitted_)
+            cache.put(key, out, out.nbytes)
+
+        #handing out a copy, so that downstream steps cannot alter the cached matrix
+        return pd.DataFrame(out.copy(), columns=X.columns, index=X.index)
+
+    def fit_transform(self, X, y=None, **fit_params):
+        return self.fit(X, y).transform(X)
+
+    def _fit_imputation(self, X):
+        if self.strategy == "knn":
+            scaler = MinMaxScaler().fit(X)
+            imputer = KNNImputer(missing_values=np.nan, n_neighbors=self.n_neighbors, weights="distance")
+            #fitted on a frame, as it transforms frames: the feature names are checked, and not warned about
+            imputer.fit(pd.DataFrame(scaler.transform(X), columns=X.columns, index=X.index))
+            return {"scaler": scaler, "imputers": [(list(X.columns), imputer)], "scale_first": True}
+
+        median_cols = [col for col in MEDIAN_IMPUTED_COLS if col in X.columns]
+        freq_cols = [col for col in X.columns if col not in median_cols + ["Age"]]
+        imputers = [(median_cols, SimpleImputer(missing_values=np.nan, strategy="median").fit(X[median_cols])),
+                    (freq_cols, SimpleImputer(missing_values=np.nan, strategy="most_frequent").fit(X[freq_cols]))]
+
+        imputed = X.astype(float)
+        for cols, imputer in imputers:
+            imputed[cols] = imputer.transform(X[cols])
+
+        return {"scaler": MinMaxScaler().fit(imputed), "imputers": imputers, "scale_first": False}
+
+    def _impute(self, X, fitted):
+        scaler = fitted["scaler"]
+        df = X.astype(float)
+
+        if fitted["scale_first"]:
+            df[list(X.columns)] = scaler.transform(df)
+
+        for cols, imputer in fitted["imputers"]:
+            df[cols] = imputer.transform(df[cols])
+
+        if not fitted["scale_first"]:
+            df[list(X.columns)] = scaler.transform(df)
+
+        return restore_clinical_units(df, scaler).to_numpy(dtype=np.float64)
@@ -0,0 +1,85 @@
+import numpy as np
+from sklearn.preprocessing import MinMaxScaler
+from anomaly_scoring import AnomalyScorer
+from utils.telemetry import instrument
+
+
+targets = ["Hinselmann", "Schiller", "Citology", "Biopsy"]
+
+#dtype of the imputed features, in both imputation branches: scaling, imputation and anomaly detection run in
+#float64 (in float32 the scaled features are rounded and the KNN donors with tied distances change), and the
+#continuous features are stored as such, as the Float64 continuous columns of data_cleaning.RAW_SCHEMA
+FEATURE_DTYPE = np.float64
+
+#steps shared by the KNN and the median/frequency imputation scripts
+
+@instrument
+def feature_scaling(df): 
+    """
+    Perform feature scaling before proceeding with KNN imputation,
+    so as to avoid the distance calculation 
+    being biased by the different scales of the features.
+    """
+    features = [col for col in df.columns if col not in targets]
+
+    scaler = MinMaxScaler() 
+    scaled_data = scaler.fit_transform(df[features].astype(np.float64))
+    scaled_df = df.copy()
+    scaled_df[features] = scaled_data
+
+    #returning the scaler object so to then eventually perform the inverse transformation
+    return scaled_df, scaler
+
+@instrument
+def isolation_forest_anomaly_detection(df, model_path=None):
+    """
+    Perform anomaly detection using Isolation Forest on the imputed dataset.
+    This method identifies anomalies by isolating observations in the feature space.
+    Labels and scores come from a single scoring pass (see anomaly_scoring.py);
+    if model_path is given, the fitted scorer is saved there to score new batches later.
+    """
+    
+    features = [col for col in df.columns if col not in targets]
+    scorer = AnomalyScorer(n_estimators=100, contamination='auto', random_state=42).fit(df[features])
+
+    df['anomaly_label'], df['anomaly_score'] = scorer.score(df[features])
+
+    if model_path is not None:
+        scorer.save(model_path)
+
+    return df
+
+@instrument
+def restore_clinical_units(df, scaler):
+
+    #defining the original features to be re-scaled (excluding anomaly_label and anomaly_score)
+    original_features = list(scaler.feature_names_in_)
+
+    #reverse the scale of the features after all operations have been performed
+    df[original_features] = scaler.inverse_transform(df[original_features])
+
+    #doing the same with the previously log-transformed features, so not to distort the medical reality of the data
+    cols_to_transform = ["Number of sexual partners", "Smokes (years)", 
+                     "Smokes (packs/year)", "Hormonal Contraceptives (years)", "IUD (years)"]
+
+    df[cols_to_transform] = np.expm1(df[cols_to_transform])
+
+    #separate the continuous columns from the discrete ones
+    continuous_cols = ["Smokes (years)", "Smokes (packs/year)", 
+        "Hormonal Contraceptives (years)", "IUD (years)"]
+    discrete_cols = [col for col in original_features if col not in continuous_cols]
+
+    #rounding the discrete features to the nearest integer, back to the uint8 counts and flags of the schema:
+    #the imputed values lie within the observed range, so any value out of the uint8 range is an error
+    #(astype would silently wrap it around)
+    rounded = df[discrete_cols].round()
+    uint8_range = np.iinfo(np.uint8)
+    out_of_range = ((rounded < uint8_range.min) | (rounded > uint8_range.max)).any()
+    if out_of_range.any():
+        raise ValueError(f"Columns {out_of_range[out_of_range].index.tolist()} have values out of the uint8 range")
+    df[discrete_cols] = rounded.astype(np.uint8)
+
+    #the continuous features are stored in FEATURE_DTYPE, the discrete ones as uint8
+    df[continuous_cols] = df[continuous_cols].astype(FEATURE_DTYPE)
+
+    return df
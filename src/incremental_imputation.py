@@ -0,0 +1,158 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import KDTree
+
+from knn_engine import _get_weights
+from preprocessing import ClinicalPreprocessor, targets
+
+
+class IncrementalKNNImputer:
+    """
+    Persisted imputation model for the daily intake of new patient records.
+
+    It holds the fitted ClinicalPreprocessor (cleaning, scaling and restore_clinical_units
+    logic) and a donor pool, i.e. the already imputed cohort in scaled space. New raw
+    records are cleaned, scaled, imputed from their n_neighbors nearest donors
+    (nan-euclidean distance, distance weighting, as in knn_imputation.KNN_imputing)
+    and brought back to clinical units, without refitting anything.
+
+    Donors are searched through KD-trees built lazily for each missingness pattern
+    of the incoming records. Newly verified records are appended to the pool and
+    searched brute-force until they exceed rebuild_ratio times the indexed donors,
+    at which point the trees are rebuilt on the next query.
+    """
+
+    def __init__(self, preprocessor, n_neighbors=29, weights="distance", rebuild_ratio=0.1, leaf_size=40):
+        self.preprocessor = preprocessor
+        self.n_neighbors = n_neighbors
+        self.weights = weights
+        self.rebuild_ratio = rebuild_ratio
+        self.leaf_size = leaf_size
+
+        columns = preprocessor.output_columns_
+        self.feature_idx_ = np.array([i for i, col in enumerate(columns) if col not in targets])
+
+    def fit(self, cohort):
+        """
+        Build the donor pool from an imputed cohort in clinical units
+        (e.g. the output of knn_imputation.py)
+        """
+        donors = self.preprocessor.rescale(cohort, dtype=np.float64)[:, self.feature_idx_]
+        if np.isnan(donors).any():
+            raise ValueError("The donor cohort must not have missing features")
+
+        self._set_pool(donors)
+        return self
+
+    def _set_pool(self, donors):
+        self._pool = np.array(donors, dtype=np.float64)
+        self.n_donors_ = donors.shape[0]
+        self._n_indexed = self.n_donors_
+        self._trees = {}
+
+    @property
+    def donors_(self):
+        return self._pool[:self.n_donors_]
+
+    def transform(self, X):
+        """
+        Clean, scale and impute a batch of raw records (the columns of
+        data_cleaning.load_and_basic_data_cleaning); returns the scaled array
+        with the columns of preprocessor.output_columns_
+        """
+        out = self.preprocessor.transform(X, dtype=np.float64)
+        features = out[:, self.feature_idx_]
+        mask = np.isnan(features)
+
+        rows_missing = np.flatnonzero(mask.any(axis=1))
+        if rows_missing.shape[0]:
+            patterns, pattern_idx = np.unique(mask[rows_missing], axis=0, return_inverse=True)
+            for i, pattern in enumerate(patterns):
+                rows = rows_missing[pattern_idx.ravel() == i]
+                features[np.ix_(rows, pattern)] = self._impute_pattern(features[rows], pattern)
+
+        out[:, self.feature_idx_] = features
+        return out
+
+    def impute(self, X):
+        """
+        Impute a batch of raw records and return it in clinical units
+        (scaling and log transform undone, discrete features rounded)
+        """
+        restored = self.preprocessor.inverse_transform(self.transform(X), dtype=np.float64)
+        return pd.DataFrame(restored, columns=self.preprocessor.output_columns_)
+
+    def _impute_pattern(self, rows, pattern):
+        observed = np.flatnonzero(~pattern)
+        if observed.shape[0] == 0:
+            return np.broadcast_to(self.donors_[:, pattern].mean(axis=0), (rows.shape[0], pattern.sum()))
+
+        queries = rows[:, observed]
+        n_neighbors = min(self.n_neighbors, self.n_donors_)
+
+        #indexed donors, through the KD-tree of this pattern
+        if self.n_donors_ - self._n_indexed > self.rebuild_ratio * self._n_indexed:
+            self._n_indexed = self.n_donors_
+            self._trees = {}
+        key = observed.tobytes()
+        if key not in self._trees:
+            self._trees[key] = KDTree(self._pool[:self._n_indexed, observed], leaf_size=self.leaf_size)
+        dist, donors_idx = self._trees[key].query(queries, k=min(n_neighbors, self._n_indexed))
+
+        #donors appended since the last rebuild, brute force
+        if self._n_indexed < self.n_donors_:
+            delta = self._pool[self._n_indexed:self.n_donors_, observed]
+            delta_dist = np.sqrt(((queries[:, np.newaxis, :] - delta[np.newaxis]) ** 2).sum(axis=2))
+            dist = np.hstack([dist, delta_dist])
+            donors_idx = np.hstack([donors_idx, np.broadcast_to(np.arange(self._n_indexed, self.n_donors_),
+                                                                delta_dist.shape)])
+            nearest = np.argpartition(dist, n_neighbors - 1, axis=1)[:, :n_neighbors]
+            dist = np.take_along_axis(dist, nearest, axis=1)
+            donors_idx = np.take_along_axis(donors_idx, nearest, axis=1)
+
+        #rescaling to the nan-euclidean distance, which weighs the observed coordinates up
+        dist = dist * np.sqrt(pattern.shape[0] / observed.shape[0])
+
+        weight_matrix = _get_weights(dist, self.weights)
+        donors = self._pool[:, pattern][donors_idx]
+        return np.einsum('rk,rkc->rc', weight_matrix, donors) / weight_matrix.sum(axis=1)[:, None]
+
+    def add_donors(self, X):
+        """
+        Append newly verified raw records to the donor pool (their own missing
+        features are imputed first), without rebuilding the index
+        """
+        new_donors = self.transform(X)[:, self.feature_idx_]
+
+        n_total = self.n_donors_ + new_donors.shape[0]
+        if n_total > self._pool.shape[0]:
+            #growing the pool geometrically, so that appends are amortized O(1) per row
+            pool = np.empty((max(n_total, 2 * self._pool.shape[0]), self._pool.shape[1]))
+            pool[:self.n_donors_] = self.donors_
+            self._pool = pool
+
+        self._pool[self.n_donors_:n_total] = new_donors
+        self.n_donors_ = n_total
+
+        return self
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.preprocessor.save(os.path.join(path, 'preprocessor.npz'))
+        np.save(os.path.join(path, 'donors.npy'), self.donors_)
+        params = {'n_neighbors': self.n_neighbors, 'weights': self.weights,
+                  'rebuild_ratio': self.rebuild_ratio, 'leaf_size': self.leaf_size}
+        with open(os.path.join(path, 'params.json'), 'w') as f:
+            json.dump(params, f, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, 'params.json')) as f:
+            params = json.load(f)
+
+        imputer = cls(ClinicalPreprocessor.load(os.path.join(path, 'preprocessor.npz')), **params)
+        imputer._set_pool(np.load(os.path.join(path, 'donors.npy')))
+        return imputer
@@ -0,0 +1,179 @@
+import numpy as np
+from joblib import Parallel, delayed
+from sklearn.metrics.pairwise import nan_euclidean_distances
+from sklearn.neighbors import BallTree, KDTree
+
+
+#search strategies of BlockedKNNImputer
+SEARCHES = {'brute': None, 'ball_tree': BallTree, 'kd_tree': KDTree}
+
+
+def _get_weights(dist, weights):
+    """
+    Donor weights, as computed by KNNImputer: with distance weighting, donors at
+    distance zero take all the weight of their receiver; undefined distances weigh zero
+    """
+    if weights == "uniform":
+        weight_matrix = np.ones_like(dist)
+        weight_matrix[np.isnan(dist)] = 0.
+        return weight_matrix
+
+    with np.errstate(divide="ignore"):
+        weight_matrix = 1. / dist
+    inf_mask = np.isinf(weight_matrix)
+    inf_row = np.any(inf_mask, axis=1)
+    weight_matrix[inf_row] = inf_mask[inf_row]
+    weight_matrix[np.isnan(weight_matrix)] = 0.
+
+    return weight_matrix
+
+
+def _as_float(X, copy=False):
+    #float32 input is kept as is, like in KNNImputer
+    X = np.asarray(X)
+    dtype = X.dtype if X.dtype in (np.float32, np.float64) else np.float64
+    return np.array(X, dtype=dtype) if copy else np.asarray(X, dtype=dtype)
+
+
+class BlockedKNNImputer:
+    """
+    KNN imputation engine with the semantics of sklearn's KNNImputer
+    (nan-euclidean distance, uniform or distance weighting), built to scale
+    beyond a few thousand rows.
+
+    search='brute' is exact: receivers are processed in blocks whose distance
+    matrix fits within working_memory (MB), and blocks are spread over n_jobs
+    threads. The result is the one of KNNImputer, float32 input included (the
+    distances are computed in the dtype of the input), and so is the shape:
+    columns without any observed value at fit time are dropped, or set to 0
+    with keep_empty_features=True.
+
+    search='ball_tree' / 'kd_tree' trade exactness for speed: donors are
+    restricted to the complete-case rows, indexed once per missingness pattern
+    of the receivers (the nan-euclidean distance to a complete row is a scaled
+    euclidean distance over the receiver's observed features), and the k
+    neighbors of a receiver are queried once for all its missing features.
+    """
+
+    def __init__(self, n_neighbors=29, weights="distance", search='brute', working_memory=256,
+                 leaf_size=40, n_jobs=None, keep_empty_features=False):
+        if search not in SEARCHES:
+            raise ValueError(f"search must be one of {list(SEARCHES)}, got {search!r}")
+
+        self.n_neighbors = n_neighbors
+        self.weights = weights
+        self.search = search
+        self.working_memory = working_memory
+        self.leaf_size = leaf_size
+        self.n_jobs = n_jobs
+        self.keep_empty_features = keep_empty_features
+
+    def fit(self, X, y=None):
+        self.fit_X_ = _as_float(X)
+        self.mask_fit_X_ = np.isnan(self.fit_X_)
+        self.col_means_ = np.ma.array(self.fit_X_, mask=self.mask_fit_X_).mean(axis=0).filled(np.nan)
+        #columns with at least one observed value, the others are left out like in KNNImputer
+        self.valid_mask_ = ~self.mask_fit_X_.all(axis=0)
+
+        if self.search != 'brute':
+            self.donors_ = self.fit_X_[~self.mask_fit_X_[:, self.valid_mask_].any(axis=1)]
+            if self.donors_.shape[0] == 0:
+                raise ValueError("Indexed search needs at least one complete-case donor, use search='brute'")
+
+        return self
+
+    def fit_transform(self, X, y=None):
+        return self.fit(X).transform(X)
+
+    def transform(self, X):
+        X = _as_float(X, copy=True)
+        mask = np.isnan(X)
+        #only the valid columns are imputed
+        mask[:, ~self.valid_mask_] = False
+        row_missing_idx = np.flatnonzero(mask.any(axis=1))
+
+        if row_missing_idx.shape[0] == 0:
+            return self._drop_empty(X)
+
+        if self.search == 'brute':
+            tasks = [delayed(self._impute_block_brute)(X[block], mask[block])
+                     for block in np.array_split(row_missing_idx, self._n_blocks(row_missing_idx.shape[0]))]
+            blocks = np.array_split(row_missing_idx, len(tasks))
+        else:
+            patterns, pattern_idx = np.unique(mask[row_missing_idx], axis=0, return_inverse=True)
+            blocks = [row_missing_idx[pattern_idx.ravel() == i] for i in range(patterns.shape[0])]
+            tasks = [delayed(self._impute_block_indexed)(X[block], pattern)
+                     for block, pattern in zip(blocks, patterns)]
+
+        #numpy and the tree queries release the GIL, so threads share fit_X without copies
+        results = Parallel(n_jobs=self.n_jobs, prefer="threads")(tasks)
+        for block, imputed in zip(blocks, results):
+            X[block] = imputed
+
+        return self._drop_empty(X)
+
+    def _drop_empty(self, X):
+        if self.keep_empty_features:
+            X[:, ~self.valid_mask_] = 0
+            return X
+        return X[:, self.valid_mask_]
+
+    def _n_blocks(self, n_receivers):
+        #the nan-euclidean computation keeps a few (block x n_fit) temporaries alive
+        row_bytes = 4 * self.fit_X_.itemsize * self.fit_X_.shape[0]
+        block_size = max(1, int(self.working_memory * 2 ** 20 // row_bytes))
+        return max(1, -(-n_receivers // block_size))
+
+    def _impute_block_brute(self, X_block, mask_block):
+        #distances in the dtype of the data, as KNNImputer computes them (float32 ones are less accurate,
+        #which is why knn_imputation.KNN_imputing imputes in float64)
+        dist = nan_euclidean_distances(X_block, self.fit_X_)
+        X_block = X_block.copy()
+
+        for col in np.flatnonzero(mask_block.any(axis=0)):
+            potential_donors_idx = np.flatnonzero(~self.mask_fit_X_[:, col])
+            if potential_donors_idx.shape[0] == 0:
+                continue
+
+            receivers = np.flatnonzero(mask_block[:, col])
+            dist_subset = dist[receivers][:, potential_donors_idx]
+
+            #receivers with all nan distances impute with the column mean
+            all_nan_dist = np.isnan(dist_subset).all(axis=1)
+            X_block[receivers[all_nan_dist], col] = self.col_means_[col]
+            if np.all(all_nan_dist):
+                continue
+            receivers = receivers[~all_nan_dist]
+            dist_subset = dist_subset[~all_nan_dist]
+
+            n_neighbors = min(self.n_neighbors, potential_donors_idx.shape[0])
+            donors_idx = np.argpartition(dist_subset, n_neighbors - 1, axis=1)[:, :n_neighbors]
+            donors_dist = dist_subset[np.arange(donors_idx.shape[0])[:, None], donors_idx]
+
+            weight_matrix = _get_weights(donors_dist, self.weights)
+            donors = self.fit_X_[potential_donors_idx, col].take(donors_idx)
+            X_block[receivers, col] = np.ma.average(np.ma.array(donors, mask=np.zeros(donors.shape, bool)),
+                                                    axis=1, weights=weight_matrix).data
+
+        return X_block
+
+    def _impute_block_indexed(self, X_block, pattern):
+        X_block = X_block.copy()
+        observed = np.flatnonzero(~pattern & self.valid_mask_)
+
+        if observed.shape[0] == 0:
+            X_block[:, pattern] = self.col_means_[pattern]
+            return X_block
+
+        n_neighbors = min(self.n_neighbors, self.donors_.shape[0])
+        tree = SEARCHES[self.search](self.donors_[:, observed], leaf_size=self.leaf_size)
+        dist, donors_idx = tree.query(X_block[:, observed], k=n_neighbors)
+
+        #rescaling to the nan-euclidean distance, which weighs the observed coordinates up
+        dist *= np.sqrt(X_block.shape[1] / observed.shape[0])
+
+        weight_matrix = _get_weights(dist, self.weights)
+        donors = self.donors_[:, pattern][donors_idx]
+        X_block[:, pattern] = np.einsum('rk,rkc->rc', weight_matrix, donors) / weight_matrix.sum(axis=1)[:, None]
+
+        return X_block
@@ -1,42 +1,64 @@
+import os
 import pandas as pd
-import numpy as np
-from sklearn.impute import SimpleImputer
-from sklearn.preprocessing import MinMaxScaler
-from sklearn.ensemble import IsolationForest
-from knn_imputation import feature_scaling, isolation_forest_anomaly_detection, restore_clinical_units
+from imputation_helpers import FEATURE_DTYPE, feature_scaling, isolation_forest_anomaly_detection, restore_clinical_units
+from utils.columnar_store import read_columnar, write_columnar
+from utils.paths import DATA_DIR, IMPUTED_DATA_DIR
+from utils.sketches import QUANTILE_K, SketchImputer
+from utils.telemetry import instrument
 
-BASIC_CLEANED_DATA_PATH = 'C:\\unibo-dtm-ml-2526-cervical-cancer-predictor\\data\\cleaned_data.csv'
-PROCESSED_DATA_PATH = 'C:\\unibo-dtm-ml-2526-cervical-cancer-predictor\\data\\data_after_imputation\\median_and_freq_imputed.csv'
+BASIC_CLEANED_DATA_PATH = os.path.join(DATA_DIR, 'cleaned_data')
+PROCESSED_DATA_PATH = os.path.join(IMPUTED_DATA_DIR, 'median_and_freq_imputed')
+PROCESSED_CSV_PATH = os.path.join(IMPUTED_DATA_DIR, 'median_and_freq_imputed.csv')
+
+#the stages hand data over in the columnar format of utils/columnar_store.py, CSV is only an export
+EXPORT_CSV = True
 
 targets = ["Hinselmann", "Schiller", "Citology", "Biopsy"]
 
+#count/duration columns imputed with the median, every other incomplete column gets the most frequent value
+MEDIAN_IMPUTED_COLS = ["Number of sexual partners", "First sexual intercourse", "Num of pregnancies", 
+                       "Smokes (years)","Smokes (packs/year)",
+                       "Hormonal Contraceptives (years)", "IUD (years)","STDs (number)"]
+
+def median_freq_columns(columns):
+    """Columns imputed with the median and with the most frequent value"""
+    exclude = MEDIAN_IMPUTED_COLS + ["Age"] + targets #Age column is complete
+    return MEDIAN_IMPUTED_COLS, [col for col in columns if col not in exclude]
+
+def fit_median_freq_imputer(chunks, columns, n_jobs = None, k = QUANTILE_K):
+    """
+    Fit the median/most frequent imputation in one streaming pass over chunks of cleaned data
+    (e.g. from data_cleaning.stream_basic_data_cleaning and the column dropping steps),
+    sketched in parallel on n_jobs threads; the imputer then fills chunk by chunk with transform_stream
+    Medians come from mergeable quantile sketches (see utils/sketches.py): they are exact up to
+    k values per column (always with k=None, keeping every value), and their rank error
+    is bounded by imputer.error_bounds_ above
+    """
+    median_cols, mode_cols = median_freq_columns(columns)
+    return SketchImputer(median_cols, mode_cols, k=k, dtype=FEATURE_DTYPE).fit(chunks, n_jobs=n_jobs)
+
 # Setting up the imputation strategy for the missing values in the dataset.
-def median_freq_imputing(df):
+@instrument
+def median_freq_imputing(df, chunksize = None, n_jobs = None):
     """
     Perform imputation of missing values for those columns still having some
     missing values after the initial cleaning steps.
+    If chunksize is given, the imputer is fitted on chunks of rows in parallel (n_jobs threads),
+    with bounded sketches; otherwise the frame is already in memory and the medians are exact
     """
-    num_imputer = SimpleImputer(missing_values=np.nan,strategy="median")
-    int_missing_values = ["Number of sexual partners", "First sexual intercourse", "Num of pregnancies", 
-                          "Smokes (years)","Smokes (packs/year)",
-                          "Hormonal Contraceptives (years)", "IUD (years)","STDs (number)"]
-    
-    df[int_missing_values] = num_imputer.fit_transform(df[int_missing_values])
-    
-    exclude = int_missing_values + ["Age"] + targets #Age column is complete
+    if chunksize is None:
+        imputer = fit_median_freq_imputer([df], df.columns, k=None)
+    else:
+        chunks = (df.iloc[start:start + chunksize] for start in range(0, len(df), chunksize))
+        imputer = fit_median_freq_imputer(chunks, df.columns, n_jobs=n_jobs)
 
-    cat_cols = [col for col in df.columns if col not in exclude]
-    cat_imputer = SimpleImputer(missing_values=np.nan, strategy="most_frequent")
-    
-    df[cat_cols] = cat_imputer.fit_transform(df[cat_cols])
-    
-    return df
+    return imputer.transform(df)
 
 if __name__ == "__main__":
     #executing the whole pipeline with the methods just defined
     print("Starting median-based imputation process...")
 
-    data = pd.read_csv(BASIC_CLEANED_DATA_PATH)
+    data = read_columnar(BASIC_CLEANED_DATA_PATH)
     
     #performing median and frequency imputation of the missing values
     imputed_data = median_freq_imputing(data)
@@ -52,6 +74,10 @@ if __name__ == "__main__":
     #restore the data from scaling and log transform (data un-squashing)
     final_data = restore_clinical_units(analyzed_data, scaler)
 
-    final_data.to_csv(PROCESSED_DATA_PATH, index=False)
+    write_columnar(final_data, PROCESSED_DATA_PATH)
     print(f"Cleaned data saved to {PROCESSED_DATA_PATH}")
 
+    if EXPORT_CSV:
+        final_data.to_csv(PROCESSED_CSV_PATH, index=False)
+        print(f"Cleaned data exported to {PROCESSED_CSV_PATH}")
+
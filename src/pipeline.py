@@ -0,0 +1,356 @@
+"""
+Data preparation pipeline, run as a DAG of cached stages:
+
+    clean -> knn_impute        -> knn_anomaly        -> knn_restore
+          -> median_freq_impute -> median_freq_anomaly -> median_freq_restore
+
+Every stage output is cached under .pipeline_cache/<stage>/<key>, where the key
+hashes the stage inputs (content of the raw file, digest of the upstream outputs),
+its code (stage function and every src module it imports, directly or not), its
+parameters and the versions of the numerical libraries. Stages whose key is already cached are skipped,
+the others run in a pool of worker processes, so the KNN and median/frequency
+branches are computed in parallel. sklearn is only imported by the stages that run,
+so a fully cached run starts and ends in a fraction of a second.
+
+The results are published where the single scripts write them
+(data/cleaned_data, data/data_after_imputation/*_imputed, plus the CSV exports).
+
+Usage (from the src folder):
+    python -m pipeline [--force] [--jobs 2] [--no-csv]
+"""
+
+import argparse
+import ast
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import sys
+import textwrap
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from importlib.metadata import PackageNotFoundError, version
+
+from utils.paths import DATA_DIR, IMPUTED_DATA_DIR, ROOT_DIR
+
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.path.join(ROOT_DIR, '.pipeline_cache')
+RAW_DATA_PATH = os.path.join(DATA_DIR, 'raw.csv')
+
+#libraries whose version is part of every cache key
+KEY_PACKAGES = ['numpy', 'pandas', 'scikit-learn']
+
+
+def _read_data(path):
+    from utils.columnar_store import read_columnar
+    return read_columnar(os.path.join(path, 'data'), mmap=False)
+
+
+def _write_data(path, df, scaler=None):
+    from utils.columnar_store import write_columnar
+    write_columnar(df, os.path.join(path, 'data'))
+    if scaler is not None:
+        import joblib
+        joblib.dump(scaler, os.path.join(path, 'scaler.joblib'))
+
+
+def clean_stage(out_dir, raw_path):
+    from data_cleaning import (load_and_basic_data_cleaning, zero_variance_drop, corr_based_drop,
+                               low_variance_aggr, log_transform)
+
+    data = load_and_basic_data_cleaning(raw_path)
+    for step in (zero_variance_drop, corr_based_drop, low_variance_aggr, log_transform):
+        data = step(data)
+    _write_data(out_dir, data)
+
+
+def knn_impute_stage(out_dir, cleaned_dir, n_neighbors):
+    from knn_imputation import feature_scaling, KNN_imputing
+
+    scaled_data, scaler = feature_scaling(_read_data(cleaned_dir))
+    _write_data(out_dir, KNN_imputing(scaled_data, n_neighbors=n_neighbors), scaler)
+
+
+def median_freq_impute_stage(out_dir, cleaned_dir):
+    from median_and_freq_imputation import feature_scaling, median_freq_imputing
+
+    scaled_data, scaler = feature_scaling(median_freq_imputing(_read_data(cleaned_dir)))
+    _write_data(out_dir, scaled_data, scaler)
+
+
+def anomaly_stage(out_dir, imputed_dir):
+    from imputation_helpers import isolation_forest_anomaly_detection
+
+    _write_data(out_dir, isolation_forest_anomaly_detection(_read_data(imputed_dir)))
+
+
+def restore_stage(out_dir, analyzed_dir, imputed_dir):
+    import joblib
+    from imputation_helpers import restore_clinical_units
+
+    scaler = joblib.load(os.path.join(imputed_dir, 'scaler.joblib'))
+    _write_data(out_dir, restore_clinical_units(_read_data(analyzed_dir), scaler))
+
+
+def _module_file(module, base_dir=SRC_DIR):
+    #src file of a module name (relative to base_dir), None for the installed packages
+    path = os.path.join(base_dir, *module.split('.'))
+    for candidate in (path + '.py', os.path.join(path, '__init__.py')):
+        if os.path.isfile(candidate):
+            return os.path.normpath(candidate)
+    return None
+
+
+def _imported_files(tree, file_dir):
+    """src files imported anywhere in an ast (function-level imports included)"""
+    files = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules = [(alias.name, SRC_DIR) for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            #relative imports (utils/) are resolved from the importing file, the others from src
+            base_dir = file_dir if node.level else SRC_DIR
+            for _ in range(node.level - 1):
+                base_dir = os.path.dirname(base_dir)
+            module = node.module or ''
+            #"from package import module" imports a module as well
+            modules = [(module, base_dir)] + [(f"{module}.{alias.name}".strip('.'), base_dir) for alias in node.names]
+        else:
+            continue
+        files.update(path for path in (_module_file(name, base_dir) for name, base_dir in modules if name) if path)
+    return files
+
+
+def code_files(func):
+    """
+    src files a stage function depends on: pipeline.py functions it calls (e.g. _read_data),
+    and every src module they import, transitively
+    """
+    module = sys.modules[func.__module__]
+    trees, seen_functions = [], set()
+    functions = [func]
+    while functions:
+        function = functions.pop()
+        if function.__name__ in seen_functions:
+            continue
+        seen_functions.add(function.__name__)
+        tree = ast.parse(textwrap.dedent(inspect.getsource(function)))
+        trees.append(tree)
+        for node in ast.walk(tree):
+            helper = getattr(module, node.id, None) if isinstance(node, ast.Name) else None
+            if inspect.isfunction(helper) and helper.__module__ == func.__module__:
+                functions.append(helper)
+
+    files = set()
+    for tree in trees:
+        files |= _imported_files(tree, SRC_DIR)
+    pending = list(files)
+    while pending:
+        path = pending.pop()
+        with open(path) as f:
+            for imported in _imported_files(ast.parse(f.read()), os.path.dirname(path)) - files:
+                files.add(imported)
+                pending.append(imported)
+    return sorted(files)
+
+
+class Stage:
+    """
+    A node of the pipeline: func(out_dir, *sources, *upstream_output_dirs, **params)
+    writes the stage output into out_dir, and publish is the columnar path (and CSV export)
+    its output is copied to; the src modules hashed in the key are found by code_files
+    """
+
+    def __init__(self, name, func, deps=(), sources=(), params=None, publish=None):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.sources = list(sources)
+        self.params = params or {}
+        self.publish = publish
+
+    @property
+    def code(self):
+        return code_files(self.func)
+
+    def key(self, digests):
+        """
+        Cache key of the stage, given the output digests of its upstream stages
+        """
+        key = hashlib.sha1()
+        key.update(self.name.encode())
+        key.update(inspect.getsource(self.func).encode())
+        for path in self.code:
+            key.update(os.path.relpath(path, SRC_DIR).encode())
+            key.update(_file_digest(path).encode())
+        key.update(json.dumps(self.params, sort_keys=True).encode())
+        for source in self.sources:
+            key.update(_file_digest(source).encode())
+        for dep in self.deps:
+            key.update(digests[dep].encode())
+        for package in KEY_PACKAGES:
+            try:
+                key.update(version(package).encode())
+            except PackageNotFoundError:
+                pass
+        return key.hexdigest()
+
+
+def _file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _dir_digest(path):
+    digest = hashlib.sha1()
+    for folder, dirs, files in sorted(os.walk(path)):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(folder, name)
+            digest.update(os.path.relpath(file_path, path).encode())
+            digest.update(_file_digest(file_path).encode())
+    return digest.hexdigest()
+
+
+def build_stages(raw_path=RAW_DATA_PATH, n_neighbors=29):
+    return [
+        Stage('clean', clean_stage, sources=[raw_path], publish=os.path.join(DATA_DIR, 'cleaned_data')),
+        Stage('knn_impute', knn_impute_stage, deps=['clean'], params={'n_neighbors': n_neighbors}),
+        Stage('median_freq_impute', median_freq_impute_stage, deps=['clean']),
+        Stage('knn_anomaly', anomaly_stage, deps=['knn_impute']),
+        Stage('median_freq_anomaly', anomaly_stage, deps=['median_freq_impute']),
+        Stage('knn_restore', restore_stage, deps=['knn_anomaly', 'knn_impute'],
+              publish=os.path.join(IMPUTED_DATA_DIR, 'knn_imputed')),
+        Stage('median_freq_restore', restore_stage, deps=['median_freq_anomaly', 'median_freq_impute'],
+              publish=os.path.join(IMPUTED_DATA_DIR, 'median_and_freq_imputed')),
+    ]
+
+
+def _execute(stage, entry, inputs):
+    """
+    Run a stage into its cache entry; the entry only appears, through an atomic
+    rename, once the output and the manifest are complete
+    """
+    tmp_entry = f"{entry}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_entry, ignore_errors=True)
+    out_dir = os.path.join(tmp_entry, 'output')
+    os.makedirs(out_dir)
+
+    start = time.perf_counter()
+    stage.func(out_dir, *inputs, **stage.params)
+    manifest = {'stage': stage.name, 'digest': _dir_digest(out_dir),
+                'seconds': round(time.perf_counter() - start, 3), 'created': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    with open(os.path.join(tmp_entry, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    shutil.rmtree(entry, ignore_errors=True)
+    os.replace(tmp_entry, entry)
+    return manifest
+
+
+def run(stages, cache_dir=CACHE_DIR, force=False, jobs=2):
+    """
+    Run the stages in dependency order, skipping those already cached (unless force),
+    and return {stage name: (output dir, manifest, status)}
+    """
+    results = {}
+    pending = {stage.name: stage for stage in stages}
+    digests = {}
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        running = {}
+        while pending or running:
+            progress = True
+            while progress:
+                progress = False
+                for name, stage in list(pending.items()):
+                    if not all(dep in digests for dep in stage.deps):
+                        continue
+                    del pending[name]
+                    progress = True
+
+                    entry = os.path.join(cache_dir, name, stage.key(digests))
+                    manifest_path = os.path.join(entry, 'manifest.json')
+                    if not force and os.path.exists(manifest_path):
+                        with open(manifest_path) as f:
+                            manifest = json.load(f)
+                        digests[name] = manifest['digest']
+                        results[name] = (os.path.join(entry, 'output'), manifest, 'cached')
+                        continue
+
+                    inputs = stage.sources + [results[dep][0] for dep in stage.deps]
+                    running[pool.submit(_execute, stage, entry, inputs)] = (name, entry)
+
+            if not running:
+                if pending:
+                    raise ValueError(f"Unresolvable stage dependencies: {sorted(pending)}")
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name, entry = running.pop(future)
+                manifest = future.result()
+                digests[name] = manifest['digest']
+                results[name] = (os.path.join(entry, 'output'), manifest, 'ran')
+
+    return results
+
+
+def publish(stages, results, cache_dir=CACHE_DIR, export_csv=True):
+    """
+    Copy the outputs of the publishing stages to their data paths,
+    only when they differ from what was last published there
+    """
+    published_path = os.path.join(cache_dir, 'published.json')
+    published = {}
+    if os.path.exists(published_path):
+        with open(published_path) as f:
+            published = json.load(f)
+
+    for stage in stages:
+        if stage.publish is None:
+            continue
+        out_dir, manifest, _ = results[stage.name]
+        if published.get(stage.publish) == manifest['digest'] and os.path.exists(stage.publish):
+            continue
+
+        shutil.rmtree(stage.publish, ignore_errors=True)
+        shutil.copytree(os.path.join(out_dir, 'data'), stage.publish)
+        if export_csv:
+            from utils.columnar_store import to_csv
+            to_csv(stage.publish, stage.publish + '.csv')
+        published[stage.publish] = manifest['digest']
+        print(f"Published {stage.name} to {stage.publish}")
+
+    with open(published_path, 'w') as f:
+        json.dump(published, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--raw', default=RAW_DATA_PATH, help='raw CSV export to clean')
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    parser.add_argument('--jobs', type=int, default=2, help='worker processes running the stages')
+    parser.add_argument('--n-neighbors', type=int, default=29)
+    parser.add_argument('--force', action='store_true', help='recompute every stage, ignoring the cache')
+    parser.add_argument('--no-csv', action='store_true', help='skip the CSV exports of the published outputs')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    stages = build_stages(args.raw, args.n_neighbors)
+    results = run(stages, args.cache_dir, force=args.force, jobs=args.jobs)
+    publish(stages, results, args.cache_dir, export_csv=not args.no_csv)
+
+    for stage in stages:
+        _, manifest, status = results[stage.name]
+        print(f"{stage.name:<22}{status:<8}{manifest['seconds']:>8.3f}s  {manifest['digest'][:12]}")
+    print(f"Pipeline completed in {time.perf_counter() - start:.3f}s")
+
+
+if __name__ == '__main__':
+    main()
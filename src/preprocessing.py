@@ -0,0 +1,159 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+from data_cleaning import RAW_COLS, CONTINUOUS_RAW_COLS, HIGH_MISSINGNESS_COLS, HIGH_CORR_COLS, \
+    REDUNDANT_COLS, VIRAL_GROUP, BACTERIAL_GROUP, LOG_TRANSFORM_COLS
+
+
+targets = ["Hinselmann", "Schiller", "Citology", "Biopsy"]
+
+#names and positions of the two aggregated STD columns, as in data_cleaning.low_variance_aggr
+AGGREGATED_COLS = {'STDs: Viral group': (9, VIRAL_GROUP), 'STDs: Bacterial group': (10, BACTERIAL_GROUP)}
+
+
+class ClinicalPreprocessor:
+    """
+    Fitted, fused version of the preprocessing chain
+    zero_variance_drop -> corr_based_drop -> low_variance_aggr -> log_transform -> feature_scaling
+    and of its inverse, restore_clinical_units.
+
+    At fit time, the dropped columns, the STD group sums, the log-transformed columns,
+    the min/max scaling parameters and the rounding of the inverse transform are compiled
+    into NumPy index and coefficient arrays, so that a whole batch is transformed
+    (or inverse-transformed) in a handful of vectorized operations, with no per-column loop.
+    The fitted object can be saved and loaded, so a scoring service applies exactly
+    the transform of the training data.
+    """
+
+    #fitted attributes stored by save
+    _fitted_arrays = ['copy_dst_', 'copy_src_', 'group_dst_', 'group_src_', 'group_offsets_',
+                      'log_idx_', 'scale_', 'offset_', 'round_idx_']
+
+    def fit(self, df):
+        """
+        Fit on the output of data_cleaning.load_and_basic_data_cleaning
+        """
+        self.input_columns_ = [col for col in RAW_COLS if col in df.columns]
+        raw = self._to_array(df, self.input_columns_, np.float64)
+
+        #zero-variance columns are the only decision depending on the data
+        variances = np.nanvar(raw, axis=0, ddof=1)
+        zero_var_cols = [col for col, var in zip(self.input_columns_, variances) if var == 0]
+
+        #replaying the column layout of the cleaning functions on the column names alone
+        dropped = set(zero_var_cols + HIGH_MISSINGNESS_COLS + HIGH_CORR_COLS + REDUNDANT_COLS)
+        columns = [col for col in self.input_columns_ if col not in dropped]
+        groups = {name: [col for col in group if col in columns] for name, (_, group) in AGGREGATED_COLS.items()}
+        for name, (position, _) in AGGREGATED_COLS.items():
+            columns.insert(position, name)
+        grouped = set(sum(groups.values(), []))
+        self.output_columns_ = [col for col in columns if col not in grouped]
+
+        position = {col: i for i, col in enumerate(self.input_columns_)}
+        out_position = {col: i for i, col in enumerate(self.output_columns_)}
+
+        #plain copies: output position <- input position
+        copied = [col for col in self.output_columns_ if col not in groups]
+        self.copy_dst_ = np.array([out_position[col] for col in copied], dtype=np.intp)
+        self.copy_src_ = np.array([position[col] for col in copied], dtype=np.intp)
+
+        #group sums: the members of every group are gathered next to each other and summed with reduceat
+        self.group_dst_ = np.array([out_position[name] for name in groups], dtype=np.intp)
+        self.group_src_ = np.array([position[col] for name in groups for col in groups[name]], dtype=np.intp)
+        self.group_offsets_ = np.cumsum([0] + [len(groups[name]) for name in groups])[:-1].astype(np.intp)
+
+        self.log_idx_ = np.array([out_position[col] for col in LOG_TRANSFORM_COLS if col in out_position],
+                                 dtype=np.intp)
+
+        #min/max scaling of the features, written as X * scale + offset (targets keep scale 1, offset 0)
+        features = np.array([col not in targets for col in self.output_columns_])
+        cleaned = self._clean(raw)
+        data_min = np.nanmin(cleaned, axis=0)
+        data_range = np.nanmax(cleaned, axis=0) - data_min
+        data_range[data_range == 0] = 1.
+
+        self.scale_ = np.where(features, 1. / data_range, 1.)
+        self.offset_ = np.where(features, -data_min * self.scale_, 0.)
+
+        #rounding of the discrete features in restore_clinical_units
+        self.round_idx_ = np.flatnonzero(features & ~np.isin(self.output_columns_, CONTINUOUS_RAW_COLS))
+
+        return self
+
+    @staticmethod
+    def _to_array(X, columns, dtype):
+        if isinstance(X, pd.DataFrame):
+            return X[columns].to_numpy(dtype=dtype, na_value=np.nan)
+        return np.asarray(X, dtype=dtype)
+
+    def _clean(self, raw):
+        out = np.empty((raw.shape[0], len(self.output_columns_)), dtype=raw.dtype)
+
+        out[:, self.copy_dst_] = raw[:, self.copy_src_]
+
+        #missing values count as zero in the group sums, like DataFrame.sum does
+        members = np.nan_to_num(raw[:, self.group_src_], nan=0.)
+        #a group left without members (e.g. all of them zero-variance) sums to zero; reduceat
+        #would take the next member for a repeated offset, and fail on a trailing one
+        sizes = np.diff(self.group_offsets_, append=self.group_src_.shape[0])
+        out[:, self.group_dst_] = 0.
+        if (sizes > 0).any():
+            out[:, self.group_dst_[sizes > 0]] = np.add.reduceat(members, self.group_offsets_[sizes > 0], axis=1)
+
+        out[:, self.log_idx_] = np.log1p(out[:, self.log_idx_])
+
+        return out
+
+    def transform(self, X, dtype=np.float32):
+        """
+        Clean, log-transform and scale a batch of raw records (a DataFrame, or an
+        array with the columns of input_columns_); missing values stay NaN
+        """
+        out = self._clean(self._to_array(X, self.input_columns_, dtype))
+        out *= self.scale_.astype(dtype)
+        out += self.offset_.astype(dtype)
+        return out
+
+    def inverse_transform(self, X, dtype=np.float32):
+        """
+        Undo scaling and log transform, and round the discrete features
+        (the array counterpart of knn_imputation.restore_clinical_units)
+        """
+        out = np.array(self._to_array(X, self.output_columns_, dtype), dtype=dtype)
+        out -= self.offset_.astype(dtype)
+        out /= self.scale_.astype(dtype)
+        out[:, self.log_idx_] = np.expm1(out[:, self.log_idx_])
+        out[:, self.round_idx_] = np.rint(out[:, self.round_idx_])
+        return out
+
+    def rescale(self, X, dtype=np.float32):
+        """
+        Log-transform and scale a batch already in clinical units, with the columns
+        of output_columns_ (e.g. an imputed cohort): the inverse of inverse_transform,
+        up to its rounding
+        """
+        out = np.array(self._to_array(X, self.output_columns_, dtype), dtype=dtype)
+        out[:, self.log_idx_] = np.log1p(out[:, self.log_idx_])
+        out *= self.scale_.astype(dtype)
+        out += self.offset_.astype(dtype)
+        return out
+
+    def transform_frame(self, X, dtype=np.float32):
+        return pd.DataFrame(self.transform(X, dtype), columns=self.output_columns_)
+
+    def save(self, path):
+        arrays = {name: getattr(self, name) for name in self._fitted_arrays}
+        columns = json.dumps({'input_columns_': self.input_columns_, 'output_columns_': self.output_columns_})
+        np.savez(path, columns=np.array(columns), **arrays)
+
+    @classmethod
+    def load(cls, path):
+        preprocessor = cls()
+        with np.load(path, allow_pickle=False) as stored:
+            for name, value in json.loads(str(stored['columns'])).items():
+                setattr(preprocessor, name, value)
+            for name in cls._fitted_arrays:
+                setattr(preprocessor, name, stored[name])
+        return preprocessor
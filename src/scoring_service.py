@@ -0,0 +1,424 @@
+"""
+Local scoring service for the champion multi-target model.
+
+A scoring bundle (see ScoringBundle.save) holds everything needed to score raw intake
+records: the cleaning/scaling rules and the donor pool of the KNN imputation
+(incremental_imputation.py), the anomaly scorer (anomaly_scoring.py), the fitted
+multi-target model and the per-target decision thresholds. It is loaded once at startup;
+the model is stored in the format of utils/model_bundle.py, so only the targets scored
+(--targets) are loaded, on first use.
+
+Usage (from the src folder):
+    python -m scoring_service serve --bundle BUNDLE_DIR --port 8000
+    python -m scoring_service score --bundle BUNDLE_DIR records.csv predictions.csv
+    python -m scoring_service loadtest --bundle BUNDLE_DIR --requests 2000 --concurrency 32
+
+The HTTP server coalesces concurrent requests into micro-batches, so that
+predict_proba runs vectorized over many records at once:
+    POST /score    {"records": [{"Age": 18, "Number of sexual partners": 4, ...}, ...]}
+    GET  /metrics  latency and throughput counters
+"""
+
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+import urllib.request
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import joblib
+import numpy as np
+import pandas as pd
+
+from anomaly_scoring import AnomalyScorer
+from incremental_imputation import IncrementalKNNImputer
+from preprocessing import ClinicalPreprocessor, targets
+from utils.model_bundle import load_model_bundle, save_model_bundle
+from utils.paths import DATA_DIR
+
+
+RAW_DATA_PATH = os.path.join(DATA_DIR, 'raw.csv')
+
+
+class _SelectedTargets:
+    """
+    A multi-target model restricted to some of its targets: the predict_proba
+    outputs of the others are dropped
+    """
+
+    def __init__(self, model, model_targets, targets):
+        unknown = [target for target in targets if target not in model_targets]
+        if unknown:
+            raise KeyError(f"Targets {unknown} are not predicted by the model, which predicts {model_targets}")
+        self.model = model
+        self.positions = [list(model_targets).index(target) for target in targets]
+
+    def predict_proba(self, X):
+        probs = self.model.predict_proba(X)
+        return [probs[position] for position in self.positions]
+
+
+class ScoringBundle:
+    """
+    Imputer + anomaly scorer + multi-target model + decision thresholds,
+    turning raw records into per-target probabilities and flags
+    """
+
+    def __init__(self, imputer, anomaly_scorer, model, targets, thresholds, feature_columns):
+        self.imputer = imputer
+        self.anomaly_scorer = anomaly_scorer
+        self.model = model
+        self.targets = list(targets)
+        self.thresholds = np.array([thresholds[target] for target in self.targets])
+        self.feature_columns = list(feature_columns)
+
+    @classmethod
+    def build(cls, raw, cohort, model, thresholds, n_neighbors=29, model_targets=None):
+        """
+        Assemble a bundle from the raw training records (output of
+        data_cleaning.load_and_basic_data_cleaning), the imputed cohort the model
+        was trained on (output of knn_imputation.py), the fitted model and
+        the per-target thresholds ({target: threshold})
+        model_targets: the target columns in the order the model was fitted on (the order
+        of its predict_proba outputs), by default the order of the target columns of the cohort;
+        the notebooks fit Biopsy first, so their models need it explicitly
+        """
+        if model_targets is None:
+            model_targets = [col for col in cohort.columns if col in targets]
+        model_targets = list(model_targets)
+
+        #the thresholds are matched by name, whatever the order of the dict
+        if sorted(thresholds) != sorted(model_targets):
+            raise ValueError(f"The thresholds are given for {sorted(thresholds)}, "
+                             f"the model predicts {model_targets}")
+        #a fitted search, or a Pipeline ending with the MultiOutputClassifier
+        fitted = getattr(model, 'best_estimator_', model)
+        fitted = fitted.steps[-1][1] if hasattr(fitted, 'steps') else fitted
+        n_outputs = len(getattr(fitted, 'estimators_', model_targets))
+        if n_outputs != len(model_targets):
+            raise ValueError(f"The model has {n_outputs} outputs, got {len(model_targets)} targets")
+
+        imputer = IncrementalKNNImputer(ClinicalPreprocessor().fit(raw), n_neighbors=n_neighbors).fit(cohort)
+        anomaly_scorer = AnomalyScorer().fit(imputer.donors_)
+        feature_columns = [col for col in cohort.columns if col not in targets]
+        return cls(imputer, anomaly_scorer, model, model_targets, thresholds, feature_columns)
+
+    def features(self, records):
+        """
+        Model features of raw records: imputed features in clinical units,
+        plus anomaly_label and anomaly_score
+        """
+        preprocessor = self.imputer.preprocessor
+        records = records.reindex(columns=preprocessor.input_columns_)
+
+        scaled = self.imputer.transform(records)
+        labels, scores = self.anomaly_scorer.score(scaled[:, self.imputer.feature_idx_])
+        clinical = preprocessor.inverse_transform(scaled, dtype=np.float64)
+
+        X = pd.DataFrame(clinical, columns=preprocessor.output_columns_)
+        X['anomaly_label'] = labels
+        X['anomaly_score'] = scores
+
+        return X[self.feature_columns]
+
+    def predict_proba(self, records):
+        #no record (an empty request or CSV chunk): the anomaly forest rejects empty arrays
+        if len(records) == 0:
+            return np.empty((0, len(self.targets)))
+        probs = self.model.predict_proba(self.features(records))
+        #MultiOutputClassifier returns one (n_samples, 2) array per target
+        return np.column_stack([prob[:, 1] for prob in probs])
+
+    def score(self, records):
+        probs = self.predict_proba(records)
+        flags = probs >= self.thresholds
+
+        out = pd.DataFrame(probs, columns=[f"{target}_probability" for target in self.targets])
+        for i, target in enumerate(self.targets):
+            out[f"{target}_flag"] = flags[:, i]
+        return out
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.imputer.save(os.path.join(path, 'imputer'))
+        self.anomaly_scorer.save(os.path.join(path, 'anomaly_scorer.joblib'))
+        save_model_bundle(self.model, os.path.join(path, 'model'), self.targets)
+
+        manifest = {'targets': self.targets, 'thresholds': dict(zip(self.targets, self.thresholds.tolist())),
+                    'feature_columns': self.feature_columns}
+        with open(os.path.join(path, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+    @classmethod
+    def load(cls, path, targets=None):
+        """
+        Load a bundle scoring the given targets only (all by default)
+        """
+        with open(os.path.join(path, 'manifest.json')) as f:
+            manifest = json.load(f)
+        targets = manifest['targets'] if targets is None else list(targets)
+
+        if os.path.isdir(os.path.join(path, 'model')):
+            model = load_model_bundle(os.path.join(path, 'model'), targets)
+        else:
+            #bundles saved before the model bundle format hold a pickled model of all the targets
+            model = _SelectedTargets(joblib.load(os.path.join(path, 'model.joblib')), manifest['targets'], targets)
+
+        return cls(IncrementalKNNImputer.load(os.path.join(path, 'imputer')),
+                   AnomalyScorer.load(os.path.join(path, 'anomaly_scorer.joblib')),
+                   model, targets, manifest['thresholds'], manifest['feature_columns'])
+
+
+class ServiceMetrics:
+    """
+    Request latency and throughput counters, with percentiles over the last `window` requests
+    """
+
+    def __init__(self, window=10_000):
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.n_requests = 0
+        self.n_records = 0
+        self.n_batches = 0
+        self.n_errors = 0
+
+    def record_request(self, latency, n_records):
+        with self.lock:
+            self.latencies.append(latency)
+            self.n_requests += 1
+            self.n_records += n_records
+
+    def record_batch(self, n_records):
+        with self.lock:
+            self.batch_sizes.append(n_records)
+            self.n_batches += 1
+
+    def record_error(self):
+        with self.lock:
+            self.n_errors += 1
+
+    def snapshot(self):
+        with self.lock:
+            uptime = time.perf_counter() - self.started
+            latencies = np.array(self.latencies) * 1000
+            snapshot = {'uptime_s': round(uptime, 3), 'requests': self.n_requests, 'records': self.n_records,
+                        'batches': self.n_batches, 'errors': self.n_errors,
+                        'records_per_s': round(self.n_records / uptime, 1) if uptime else 0.,
+                        'mean_batch_size': round(float(np.mean(self.batch_sizes)), 2) if self.batch_sizes else 0.}
+            if latencies.size:
+                p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+                snapshot.update({'latency_ms_p50': round(p50, 3), 'latency_ms_p95': round(p95, 3),
+                                 'latency_ms_p99': round(p99, 3), 'latency_ms_max': round(latencies.max(), 3)})
+            return snapshot
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent scoring requests: a worker thread waits for the first
+    pending request, collects more for at most max_wait_ms or until max_batch_size
+    records are pending, scores them all with one vectorized call and resolves
+    each request's future with its own rows; if the batch fails, its requests are
+    scored one by one, so that only the failing ones get the error
+    """
+
+    def __init__(self, bundle, metrics, max_batch_size=512, max_wait_ms=5):
+        self.bundle = bundle
+        self.metrics = metrics
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.pending = queue.Queue()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, records):
+        future = Future()
+        self.pending.put((records, future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self.pending.get()]
+            n_records = len(batch[0][0])
+            deadline = time.perf_counter() + self.max_wait
+
+            while n_records < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.pending.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(item)
+                n_records += len(item[0])
+
+            self._score(batch, n_records)
+
+    def _score(self, batch, n_records):
+        try:
+            scored = self.bundle.score(pd.concat([records for records, _ in batch], ignore_index=True))
+        except Exception as error:
+            if len(batch) == 1:
+                batch[0][1].set_exception(error)
+                return
+            #one malformed request must not fail the requests it was coalesced with
+            for item in batch:
+                self._score([item], len(item[0]))
+            return
+
+        self.metrics.record_batch(n_records)
+        start = 0
+        for records, future in batch:
+            future.set_result(scored.iloc[start:start + len(records)])
+            start += len(records)
+
+
+def make_handler(batcher, metrics):
+
+    class ScoringHandler(BaseHTTPRequestHandler):
+
+        def _reply(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                self._reply(200, metrics.snapshot())
+            else:
+                self._reply(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/score':
+                self._reply(404, {'error': 'not found'})
+                return
+
+            start = time.perf_counter()
+            try:
+                payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                records = pd.DataFrame.from_records(payload['records'])
+                scored = batcher.submit(records).result()
+            except Exception as error:
+                metrics.record_error()
+                self._reply(400, {'error': str(error)})
+                return
+
+            metrics.record_request(time.perf_counter() - start, len(records))
+            self._reply(200, {'predictions': scored.to_dict(orient='records')})
+
+        def log_message(self, format, *args):
+            #per-request logging would dominate the latency, /metrics reports on requests instead
+            pass
+
+    return ScoringHandler
+
+
+class ScoringServer(ThreadingHTTPServer):
+    #the default listen backlog (5) resets connections under bursts of concurrent clients
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+def make_server(bundle, host='127.0.0.1', port=8000, max_batch_size=512, max_wait_ms=5):
+    metrics = ServiceMetrics()
+    batcher = MicroBatcher(bundle, metrics, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+    return ScoringServer((host, port), make_handler(batcher, metrics))
+
+
+def score_file(bundle, input_path, output_path, chunksize=100_000):
+    """
+    Bulk scoring of a raw CSV export (same format as raw.csv), chunk by chunk
+    """
+    header = True
+    for chunk in pd.read_csv(input_path, na_values='?', chunksize=chunksize):
+        bundle.score(chunk).to_csv(output_path, mode='w' if header else 'a', header=header, index=False)
+        header = False
+
+
+def load_test(bundle, n_requests=2000, concurrency=32, records_per_request=1, raw_path=RAW_DATA_PATH):
+    """
+    Start the server on an ephemeral local port and fire concurrent requests at it,
+    with records sampled from raw.csv; returns the server metrics
+    """
+    server = make_server(bundle, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}/score'.format(server.server_address[1])
+
+    raw = pd.read_csv(raw_path, na_values='?')
+    rng = np.random.RandomState(0)
+
+    def send(_):
+        sample = raw.iloc[rng.randint(raw.shape[0], size=records_per_request)]
+        records = json.loads(sample.to_json(orient='records'))
+        request = urllib.request.Request(url, data=json.dumps({'records': records}).encode(),
+                                         headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status
+        except OSError:
+            return None
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        statuses = list(pool.map(send, range(n_requests)))
+    elapsed = time.perf_counter() - start
+
+    with urllib.request.urlopen(url.replace('/score', '/metrics')) as response:
+        metrics = json.loads(response.read())
+    server.shutdown()
+
+    metrics['client_wall_s'] = round(elapsed, 3)
+    metrics['client_requests_per_s'] = round(n_requests / elapsed, 1)
+    metrics['client_failures'] = sum(status != 200 for status in statuses)
+    return metrics
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve = subparsers.add_parser('serve', help='run the HTTP scoring server')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8000)
+
+    score = subparsers.add_parser('score', help='score a raw CSV export in bulk')
+    score.add_argument('input')
+    score.add_argument('output')
+
+    loadtest = subparsers.add_parser('loadtest', help='load-test a local server instance')
+    loadtest.add_argument('--requests', type=int, default=2000)
+    loadtest.add_argument('--concurrency', type=int, default=32)
+    loadtest.add_argument('--records-per-request', type=int, default=1)
+
+    for subparser in (serve, score, loadtest):
+        subparser.add_argument('--bundle', required=True)
+        subparser.add_argument('--targets', nargs='+', help='targets to score (all by default)')
+    for subparser in (serve, loadtest):
+        subparser.add_argument('--max-batch-size', type=int, default=512)
+        subparser.add_argument('--max-wait-ms', type=float, default=5)
+
+    args = parser.parse_args()
+    bundle = ScoringBundle.load(args.bundle, args.targets)
+
+    if args.command == 'serve':
+        server = make_server(bundle, args.host, args.port, args.max_batch_size, args.max_wait_ms)
+        print(f"Scoring service listening on http://{args.host}:{server.server_address[1]}")
+        server.serve_forever()
+    elif args.command == 'score':
+        score_file(bundle, args.input, args.output)
+        print(f"Predictions saved to {args.output}")
+    else:
+        print(json.dumps(load_test(bundle, args.requests, args.concurrency, args.records_per_request), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""Columnar binary format used to hand data over between the pipeline stages.
+
+A stored frame is a directory holding one ``.npy`` file per column (plus a
+``.mask.npy`` file for the pandas nullable columns, e.g. UInt8 and Float32)
+and a ``schema.json`` sidecar with the column names, dtypes and row count:
+
+    cleaned_data/
+    ├── schema.json
+    ├── col_000.npy
+    ├── col_001.npy
+    ├── col_001.mask.npy
+    └── ...
+
+Unlike a CSV round-trip, dtypes (nullable integers included) are preserved,
+single columns can be loaded on their own, and columns are memory-mapped on
+load instead of being parsed. CSV remains available through ``to_csv`` as an
+export format only.
+
+Missing masks and 0/1 flag columns (uint8 or boolean, see data_cleaning.RAW_SCHEMA)
+are bit-packed, one bit per row; they are unpacked on load, the other columns
+stay memory-mapped.
+"""
+
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+
+FORMAT_VERSION = 2
+#version 1 directories (masks stored unpacked, no packed flags) are still read
+SUPPORTED_VERSIONS = (1, 2)
+SCHEMA_FILE = 'schema.json'
+
+
+def _column_file(position):
+    #column names contain characters such as "/" and ":", so files are named by position
+    return 'col_{:03d}.npy'.format(position)
+
+
+def _mask_file(position):
+    return 'col_{:03d}.mask.npy'.format(position)
+
+
+def _is_flag(values):
+    return bool(values.dtype in (np.uint8, np.bool_) and (values.size == 0 or values.max() <= 1))
+
+
+def write_columnar(df, path):
+    """Store ``df`` as a columnar directory at ``path``, replacing any previous one.
+    Only numeric, boolean and pandas nullable (masked) columns are supported.
+    The directory is written next to ``path`` (``<path>.tmp``) and swapped in once
+    complete, so no column file of a previous, wider frame is left behind and no
+    half-written directory is ever at ``path``. The swap is two renames, not an
+    atomic one: a reader running at the same time may briefly find no directory,
+    and a crash in between leaves the previous frame in ``<path>.old`` (cleared by
+    the next write).
+    """
+    path = os.path.normpath(path)
+    final_path, path = path, path + '.tmp'
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+    columns = []
+    for position, (name, series) in enumerate(df.items()):
+        dtype = series.dtype
+
+        if isinstance(series.array, pd.arrays.IntegerArray) or \
+                isinstance(series.array, pd.arrays.FloatingArray) or \
+                isinstance(series.array, pd.arrays.BooleanArray):
+            mask = series.isna().to_numpy()
+            values = series.to_numpy(dtype=dtype.numpy_dtype, na_value=0 if dtype.kind != 'b' else False)
+            np.save(os.path.join(path, _mask_file(position)), np.packbits(mask))
+            masked = True
+        elif isinstance(dtype, np.dtype) and dtype.kind in 'biuf':
+            values = series.to_numpy()
+            masked = False
+        else:
+            raise TypeError('Column {!r} has unsupported dtype {}.'.format(name, dtype))
+
+        packed = _is_flag(values)
+        if packed:
+            values = np.packbits(values.astype(bool))
+        np.save(os.path.join(path, _column_file(position)), np.ascontiguousarray(values))
+        columns.append({'name': name, 'dtype': str(dtype), 'masked': masked, 'packed': packed})
+
+    schema = {'format_version': FORMAT_VERSION, 'n_rows': int(df.shape[0]), 'columns': columns}
+    with open(os.path.join(path, SCHEMA_FILE), 'w') as f:
+        json.dump(schema, f, indent=2)
+
+    #a directory cannot be replaced by a rename, so the previous one is moved aside first
+    #(into a place freed from what an interrupted write may have left there)
+    shutil.rmtree(final_path + '.old', ignore_errors=True)
+    if os.path.exists(final_path):
+        os.replace(final_path, final_path + '.old')
+    os.replace(path, final_path)
+    shutil.rmtree(final_path + '.old', ignore_errors=True)
+
+
+def read_schema(path):
+    with open(os.path.join(path, SCHEMA_FILE)) as f:
+        schema = json.load(f)
+
+    if schema['format_version'] not in SUPPORTED_VERSIONS:
+        raise ValueError('Unsupported columnar format version {}.'.format(schema['format_version']))
+
+    return schema
+
+
+def read_columnar(path, columns=None, mmap=True):
+    """Load a columnar directory written by ``write_columnar``.
+    columns: optional list of column names to load (column projection)
+    mmap: if True, columns are memory-mapped copy-on-write, so no data is
+    read until it is accessed and frames can be modified without touching
+    the stored files.
+    """
+    schema = read_schema(path)
+    positions = {column['name']: position for position, column in enumerate(schema['columns'])}
+
+    if columns is None:
+        columns = list(positions)
+    missing = [name for name in columns if name not in positions]
+    if missing:
+        raise KeyError('Columns {} are not stored in {}.'.format(missing, path))
+
+    mmap_mode = 'c' if mmap else None
+    packed_masks = schema['format_version'] >= 2
+    n_rows = schema['n_rows']
+    data = {}
+    for name in columns:
+        position = positions[name]
+        column = schema['columns'][position]
+        values = np.load(os.path.join(path, _column_file(position)), mmap_mode=mmap_mode)
+        if column.get('packed', False):
+            dtype = pd.api.types.pandas_dtype(column['dtype'])
+            values = np.unpackbits(values, count=n_rows).astype(getattr(dtype, 'numpy_dtype', dtype), copy=False)
+
+        if column['masked']:
+            mask = np.load(os.path.join(path, _mask_file(position)), mmap_mode=mmap_mode)
+            if packed_masks:
+                mask = np.unpackbits(mask, count=n_rows).view(bool)
+            array_type = pd.api.types.pandas_dtype(column['dtype']).construct_array_type()
+            data[name] = array_type(values, mask, copy=False)
+        else:
+            data[name] = values
+
+    return pd.DataFrame(data, columns=columns, copy=False)
+
+
+def to_csv(path, csv_path):
+    """Export a columnar directory as CSV."""
+    read_columnar(path).to_csv(csv_path, index=False)
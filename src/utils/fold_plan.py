@@ -0,0 +1,212 @@
+"""This file includes a precomputed, cached representation of the splits
+produced by the multilabel cross validators in ml_stratifiers.py.
+
+Every call to ``split`` on those cross validators re-runs the Iterative
+Stratification algorithm for every repeat/split. A FoldPlan computes all of
+them once (in parallel, with one seeded random generator per repeat), keeps
+only the compact test-fold vectors, and can be reused as the ``cv`` argument
+of any scikit-learn search or cross-validation helper.
+"""
+
+import hashlib
+
+import numpy as np
+import scipy.sparse as sp
+from joblib import Parallel, delayed
+
+from sklearn.utils import check_random_state
+from sklearn.utils.validation import _num_samples, check_array
+from sklearn.model_selection._split import _validate_shuffle_split
+
+from .ml_stratifiers import IterativeStratification, MultilabelStratifiedKFold, \
+    RepeatedMultilabelStratifiedKFold, MultilabelStratifiedShuffleSplit
+
+
+#in-process memo of the plans computed so far, keyed by FoldPlan.make_key
+_PLAN_CACHE = {}
+
+
+def _kfold_test_folds(y, n_splits, shuffle, random_state):
+    #a single (seeded) run of MultilabelStratifiedKFold
+    cv = MultilabelStratifiedKFold(n_splits=n_splits, shuffle=shuffle, random_state=random_state)
+    return cv._make_test_folds(None, y)
+
+
+def _shuffle_split_test_folds(y, n_train, n_test, random_state):
+    #a single (seeded) split of MultilabelStratifiedShuffleSplit, 1 marks the test samples
+    rng = check_random_state(random_state)
+    indices = np.arange(y.shape[0])
+    rng.shuffle(indices)
+
+    r = np.array([n_train, n_test]) / (n_train + n_test)
+    test_folds = IterativeStratification(labels=y[indices], r=r, random_state=rng)
+
+    return test_folds[np.argsort(indices)]
+
+
+def _as_bool_labels(y):
+    #sparse label matrices are kept sparse (canonical CSR), dense ones become bool arrays
+    if sp.issparse(y):
+        y = sp.csr_matrix(y, dtype=bool)
+        y.eliminate_zeros()
+        y.sort_indices()
+        return y
+    return np.asarray(y, dtype=bool)
+
+
+def _compact_dtype(n_folds):
+    return np.int8 if n_folds <= np.iinfo(np.int8).max else np.int16
+
+
+class FoldPlan:
+    """Precomputed multilabel stratified splits.
+
+    Parameters
+    ----------
+    test_folds : ndarray, shape (n_repeats, n_samples)
+        For every repeat, the fold each sample is tested in.
+    n_folds : int
+        Number of folds of every repeat. A plan built from a
+        MultilabelStratifiedShuffleSplit has two folds per repeat (0 for
+        train, 1 for test) and yields a single split per repeat.
+    kind : {'kfold', 'shuffle_split'}
+        Cross validator the plan was built from.
+    key : str or None
+        Cache key of the plan, see ``FoldPlan.make_key``.
+
+    Notes
+    -----
+    A plan built from a plain MultilabelStratifiedKFold yields exactly the
+    splits of that cross validator. Repeated k-fold and shuffle-split plans
+    seed every repeat independently (so that repeats can be computed in
+    parallel) and therefore differ from the splits the cross validators
+    yield when iterated serially with one shared random generator.
+    """
+
+    def __init__(self, test_folds, n_folds, kind, key=None):
+        if kind not in ('kfold', 'shuffle_split'):
+            raise ValueError('Supported plan kinds are kfold and shuffle_split. Got {!r} instead.'.format(kind))
+
+        self.test_folds = np.asarray(test_folds, dtype=_compact_dtype(n_folds))
+        self.n_folds = int(n_folds)
+        self.kind = kind
+        self.key = key
+
+    @property
+    def n_repeats(self):
+        return self.test_folds.shape[0]
+
+    @property
+    def n_samples(self):
+        return self.test_folds.shape[1]
+
+    @staticmethod
+    def make_key(cv, y):
+        """Hash of the label matrix and of the cross validator parameters.
+        Returns None when the cross validator is not seeded with an int,
+        since its splits are not reproducible then.
+        """
+        if not isinstance(cv.random_state, (int, np.integer)):
+            return None
+
+        y = _as_bool_labels(y)
+        params = {key: value for key, value in vars(cv).items() if key != 'cv'}
+        if isinstance(cv, RepeatedMultilabelStratifiedKFold):
+            params['splitter'] = cv.cv.__name__
+
+        digest = hashlib.sha1()
+        digest.update(type(cv).__name__.encode())
+        digest.update(repr(sorted(params.items(), key=lambda item: item[0])).encode())
+        digest.update(repr(y.shape).encode())
+        if sp.issparse(y):
+            digest.update(y.indptr.tobytes())
+            digest.update(y.indices.tobytes())
+        else:
+            digest.update(np.ascontiguousarray(y).tobytes())
+
+        return digest.hexdigest()
+
+    @classmethod
+    def from_splitter(cls, cv, y, n_jobs=None):
+        """Compute the plan of one of the cross validators in ml_stratifiers.py.
+        Repeats are computed in a process pool of ``n_jobs`` workers, each with
+        its own seed drawn from the random state of ``cv``.
+        """
+        y = _as_bool_labels(check_array(y, accept_sparse=('csr', 'csc'), ensure_2d=False, dtype=None))
+        key = cls.make_key(cv, y)
+
+        if isinstance(cv, MultilabelStratifiedKFold):
+            test_folds = [_kfold_test_folds(y, cv.n_splits, cv.shuffle, cv.random_state)]
+            return cls(test_folds, cv.n_splits, 'kfold', key=key)
+
+        rng = check_random_state(cv.random_state)
+
+        if isinstance(cv, RepeatedMultilabelStratifiedKFold):
+            n_splits = cv.cvargs['n_splits']
+            seeds = rng.randint(np.iinfo(np.int32).max, size=cv.n_repeats)
+            test_folds = Parallel(n_jobs=n_jobs)(
+                delayed(_kfold_test_folds)(y, n_splits, True, seed) for seed in seeds)
+            return cls(test_folds, n_splits, 'kfold', key=key)
+
+        if isinstance(cv, MultilabelStratifiedShuffleSplit):
+            n_train, n_test = _validate_shuffle_split(y.shape[0], cv.test_size, cv.train_size)
+            seeds = rng.randint(np.iinfo(np.int32).max, size=cv.n_splits)
+            test_folds = Parallel(n_jobs=n_jobs)(
+                delayed(_shuffle_split_test_folds)(y, n_train, n_test, seed) for seed in seeds)
+            return cls(test_folds, 2, 'shuffle_split', key=key)
+
+        raise ValueError('Supported cross validators are MultilabelStratifiedKFold, '
+                         'RepeatedMultilabelStratifiedKFold and MultilabelStratifiedShuffleSplit. '
+                         'Got {!r} instead.'.format(type(cv).__name__))
+
+    def get_n_splits(self, X=None, y=None, groups=None):
+        if self.kind == 'shuffle_split':
+            return self.n_repeats
+        return self.n_repeats * self.n_folds
+
+    def split(self, X, y=None, groups=None):
+        """Generate the train/test indices of the plan, with the same
+        signature as the cross validators it replaces.
+        """
+        n_samples = _num_samples(X)
+        if n_samples != self.n_samples:
+            raise ValueError('The plan was computed for {} samples, got {} instead.'.format(
+                self.n_samples, n_samples))
+
+        test_fold_ids = [1] if self.kind == 'shuffle_split' else range(self.n_folds)
+
+        for test_folds in self.test_folds:
+            for fold_idx in test_fold_ids:
+                test_idx = test_folds == fold_idx
+                yield np.where(~test_idx)[0], np.where(test_idx)[0]
+
+    def save(self, path):
+        np.savez_compressed(path, test_folds=self.test_folds, n_folds=self.n_folds,
+                            kind=self.kind, key='' if self.key is None else self.key)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as stored:
+            key = str(stored['key'])
+            return cls(stored['test_folds'], int(stored['n_folds']), str(stored['kind']),
+                       key=key or None)
+
+    def __repr__(self):
+        return '{}(kind={!r}, n_repeats={}, n_folds={}, n_samples={})'.format(
+            type(self).__name__, self.kind, self.n_repeats, self.n_folds, self.n_samples)
+
+
+def get_fold_plan(cv, y, n_jobs=None):
+    """Return the FoldPlan of ``cv`` on ``y``, memoized in-process so the same
+    splits are reused across model families at no cost.
+    e.g. plan = get_fold_plan(msss, y, n_jobs=-1); for train, test in plan.split(X, y): ...
+    """
+    key = FoldPlan.make_key(cv, y)
+    if key is not None and key in _PLAN_CACHE:
+        return _PLAN_CACHE[key]
+
+    plan = FoldPlan.from_splitter(cv, y, n_jobs=n_jobs)
+    if key is not None:
+        _PLAN_CACHE[key] = plan
+
+    return plan
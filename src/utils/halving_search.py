@@ -0,0 +1,208 @@
+"""This file includes a budget-aware hyperparameter search for the multi-target
+models, a drop-in replacement of RandomizedSearchCV in the nested loops of the
+modeling notebooks.
+
+The candidates are evaluated by successive halving on MultilabelStratifiedKFold
+inner folds: every rung evaluates the surviving candidates with factor times more
+resources (inner folds, training rows or a parameter such as n_estimators) and only
+the best 1/factor of them are promoted, so bad candidates are cut after a cheap
+evaluation. With warm_start, the best configurations of the previous fit (i.e. of
+the previous outer fold) skip the first rung of the next one.
+"""
+
+import math
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+
+from sklearn.base import BaseEstimator, clone
+from sklearn.metrics import check_scoring
+from sklearn.model_selection import ParameterSampler
+from sklearn.utils import check_random_state, _safe_indexing
+from sklearn.utils.validation import _num_samples
+
+from .fold_plan import get_fold_plan
+from .ml_stratifiers import MultilabelStratifiedKFold
+
+
+#smallest training subsample of the 'n_samples' resource: smaller ones lose the positives of the rare targets
+MIN_SAMPLES = 100
+
+
+def _fit_and_score(estimator, params, X, y, train, test, scorer):
+    model = clone(estimator).set_params(**params)
+    try:
+        model.fit(_safe_indexing(X, train), _safe_indexing(y, train))
+    except ValueError:
+        #e.g. a subsample without positives for a target: the candidate scores nan, as with error_score=np.nan
+        return np.nan
+    return scorer(model, _safe_indexing(X, test), _safe_indexing(y, test))
+
+
+class MultilabelHalvingSearchCV(BaseEstimator):
+    """Successive halving search over multilabel stratified inner folds.
+
+    Parameters
+    ----------
+    estimator : multi-output estimator (e.g. MultiOutputClassifier, or a Pipeline ending with one)
+
+    param_distributions : dict, as in RandomizedSearchCV
+
+    n_candidates : int, default=30
+        Number of candidates of the first rung (the n_iter of RandomizedSearchCV).
+
+    resource : str, default='folds'
+        'folds' (number of inner folds evaluated, scores of the previous rungs are reused),
+        'n_samples' (size of the training subsample of every inner fold), or the name of
+        an estimator parameter, e.g. 'estimator__n_estimators'.
+
+    min_resources, max_resources : int, default=None
+        Resources of the first and last rung. By default the last rung uses n_splits folds,
+        the whole inner training folds, or the parameter value set on the estimator, and the
+        first rung is factor times smaller for each rung the number of candidates allows.
+
+    factor : int, default=3
+        Resource growth and candidate reduction factor between rungs.
+
+    n_splits : int, default=3
+        Number of MultilabelStratifiedKFold inner folds.
+
+    scoring : str or callable, default='average_precision'
+
+    warm_start : bool, default=True
+        Carry the best configurations of the previous fit straight into the second rung.
+
+    n_jobs : int, default=None
+        Number of jobs of the fits of a rung.
+
+    random_state : int, RandomState instance or None, default=None
+    """
+
+    def __init__(self, estimator, param_distributions, n_candidates=30, resource='folds', min_resources=None,
+                 max_resources=None, factor=3, n_splits=3, scoring='average_precision', warm_start=True,
+                 refit=True, n_jobs=None, random_state=None, verbose=0):
+        self.estimator = estimator
+        self.param_distributions = param_distributions
+        self.n_candidates = n_candidates
+        self.resource = resource
+        self.min_resources = min_resources
+        self.max_resources = max_resources
+        self.factor = factor
+        self.n_splits = n_splits
+        self.scoring = scoring
+        self.warm_start = warm_start
+        self.refit = refit
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+        self.verbose = verbose
+
+    def _resources(self, folds):
+        """Resource of every rung: geometric growth from min_resources, ending at max_resources."""
+        if self.resource == 'folds':
+            max_resources = self.max_resources or self.n_splits
+        elif self.resource == 'n_samples':
+            max_resources = self.max_resources or min(train.shape[0] for train, _ in folds)
+        elif self.resource in self.estimator.get_params():
+            max_resources = self.max_resources or self.estimator.get_params()[self.resource]
+        else:
+            raise ValueError(f"resource must be 'folds', 'n_samples' or an estimator parameter, "
+                             f"got {self.resource!r}")
+
+        n_rungs = 1 + int(math.log(self.n_candidates, self.factor) + 1e-9)
+        min_resources = self.min_resources
+        if min_resources is None:
+            min_resources = max(max_resources // self.factor ** (n_rungs - 1), 1)
+            if self.resource == 'n_samples':
+                min_resources = min(max(min_resources, MIN_SAMPLES), max_resources)
+        if min_resources > max_resources:
+            raise ValueError(f"min_resources ({min_resources}) exceeds max_resources ({max_resources})")
+
+        n_rungs = min(n_rungs, 1 + int(math.log(max_resources / min_resources, self.factor) + 1e-9))
+        return [min_resources * self.factor ** i for i in range(n_rungs - 1)] + [max_resources]
+
+    def _evaluate(self, X, y, folds, candidates, active, resource, scorer, fold_scores, subsamples):
+        """Mean inner score of the active candidates at the given resource."""
+        if self.resource == 'folds':
+            jobs = [(c, f, folds[f][0]) for c in active for f in range(resource) if (c, f) not in fold_scores]
+            params = {c: candidates[c] for c in active}
+        elif self.resource == 'n_samples':
+            jobs = [(c, f, subsamples[f][:resource]) for c in active for f in range(len(folds))]
+            params = {c: candidates[c] for c in active}
+        else:
+            jobs = [(c, f, folds[f][0]) for c in active for f in range(len(folds))]
+            params = {c: dict(candidates[c], **{self.resource: resource}) for c in active}
+
+        scores = Parallel(n_jobs=self.n_jobs)(
+            delayed(_fit_and_score)(self.estimator, params[c], X, y, train, folds[f][1], scorer)
+            for c, f, train in jobs)
+        self.n_fits_ += len(jobs)
+
+        if self.resource != 'folds':
+            fold_scores.clear()
+        for (c, f, _), score in zip(jobs, scores):
+            fold_scores[c, f] = score
+
+        n_folds = resource if self.resource == 'folds' else len(folds)
+        return np.array([np.mean([fold_scores[c, f] for f in range(n_folds)]) for c in active])
+
+    def fit(self, X, y):
+        n_samples = _num_samples(X)
+        rng = check_random_state(self.random_state)
+
+        cv = MultilabelStratifiedKFold(n_splits=self.n_splits, shuffle=True, random_state=rng.randint(2 ** 31 - 1))
+        folds = list(get_fold_plan(cv, np.asarray(y)).split(np.zeros(n_samples), y))
+        subsamples = [rng.permutation(train) for train, _ in folds]
+        resources = self._resources(folds)
+        scorer = check_scoring(self.estimator, scoring=self.scoring)
+
+        #the carried configurations of the previous fit join at the second rung
+        carried = list(getattr(self, 'promising_', [])) if self.warm_start and len(resources) > 1 else []
+        fresh = [params for params in ParameterSampler(self.param_distributions, self.n_candidates, random_state=rng)
+                 if params not in carried]
+        candidates = fresh + carried
+        carried_idx = list(range(len(fresh), len(candidates)))
+
+        self.n_fits_ = 0
+        fold_scores, rows = {}, []
+        active = list(range(len(fresh))) if carried else list(range(len(candidates)))
+
+        for i, resource in enumerate(resources):
+            if self.verbose:
+                print(f"rung {i}: {len(active)} candidates, {self.resource}={resource}")
+            scores = self._evaluate(X, y, folds, candidates, active, resource, scorer, fold_scores, subsamples)
+            rows += [{'iter': i, 'n_resources': resource, 'candidate': c, 'params': candidates[c],
+                      'mean_test_score': score} for c, score in zip(active, scores)]
+
+            #nan scores (failed fits) rank last, ties keep the sampling order
+            order = np.argsort(-np.where(np.isnan(scores), -np.inf, scores), kind='stable')
+            ranked = [active[j] for j in order]
+            if i == len(resources) - 1:
+                break
+
+            n_next = math.ceil(self.n_candidates / self.factor ** (i + 1))
+            if i == 0 and carried:
+                active = ranked[:max(n_next - len(carried), 0)] + carried_idx
+            else:
+                active = ranked[:n_next]
+
+        self.cv_results_ = pd.DataFrame(rows)
+        self.n_resources_ = resources
+        self.best_index_ = ranked[0]
+        self.best_params_ = candidates[self.best_index_]
+        self.best_score_ = scores[order[0]]
+        self.promising_ = [candidates[c] for c in ranked[:max(math.ceil(len(ranked) / self.factor), 1)]]
+
+        if self.refit:
+            params = dict(self.best_params_)
+            if self.resource not in ('folds', 'n_samples'):
+                params[self.resource] = resources[-1]
+            self.best_estimator_ = clone(self.estimator).set_params(**params).fit(X, y)
+
+        return self
+
+    def predict(self, X):
+        return self.best_estimator_.predict(X)
+
+    def predict_proba(self, X):
+        return self.best_estimator_.predict_proba(X)
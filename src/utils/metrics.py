@@ -0,0 +1,161 @@
+"""This file includes the evaluation of the multi-target models on the outer folds,
+in place of the per-fold classification_report dictionaries of the modeling notebooks.
+
+MultilabelMetrics collects the test labels, binary predictions and probabilities of
+every (model, outer fold). Precision, recall and F1 (zero_division=0) come from
+per-target confusion counts, average precision from one sort of every target column,
+and the fold means and macro averages from array reductions. Bootstrap confidence
+intervals resample every test fold B times at once: each resample is a row of
+multinomial weights, so the confusion counts of all resamples are one matrix product
+and the average precision of all resamples one weighted cumulative sum.
+"""
+
+import numpy as np
+import pandas as pd
+
+from .thresholds import TARGETS
+
+
+METRICS = ['precision', 'recall', 'f1-score', 'average_precision']
+
+
+def _divide(numerator, denominator):
+    #zero_division=0, as in the classification_report calls of the notebooks
+    return np.divide(numerator, denominator, out=np.zeros(np.broadcast(numerator, denominator).shape),
+                     where=denominator != 0)
+
+
+def _weighted_scores(y_true, y_pred, y_prob, weights):
+    """Precision, recall, F1 and average precision of every target, for every row of
+    sample weights (n_resamples, n_samples); returns an array (n_resamples, 4, n_targets)
+    """
+    y_true = y_true.astype(bool)
+    tp = weights @ (y_true & y_pred).astype(np.float64)
+    predicted = weights @ y_pred.astype(np.float64)
+    actual = weights @ y_true.astype(np.float64)
+
+    precision = _divide(tp, predicted)
+    recall = _divide(tp, actual)
+    f1 = _divide(2 * tp, predicted + actual)
+
+    if y_prob is None:
+        ap = np.full_like(tp, np.nan)
+    else:
+        #descending scores; every sample takes the precision at the end of its group of tied scores
+        order = np.argsort(-y_prob, axis=0, kind='stable')
+        scores = np.take_along_axis(y_prob, order, axis=0)
+        positives = np.take_along_axis(y_true, order, axis=0)
+
+        n_samples = scores.shape[0]
+        group_end = np.where(np.vstack([scores[:-1] != scores[1:], np.ones((1, scores.shape[1]), bool)]),
+                             np.arange(n_samples)[:, np.newaxis], n_samples)
+        group_end = np.minimum.accumulate(group_end[::-1], axis=0)[::-1]
+
+        sorted_weights = weights[:, order]
+        cum_tp = np.cumsum(sorted_weights * positives, axis=1)
+        cum_predicted = np.cumsum(sorted_weights, axis=1)
+        columns = np.arange(scores.shape[1])
+        group_precision = _divide(cum_tp[:, group_end, columns], cum_predicted[:, group_end, columns])
+
+        ap = _divide((sorted_weights * positives * group_precision).sum(axis=1), actual)
+
+    return np.stack([precision, recall, f1, ap], axis=1)
+
+
+class MultilabelMetrics:
+    """Per-target metrics of several models over the same outer folds.
+
+    e.g.
+        metrics = MultilabelMetrics()
+        for train_index, test_index in msss.split(X, y):
+            ...
+            metrics.add('XGBoost', y_test, y_pred, prob_matrix)
+        metrics.report(n_bootstrap=2000)   # tidy frame: model, target, metric, value, std, ci_low, ci_high
+        metrics.table('XGBoost')           # targets x metrics, like the notebooks' final results
+    """
+
+    def __init__(self, targets=TARGETS):
+        self.targets = list(targets)
+        self.folds = {}
+
+    def add(self, model, y_true, y_pred, y_prob=None):
+        """Record one outer fold of a model (folds are numbered in the order they are added)"""
+        y_true, y_pred = np.asarray(y_true), np.asarray(y_pred).astype(bool)
+        if y_true.shape != y_pred.shape or y_true.shape[1] != len(self.targets):
+            raise ValueError(f"y_true and y_pred must have shape (n_samples, {len(self.targets)})")
+        if y_prob is not None:
+            y_prob = np.asarray(y_prob, dtype=np.float64)
+            if y_prob.shape != y_true.shape:
+                raise ValueError("y_prob must have the shape of y_true")
+
+        self.folds.setdefault(model, []).append((y_true, y_pred, y_prob))
+        return self
+
+    @property
+    def models(self):
+        return list(self.folds)
+
+    def confusion_counts(self):
+        """Array (n_models, n_folds, 4, n_targets) of tp, fp, fn, tn"""
+        counts = []
+        for model in self.models:
+            model_counts = []
+            for y_true, y_pred, _ in self.folds[model]:
+                t, p = y_true.astype(bool), y_pred
+                model_counts.append(np.stack([(t & p).sum(0), (~t & p).sum(0), (t & ~p).sum(0), (~t & ~p).sum(0)]))
+            counts.append(model_counts)
+        return np.array(counts)
+
+    def _scores(self, model, weights=None):
+        """Array (n_resamples, n_folds, 4, n_targets) of the model scores; weights is a list
+        with the resampling weights of every fold, None for the plain scores
+        """
+        scores = []
+        for f, (y_true, y_pred, y_prob) in enumerate(self.folds[model]):
+            fold_weights = np.ones((1, y_true.shape[0])) if weights is None else weights[f]
+            scores.append(_weighted_scores(y_true, y_pred, y_prob, fold_weights))
+        return np.stack(scores, axis=1)
+
+    def report(self, n_bootstrap=0, confidence=0.95, random_state=0):
+        """Tidy frame of the fold-mean metrics (and standard deviation across folds) of every
+        model, target and macro average; with n_bootstrap > 0, percentile confidence intervals
+        from n_bootstrap resamples of every test fold (shared by the models, so they are paired)
+        """
+        rng = np.random.default_rng(random_state)
+        resamples = {}
+        alpha = (1 - confidence) / 2
+
+        rows = []
+        for model in self.models:
+            scores = self._scores(model)[0]
+            scores = np.concatenate([scores, scores.mean(axis=2, keepdims=True)], axis=2)
+            value, std = scores.mean(axis=0), scores.std(axis=0)
+
+            if n_bootstrap:
+                weights = []
+                for fold, (y_true, _, _) in enumerate(self.folds[model]):
+                    n = y_true.shape[0]
+                    if (fold, n) not in resamples:
+                        resamples[fold, n] = rng.multinomial(n, np.full(n, 1 / n),
+                                                             size=n_bootstrap).astype(np.float64)
+                    weights.append(resamples[fold, n])
+
+                boot = self._scores(model, weights).mean(axis=1)
+                boot = np.concatenate([boot, boot.mean(axis=2, keepdims=True)], axis=2)
+                low, high = np.quantile(boot, [alpha, 1 - alpha], axis=0)
+
+            for m, metric in enumerate(METRICS):
+                for t, target in enumerate(self.targets + ['macro avg']):
+                    row = {'model': model, 'target': target, 'metric': metric,
+                           'value': value[m, t], 'std': std[m, t]}
+                    if n_bootstrap:
+                        row.update({'ci_low': low[m, t], 'ci_high': high[m, t]})
+                    rows.append(row)
+
+        return pd.DataFrame(rows)
+
+    def table(self, model, report=None):
+        """targets x metrics frame of a model, the layout of the notebooks' final results"""
+        report = self.report() if report is None else report
+        table = report[report['model'] == model].pivot(index='target', columns='metric', values='value')
+        return table.loc[self.targets + ['macro avg'], METRICS]
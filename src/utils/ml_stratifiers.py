@@ -20,6 +20,7 @@ Attribution to authors of scikit-learn/model_selection/_split.py under BSD 3 cla
 # License: BSD 3 clause
 
 import numpy as np
+import scipy.sparse as sp
 
 from sklearn.utils import check_random_state
 from sklearn.utils.validation import _num_samples, check_array
@@ -28,7 +29,126 @@ from sklearn.utils.multiclass import type_of_target
 from sklearn.model_selection._split import _BaseKFold, _RepeatedSplits, \
     BaseShuffleSplit, _validate_shuffle_split
 
+from .telemetry import instrument
 
+
+def _decrement_path(start_values, n_decrements, length):
+    """Return, for every fold, the values taken by ``start_values`` after
+    ``n_decrements + j`` successive unit decrements, for j in [0, length).
+
+    The demands in the Iterative Stratification algorithm are floats that are
+    decremented by one at a time, and once a demand drops below one the
+    repeated subtractions round differently from a single ``x - j``. Values
+    are therefore exact subtractions while they stay above zero, and the
+    remaining steps are replayed with a cumulative sum, which performs the
+    very same sequence of floating point operations as the original loop.
+    """
+    start_values = start_values[:, np.newaxis]
+    steps = n_decrements[:, np.newaxis] + np.arange(length)
+
+    exact_steps = np.floor(start_values)
+    values = start_values - steps
+
+    extra_steps = steps - exact_steps
+    inexact = extra_steps > 0
+    if np.any(inexact):
+        extra_steps = extra_steps.astype(np.int64)
+        trail = np.full((start_values.shape[0], extra_steps[inexact].max() + 1), -1.)
+        trail[:, 0] = (start_values - exact_steps)[:, 0]
+        np.cumsum(trail, axis=1, out=trail)
+
+        fold_idxs = np.nonzero(inexact)[0]
+        values[inexact] = trail[fold_idxs, extra_steps[inexact]]
+
+    return values
+
+
+def _merge_fold_demands(primary, secondary, n_picks, random_state):
+    """Replay ``n_picks`` greedy fold choices in a single vectorized step.
+
+    ``primary`` and ``secondary`` hold, for every fold, its demand trajectory
+    (as returned by ``_decrement_path``). Each pick takes the fold with the
+    largest (primary, secondary) demand and decrements both, so the sequence
+    of picks is a k-way merge of the per-fold trajectories: the trajectories
+    act as one priority queue that is drained with a single sort. Folds with
+    equal demands form tie groups, which are resolved with the same random
+    draws, in the same order, as the sample-by-sample loop.
+    """
+    n_folds = primary.shape[0]
+    fold_ids = np.repeat(np.arange(n_folds), primary.shape[1])
+    primary = primary.ravel()
+    secondary = secondary.ravel()
+
+    order = np.lexsort((fold_ids, -secondary, -primary))
+    primary = primary[order]
+    secondary = secondary[order]
+    fold_ids = fold_ids[order]
+
+    new_group = np.ones(order.shape[0], dtype=bool)
+    new_group[1:] = (primary[1:] != primary[:-1]) | (secondary[1:] != secondary[:-1])
+    group_starts = np.flatnonzero(new_group)
+    group_sizes = np.diff(np.append(group_starts, order.shape[0]))
+
+    keep = group_starts < n_picks
+    group_starts = group_starts[keep]
+    group_sizes = group_sizes[keep]
+    group_picks = np.minimum(group_sizes, n_picks - group_starts)
+
+    fold_seq = fold_ids[:n_picks].copy()
+
+    # A tie group of size g that is fully consumed needs g - 1 draws (the
+    # last remaining fold is taken without drawing), a partially consumed
+    # one needs a draw for each of its picks
+    group_draws = np.minimum(group_picks, group_sizes - 1)
+    tied = group_draws > 0
+    if not np.any(tied):
+        return fold_seq
+
+    group_starts = group_starts[tied]
+    group_sizes = group_sizes[tied]
+    group_picks = group_picks[tied]
+    group_draws = group_draws[tied]
+
+    draw_offsets = np.cumsum(group_draws) - group_draws
+    draw_sizes = np.repeat(group_sizes, group_draws) - \
+        (np.arange(group_draws.sum()) - np.repeat(draw_offsets, group_draws))
+    draws = random_state.randint(0, draw_sizes)
+
+    for size, picks in set(zip(group_sizes.tolist(), group_picks.tolist())):
+        selected = (group_sizes == size) & (group_picks == picks)
+        n_draws = min(picks, size - 1)
+        rows = np.arange(selected.sum())
+
+        members = fold_ids[group_starts[selected, np.newaxis] + np.arange(size)]
+        group_draw_idxs = draws[draw_offsets[selected, np.newaxis] + np.arange(n_draws)]
+        picked = np.empty((rows.shape[0], picks), dtype=fold_ids.dtype)
+
+        for step in range(n_draws):
+            picked[:, step] = members[rows, group_draw_idxs[:, step]]
+            remaining = np.ones(members.shape, dtype=bool)
+            remaining[rows, group_draw_idxs[:, step]] = False
+            members = members[remaining].reshape(rows.shape[0], -1)
+
+        if picks > n_draws:
+            picked[:, -1] = members[:, 0]
+
+        fold_seq[group_starts[selected, np.newaxis] + np.arange(picks)] = picked
+
+    return fold_seq
+
+
+def _count_labels_per_fold(sample_labels, fold_seq, n_folds):
+    """Number of examples of each label assigned to each fold."""
+    if sp.issparse(sample_labels):
+        n_picks = fold_seq.shape[0]
+        fold_indicator = sp.csr_matrix((np.ones(n_picks, dtype=np.int64), (fold_seq, np.arange(n_picks))),
+                                       shape=(n_folds, n_picks))
+        return (fold_indicator @ sample_labels.astype(np.int64)).toarray()
+
+    return np.stack([sample_labels[fold_seq == fold_idx].sum(axis=0) for fold_idx in range(n_folds)])
+
+
+@instrument
 def IterativeStratification(labels, r, random_state):
     """This function implements the Iterative Stratification algorithm described
     in the following paper:
@@ -37,77 +157,89 @@ def IterativeStratification(labels, r, random_state):
     (eds) Machine Learning and Knowledge Discovery in Databases. ECML PKDD
     2011. Lecture Notes in Computer Science, vol 6913. Springer, Berlin,
     Heidelberg.
+
+    Instead of assigning one sample at a time, every label pass is resolved
+    at once: the remaining label counts are updated incrementally, the fold
+    demands are merged as priority queues (see ``_merge_fold_demands``) and
+    the all-zero-label tail is placed in one vectorized step. The resulting
+    fold assignments, and the draws taken from ``random_state``, are
+    identical to the sample-by-sample formulation of the algorithm, so the
+    splits obtained for a given seed are unchanged.
+
+    ``labels`` may also be a scipy.sparse matrix, in which case the examples
+    of each label are read from the nonzero entries of its column and memory
+    stays proportional to the number of positive labels.
     """
 
+    sparse_labels = sp.issparse(labels)
+    if sparse_labels:
+        labels_by_label = sp.csc_matrix(labels, dtype=bool)
+        labels_by_label.eliminate_zeros()
+        labels_by_label.sort_indices()
+        labels = labels_by_label.tocsr()
+        num_labels = np.diff(labels_by_label.indptr)
+    else:
+        labels = np.asarray(labels, dtype=bool)
+        num_labels = labels.sum(axis=0)
+
     n_samples = labels.shape[0]
+    n_folds = r.shape[0]
     test_folds = np.zeros(n_samples, dtype=int)
 
     # Calculate the desired number of examples at each subset
     c_folds = r * n_samples
 
     # Calculate the desired number of examples of each label at each subset
-    c_folds_labels = np.outer(r, labels.sum(axis=0))
+    c_folds_labels = np.outer(r, num_labels)
+
+    # The desired numbers are tracked through the number of examples assigned
+    # so far, see _decrement_path
+    n_folds_assigned = np.zeros(n_folds, dtype=np.int64)
+    n_folds_labels_assigned = np.zeros(c_folds_labels.shape, dtype=np.int64)
 
     labels_not_processed_mask = np.ones(n_samples, dtype=bool)
 
-    while np.any(labels_not_processed_mask):
+    while np.any(num_labels):
         # Find the label with the fewest (but at least one) remaining examples,
         # breaking ties randomly
-        num_labels = labels[labels_not_processed_mask].sum(axis=0)
-
-        # Handle case where only all-zero labels are left by distributing
-        # across all folds as evenly as possible (not in original algorithm but
-        # mentioned in the text). (By handling this case separately, some
-        # code redundancy is introduced; however, this approach allows for
-        # decreased execution time when there are a relatively large number
-        # of all-zero labels.)
-        if num_labels.sum() == 0:
-            sample_idxs = np.where(labels_not_processed_mask)[0]
-
-            for sample_idx in sample_idxs:
-                fold_idx = np.where(c_folds == c_folds.max())[0]
-
-                if fold_idx.shape[0] > 1:
-                    fold_idx = fold_idx[random_state.choice(fold_idx.shape[0])]
-                else:
-                    fold_idx = fold_idx[0]
-
-                test_folds[sample_idx] = fold_idx
-                c_folds[fold_idx] -= 1
-
-            break
-
         label_idx = np.where(num_labels == num_labels[np.nonzero(num_labels)].min())[0]
         if label_idx.shape[0] > 1:
             label_idx = label_idx[random_state.choice(label_idx.shape[0])]
-
-        sample_idxs = np.where(np.logical_and(labels[:, label_idx].flatten(), labels_not_processed_mask))[0]
-
-        for sample_idx in sample_idxs:
-            # Find the subset(s) with the largest number of desired examples
-            # for this label, breaking ties by considering the largest number
-            # of desired examples, breaking further ties randomly
-            label_folds = c_folds_labels[:, label_idx]
-            fold_idx = np.where(label_folds == label_folds.max())[0]
-            
-            if fold_idx.shape[0] > 1:
-                temp_fold_idx = np.where(c_folds[fold_idx] ==
-                                         c_folds[fold_idx].max())[0]
-                
-                if temp_fold_idx.shape[0] > 1:
-                    fold_idx = fold_idx[temp_fold_idx]
-                    fold_idx = fold_idx[random_state.choice(temp_fold_idx.shape[0])]
-                else:
-                    fold_idx = fold_idx[temp_fold_idx[0]]
-            else:
-                fold_idx = fold_idx[0]
-
-            test_folds[sample_idx] = fold_idx
-            labels_not_processed_mask[sample_idx] = False
-
-            # Update desired number of examples
-            c_folds_labels[fold_idx, labels[sample_idx]] -= 1
-            c_folds[fold_idx] -= 1
+        else:
+            label_idx = label_idx[0]
+
+        if sparse_labels:
+            sample_idxs = labels_by_label.indices[
+                labels_by_label.indptr[label_idx]:labels_by_label.indptr[label_idx + 1]]
+            sample_idxs = sample_idxs[labels_not_processed_mask[sample_idxs]]
+        else:
+            sample_idxs = np.where(np.logical_and(labels[:, label_idx], labels_not_processed_mask))[0]
+        n_picks = sample_idxs.shape[0]
+
+        # Assign each example to the subset with the largest number of desired
+        # examples for this label, breaking ties by considering the largest
+        # number of desired examples, breaking further ties randomly
+        fold_seq = _merge_fold_demands(
+            _decrement_path(c_folds_labels[:, label_idx], n_folds_labels_assigned[:, label_idx], n_picks),
+            _decrement_path(c_folds, n_folds_assigned, n_picks),
+            n_picks, random_state)
+
+        test_folds[sample_idxs] = fold_seq
+        labels_not_processed_mask[sample_idxs] = False
+
+        # Update desired and remaining number of examples
+        fold_labels = _count_labels_per_fold(labels[sample_idxs], fold_seq, n_folds)
+        n_folds_labels_assigned += fold_labels
+        n_folds_assigned += np.bincount(fold_seq, minlength=n_folds)
+        num_labels -= fold_labels.sum(axis=0)
+
+    # Handle case where only all-zero labels are left by distributing
+    # across all folds as evenly as possible (not in original algorithm but
+    # mentioned in the text)
+    sample_idxs = np.where(labels_not_processed_mask)[0]
+    if sample_idxs.shape[0] > 0:
+        demands = _decrement_path(c_folds, n_folds_assigned, sample_idxs.shape[0])
+        test_folds[sample_idxs] = _merge_fold_demands(demands, demands, sample_idxs.shape[0], random_state)
 
     return test_folds
 
@@ -163,7 +295,10 @@ class MultilabelStratifiedKFold(_BaseKFold):
         super(MultilabelStratifiedKFold, self).__init__(n_splits=n_splits, shuffle=shuffle, random_state=random_state)
 
     def _make_test_folds(self, X, y):
-        y = np.asarray(y, dtype=bool)
+        if sp.issparse(y):
+            y = sp.csr_matrix(y, dtype=bool)
+        else:
+            y = np.asarray(y, dtype=bool)
         type_of_target_y = type_of_target(y)
 
         if type_of_target_y != 'multilabel-indicator':
@@ -200,7 +335,7 @@ class MultilabelStratifiedKFold(_BaseKFold):
             Note that providing ``y`` is sufficient to generate the splits and
             hence ``np.zeros(n_samples)`` may be used as a placeholder for
             ``X`` instead of actual training data.
-        y : array-like, shape (n_samples, n_labels)
+        y : array-like or sparse matrix (CSR/CSC), shape (n_samples, n_labels)
             The target variable for supervised learning problems.
             Multilabel stratification is done based on the y labels.
         groups : object
@@ -217,7 +352,7 @@ class MultilabelStratifiedKFold(_BaseKFold):
         split. You can make the results identical by setting ``random_state``
         to an integer.
         """
-        y = check_array(y, ensure_2d=False, dtype=None)
+        y = check_array(y, accept_sparse=('csr', 'csc'), ensure_2d=False, dtype=None)
         return super(MultilabelStratifiedKFold, self).split(X, y, groups)
 
 
@@ -330,8 +465,11 @@ class MultilabelStratifiedShuffleSplit(BaseShuffleSplit):
 
     def _iter_indices(self, X, y, groups=None):
         n_samples = _num_samples(X)
-        y = check_array(y, ensure_2d=False, dtype=None)
-        y = np.asarray(y, dtype=bool)
+        y = check_array(y, accept_sparse=('csr', 'csc'), ensure_2d=False, dtype=None)
+        if sp.issparse(y):
+            y = sp.csr_matrix(y, dtype=bool)
+        else:
+            y = np.asarray(y, dtype=bool)
         type_of_target_y = type_of_target(y)
 
         if type_of_target_y != 'multilabel-indicator':
@@ -344,16 +482,13 @@ class MultilabelStratifiedShuffleSplit(BaseShuffleSplit):
 
         n_samples = y.shape[0]
         rng = check_random_state(self.random_state)
-        y_orig = y.copy()
 
         r = np.array([n_train, n_test]) / (n_train + n_test)
 
         for _ in range(self.n_splits):
             indices = np.arange(n_samples)
             rng.shuffle(indices)
-            y = y_orig[indices]
-
-            test_folds = IterativeStratification(labels=y, r=r, random_state=rng)
+            test_folds = IterativeStratification(labels=y[indices], r=r, random_state=rng)
 
             test_idx = test_folds[np.argsort(indices)] == 1
             test = np.where(test_idx)[0]
@@ -371,7 +506,7 @@ class MultilabelStratifiedShuffleSplit(BaseShuffleSplit):
             Note that providing ``y`` is sufficient to generate the splits and
             hence ``np.zeros(n_samples)`` may be used as a placeholder for
             ``X`` instead of actual training data.
-        y : array-like, shape (n_samples, n_labels)
+        y : array-like or sparse matrix (CSR/CSC), shape (n_samples, n_labels)
             The target variable for supervised learning problems.
             Multilabel stratification is done based on the y labels.
         groups : object
@@ -388,5 +523,5 @@ class MultilabelStratifiedShuffleSplit(BaseShuffleSplit):
         split. You can make the results identical by setting ``random_state``
         to an integer.
         """
-        y = check_array(y, ensure_2d=False, dtype=None)
+        y = check_array(y, accept_sparse=('csr', 'csc'), ensure_2d=False, dtype=None)
         return super(MultilabelStratifiedShuffleSplit, self).split(X, y, groups)
@@ -0,0 +1,291 @@
+"""This file includes a compact on-disk format for the fitted multi-target models
+(MultiOutputClassifier, a Pipeline ending with one, or a search wrapping either),
+loaded lazily one target at a time.
+
+    model/
+    ├── manifest.json           format version, targets, feature names, and for every target
+    │                           the kind of its estimator and its classes
+    ├── preprocessing.joblib    the steps before the MultiOutputClassifier of a Pipeline (e.g. MinMaxScaler)
+    ├── 0_Biopsy/               one directory per target, by kind:
+    │                             forest   flat node tables of all the trees (.npy), memory-mapped
+    │                             xgboost  the booster in XGBoost's native binary format (model.ubj)
+    │                             knn      training set and labels (.npy), memory-mapped
+    │                             joblib   any other estimator (e.g. LogisticRegression, SVC)
+    └── ...
+
+A forest is stored as the concatenation of its trees: child indices, split feature,
+threshold, NaN direction and class probabilities of every node, about a third of its
+pickle, and is scored by walking all the trees at once with array indexing. Probabilities
+are stored as float32, so they match the forest's predict_proba up to 1e-7.
+load_model_bundle only reads the manifest: the estimator of a target is loaded on first
+use, so a scorer needing a few targets never touches the others.
+"""
+
+import json
+import os
+import threading
+
+import joblib
+import numpy as np
+import pandas as pd
+
+from sklearn.ensemble import ExtraTreesClassifier, RandomForestClassifier
+from sklearn.neighbors import KNeighborsClassifier
+from sklearn.pipeline import Pipeline
+
+
+FORMAT_VERSION = 1
+MANIFEST_FILE = 'manifest.json'
+PREPROCESSING_FILE = 'preprocessing.joblib'
+FOREST_ARRAYS = ('roots', 'left', 'right', 'feature', 'threshold', 'missing_left', 'value')
+#rows x trees walked at once when scoring a forest
+FOREST_BLOCK = 1 << 20
+
+
+class ForestTable:
+    """Flat node tables of a fitted RandomForestClassifier / ExtraTreesClassifier (single output)"""
+
+    def __init__(self, roots, left, right, feature, threshold, missing_left, value):
+        self.roots = roots
+        self.left = left
+        self.right = right
+        self.feature = feature
+        self.threshold = threshold
+        self.missing_left = missing_left
+        self.value = value
+
+    @classmethod
+    def from_estimator(cls, forest):
+        trees = [estimator.tree_ for estimator in forest.estimators_]
+        sizes = np.array([tree.node_count for tree in trees])
+        roots = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+
+        def children(attribute):
+            #leaves keep -1, the other children are shifted to global node indices
+            return np.concatenate([np.where(getattr(tree, attribute) == -1, -1, getattr(tree, attribute) + root)
+                                   for tree, root in zip(trees, roots)]).astype(np.int32)
+
+        feature_dtype = np.int16 if forest.n_features_in_ < np.iinfo(np.int16).max else np.int32
+        value = np.concatenate([tree.value[:, 0, :] for tree in trees])
+        normalizer = value.sum(axis=1, keepdims=True)
+        normalizer[normalizer == 0.] = 1.
+
+        return cls(roots.astype(np.int32), children('children_left'), children('children_right'),
+                   np.concatenate([tree.feature for tree in trees]).astype(feature_dtype),
+                   np.concatenate([tree.threshold for tree in trees]),
+                   np.concatenate([tree.missing_go_to_left for tree in trees]).astype(bool),
+                   (value / normalizer).astype(np.float32))
+
+    @property
+    def n_trees(self):
+        return self.roots.shape[0]
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for name in FOREST_ARRAYS:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        mmap_mode = 'r' if mmap else None
+        return cls(*(np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode) for name in FOREST_ARRAYS))
+
+    def predict_proba(self, X):
+        #sklearn's trees compare the float32 features with the float64 thresholds
+        X = np.asarray(X, dtype=np.float32)
+        proba = np.empty((X.shape[0], self.value.shape[1]))
+        block = max(1, FOREST_BLOCK // self.n_trees)
+
+        for start in range(0, X.shape[0], block):
+            X_block = X[start:start + block]
+            node = np.repeat(self.roots[np.newaxis, :], X_block.shape[0], axis=0).ravel()
+            #(row, tree) pairs still on an internal node, shrinking as they reach their leaves
+            pending = np.flatnonzero(self.left[node] != -1)
+            #offsets of the rows in the flattened block, so that a feature lookup is a 1d take
+            rows = pending // self.n_trees * X_block.shape[1]
+            X_flat = X_block.ravel()
+            has_missing = np.isnan(X_block).any()
+            while pending.shape[0]:
+                current = node[pending]
+                values = X_flat.take(rows + self.feature.take(current))
+                go_left = values <= self.threshold.take(current)
+                if has_missing:
+                    go_left = np.where(np.isnan(values), self.missing_left[current], go_left)
+                current = np.where(go_left, self.left.take(current), self.right.take(current))
+                node[pending] = current
+                internal = self.left.take(current) != -1
+                pending, rows = pending[internal], rows[internal]
+            proba[start:start + block] = self.value[node].reshape(X_block.shape[0], self.n_trees, -1).mean(
+                axis=1, dtype=np.float64)
+
+        return proba
+
+
+class _ForestModel:
+    """Scoring-only forest: the node tables and the classes"""
+
+    def __init__(self, table, classes):
+        self.table = table
+        self.classes_ = classes
+
+    def predict_proba(self, X):
+        return self.table.predict_proba(X)
+
+
+def _kind(estimator):
+    if isinstance(estimator, (RandomForestClassifier, ExtraTreesClassifier)) and estimator.n_outputs_ == 1:
+        return 'forest'
+    if type(estimator).__module__.startswith('xgboost') and hasattr(estimator, 'get_booster'):
+        return 'xgboost'
+    if isinstance(estimator, KNeighborsClassifier) and not callable(estimator.weights) and \
+            np.ndim(estimator._y) == 1:
+        return 'knn'
+    return 'joblib'
+
+
+def _save_estimator(estimator, kind, path):
+    os.makedirs(path, exist_ok=True)
+    if kind == 'forest':
+        ForestTable.from_estimator(estimator).save(path)
+    elif kind == 'xgboost':
+        estimator.save_model(os.path.join(path, 'model.ubj'))
+    elif kind == 'knn':
+        np.save(os.path.join(path, 'fit_X.npy'), np.asarray(estimator._fit_X, dtype=np.float64))
+        np.save(os.path.join(path, 'y.npy'), estimator.classes_[estimator._y])
+        params = {'n_neighbors': estimator.n_neighbors, 'weights': estimator.weights, 'p': estimator.p,
+                  'metric': estimator.metric, 'metric_params': estimator.metric_params}
+        with open(os.path.join(path, 'params.json'), 'w') as f:
+            json.dump(params, f, indent=2)
+    else:
+        joblib.dump(estimator, os.path.join(path, 'estimator.joblib'))
+
+
+def _load_estimator(kind, path, classes):
+    if kind == 'forest':
+        return _ForestModel(ForestTable.load(path), np.asarray(classes))
+    if kind == 'xgboost':
+        import xgboost as xgb
+        model = xgb.XGBClassifier()
+        model.load_model(os.path.join(path, 'model.ubj'))
+        return model
+    if kind == 'knn':
+        with open(os.path.join(path, 'params.json')) as f:
+            params = json.load(f)
+        #brute force keeps the memory-mapped training set as is (no tree to build);
+        #the neighbors of the other algorithms are the same up to ties
+        return KNeighborsClassifier(algorithm='brute', **params).fit(
+            np.load(os.path.join(path, 'fit_X.npy'), mmap_mode='r'), np.load(os.path.join(path, 'y.npy')))
+    return joblib.load(os.path.join(path, 'estimator.joblib'))
+
+
+def _unwrap(model):
+    #a fitted search: its refitted best estimator
+    model = getattr(model, 'best_estimator_', model)
+    preprocessing = None
+    if isinstance(model, Pipeline):
+        preprocessing = Pipeline(model.steps[:-1]) if len(model.steps) > 1 else None
+        model = model.steps[-1][1]
+    if not hasattr(model, 'estimators_'):
+        raise TypeError('Expected a fitted MultiOutputClassifier (or a Pipeline ending with one), '
+                        'got {!r} instead.'.format(type(model).__name__))
+    return preprocessing, model
+
+
+def save_model_bundle(model, path, targets):
+    """
+    Store a fitted multi-target model at path (see the module docstring)
+    targets: the target names in the order the model was fitted on, i.e. the order of its
+    estimators (there is no default: the notebooks fit Biopsy first, knn_imputation.py Hinselmann first)
+    """
+    preprocessing, multi_output = _unwrap(model)
+    estimators = multi_output.estimators_
+    targets = list(targets)
+    if len(set(targets)) != len(targets):
+        raise ValueError('Duplicated targets in {}.'.format(targets))
+    if len(targets) != len(estimators):
+        raise ValueError('Got {} targets for {} estimators.'.format(len(targets), len(estimators)))
+
+    os.makedirs(path, exist_ok=True)
+    if preprocessing is not None:
+        joblib.dump(preprocessing, os.path.join(path, PREPROCESSING_FILE))
+
+    entries = {}
+    for position, (target, estimator) in enumerate(zip(targets, estimators)):
+        kind = _kind(estimator)
+        directory = f'{position}_{target}'
+        _save_estimator(estimator, kind, os.path.join(path, directory))
+        entries[target] = {'kind': kind, 'directory': directory, 'classes': np.asarray(estimator.classes_).tolist()}
+
+    feature_names = getattr(model, 'feature_names_in_', None)
+    manifest = {'format_version': FORMAT_VERSION, 'targets': list(targets),
+                'feature_names': None if feature_names is None else list(feature_names),
+                'preprocessing': preprocessing is not None, 'estimators': entries}
+    with open(os.path.join(path, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+
+class LazyMultiOutputModel:
+    """
+    Multi-target model read from a bundle, with the predict_proba of MultiOutputClassifier
+    (one (n_samples, n_classes) array per target) over the loaded targets only;
+    the estimator of every target is loaded on its first use
+    """
+
+    def __init__(self, path, targets=None):
+        self.path = path
+        with open(os.path.join(path, MANIFEST_FILE)) as f:
+            self.manifest = json.load(f)
+        if self.manifest['format_version'] != FORMAT_VERSION:
+            raise ValueError('Unsupported model bundle version {}.'.format(self.manifest['format_version']))
+
+        self.targets = list(self.manifest['targets'] if targets is None else targets)
+        unknown = [target for target in self.targets if target not in self.manifest['estimators']]
+        if unknown:
+            raise KeyError('Targets {} are not stored in {}.'.format(unknown, path))
+
+        self._estimators = {}
+        self._preprocessing = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded_targets(self):
+        return list(self._estimators)
+
+    def estimator(self, target):
+        if target not in self._estimators:
+            with self._lock:
+                if target not in self._estimators:
+                    entry = self.manifest['estimators'][target]
+                    self._estimators[target] = _load_estimator(entry['kind'], os.path.join(self.path, entry['directory']),
+                                                               entry['classes'])
+        return self._estimators[target]
+
+    def _prepare(self, X):
+        feature_names = self.manifest['feature_names']
+        if feature_names is not None and isinstance(X, pd.DataFrame):
+            X = X[feature_names]
+        if self.manifest['preprocessing']:
+            if self._preprocessing is None:
+                self._preprocessing = joblib.load(os.path.join(self.path, PREPROCESSING_FILE))
+            X = self._preprocessing.transform(X)
+        return X
+
+    def _target_proba(self, target, X):
+        #node tables and the refitted KNN know no feature names, the other estimators keep theirs
+        if self.manifest['estimators'][target]['kind'] in ('forest', 'knn'):
+            X = np.asarray(X)
+        return self.estimator(target).predict_proba(X)
+
+    def predict_proba(self, X):
+        X = self._prepare(X)
+        return [self._target_proba(target, X) for target in self.targets]
+
+    def predict(self, X):
+        X = self._prepare(X)
+        return np.column_stack([np.asarray(self.manifest['estimators'][target]['classes'])[
+            self._target_proba(target, X).argmax(axis=1)] for target in self.targets])
+
+
+def load_model_bundle(path, targets=None):
+    """Model stored by save_model_bundle, restricted to targets (all by default), loaded lazily"""
+    return LazyMultiOutputModel(path, targets)
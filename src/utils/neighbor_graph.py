@@ -0,0 +1,337 @@
+"""This file includes a k-nearest-neighbor graph shared by the KNN classifier tuning
+and the KNN imputation.
+
+The neighbors of a query set among a training set only depend on the two sets and on
+the metric: n_neighbors, the weighting and the search algorithm (which does not change
+the neighbors, only how they are found) do not. The top-k_max neighbors and distances
+are computed once per (training set, query set, metric) and kept in a named LRU
+cache, and every smaller k and every weighting is a slice of that graph:
+
+    GraphKNeighborsClassifier   drop-in for MultiOutputClassifier(KNeighborsClassifier()),
+                                one graph serves all the targets and all the candidates
+                                of a search sharing the folds (n_neighbors, weights,
+                                algorithm, leaf_size)
+    GraphKNNImputer             KNNImputer semantics (nan-euclidean distance, donors with
+                                the feature observed), donors taken from the graph and
+                                searched exactly only when the slice is too short
+
+Neighbors are exact (brute force, blocked), ties are broken by training row order.
+The caches live in the process: with RandomizedSearchCV, use n_jobs=1 (or a threading
+backend) so that the candidates of a fold share them.
+
+e.g. in the KNN modeling notebook
+    pipeline = Pipeline([('scaler', MinMaxScaler()), ('estimator', GraphKNeighborsClassifier(k_max=29))])
+    param_grid = {'estimator__n_neighbors': [9, 11, 29], 'estimator__weights': ['uniform', 'distance'],
+                  'estimator__algorithm': [...], 'estimator__leaf_size': [...], 'estimator__p': [1, 2]}
+"""
+
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+from sklearn.base import BaseEstimator, ClassifierMixin, TransformerMixin
+from sklearn.metrics.pairwise import nan_euclidean_distances, pairwise_distances
+from sklearn.utils.validation import check_array, check_is_fitted
+
+
+#default memory budget of a graph cache
+DEFAULT_MAX_BYTES = 256 * 2 ** 20
+
+
+def _digest(X):
+    digest = hashlib.sha1()
+    digest.update(f"{X.shape}{X.dtype.str}".encode())
+    digest.update(np.ascontiguousarray(X).tobytes())
+    return digest.hexdigest()
+
+
+def _distances(X_block, fit_X, metric, p):
+    if metric == 'nan_euclidean':
+        return nan_euclidean_distances(X_block, fit_X)
+    if metric == 'minkowski':
+        #the closed forms of p = 1 and p = 2 are the ones sklearn's brute-force search uses
+        if p == 1:
+            return pairwise_distances(X_block, fit_X, metric='manhattan')
+        if p == 2:
+            return pairwise_distances(X_block, fit_X, metric='euclidean')
+        return pairwise_distances(X_block, fit_X, metric='minkowski', p=p)
+    return pairwise_distances(X_block, fit_X, metric=metric)
+
+
+def _get_weights(dist, weights):
+    #as in sklearn: with distance weighting, neighbors at distance zero take all the weight of their row
+    if weights == 'uniform':
+        weight_matrix = np.ones_like(dist)
+        weight_matrix[np.isnan(dist)] = 0.
+        return weight_matrix
+
+    with np.errstate(divide='ignore'):
+        weight_matrix = 1. / dist
+    inf_mask = np.isinf(weight_matrix)
+    inf_row = np.any(inf_mask, axis=1)
+    weight_matrix[inf_row] = inf_mask[inf_row]
+    weight_matrix[np.isnan(weight_matrix)] = 0.
+    return weight_matrix
+
+
+class NeighborGraph:
+    """Top-k neighbors (indices into the training set, sorted by distance, NaN
+    distances last) of every query row"""
+
+    def __init__(self, indices, distances, n_fit):
+        self.indices = indices
+        self.distances = distances
+        self.n_fit = n_fit
+
+    @property
+    def k(self):
+        return self.indices.shape[1]
+
+    @property
+    def complete(self):
+        #every training row is in the graph, so no neighbor can be missing from a slice
+        return self.k == self.n_fit
+
+    @property
+    def nbytes(self):
+        return self.indices.nbytes + self.distances.nbytes
+
+    def kneighbors(self, n_neighbors):
+        if n_neighbors > self.k:
+            raise ValueError(f"The graph holds {self.k} neighbors, {n_neighbors} requested")
+        return self.distances[:, :n_neighbors], self.indices[:, :n_neighbors]
+
+    @classmethod
+    def compute(cls, fit_X, X, k, metric='minkowski', p=2, working_memory=256):
+        n_fit = fit_X.shape[0]
+        k = min(k, n_fit)
+        indices = np.empty((X.shape[0], k), dtype=np.intp)
+        distances = np.empty((X.shape[0], k), dtype=np.float64)
+
+        #a block keeps its distance matrix and the sort order of it alive
+        block_size = max(1, int(working_memory * 2 ** 20 // (16 * n_fit)))
+        for start in range(0, X.shape[0], block_size):
+            dist = _distances(X[start:start + block_size], fit_X, metric, p)
+            #stable sort: ties go to the first training row, NaN distances sort last
+            order = np.argsort(dist, axis=1, kind='stable')[:, :k]
+            indices[start:start + block_size] = order
+            distances[start:start + block_size] = np.take_along_axis(dist, order, axis=1)
+
+        return cls(indices, distances, n_fit)
+
+
+class NeighborGraphCache:
+    """
+    LRU cache of neighbor graphs, keyed by the digests of the training and query sets
+    and by the metric; a cached graph serves every request for at most its k neighbors
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, fit_X, X, k, metric='minkowski', p=2, fit_key=None):
+        """Graph of at least min(k, n_fit) neighbors of X among fit_X, computed on a miss
+        (fit_key: the digest of fit_X, when the caller already has it)"""
+        key = (fit_key or _digest(fit_X), _digest(X), metric, p)
+        graph = self.entries.get(key)
+
+        if graph is not None and (graph.k >= k or graph.complete):
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return graph
+
+        self.misses += 1
+        graph = NeighborGraph.compute(fit_X, X, k, metric, p)
+        self.put(key, graph)
+        return graph
+
+    def put(self, key, graph):
+        if key in self.entries:
+            self.n_bytes -= self.entries.pop(key).nbytes
+
+        self.entries[key] = graph
+        self.n_bytes += graph.nbytes
+
+        while self.n_bytes > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.n_bytes -= evicted.nbytes
+
+    def clear(self):
+        self.entries.clear()
+        self.n_bytes = 0
+
+
+#caches are looked up by name, since sklearn's clone deep-copies the estimator parameters
+_CACHES = {}
+
+
+def get_graph_cache(name='default'):
+    if name not in _CACHES:
+        _CACHES[name] = NeighborGraphCache()
+    return _CACHES[name]
+
+
+class GraphKNeighborsClassifier(ClassifierMixin, BaseEstimator):
+    """
+    k-nearest-neighbors classifier reading its neighbors from a shared NeighborGraph.
+
+    Predictions are those of KNeighborsClassifier (up to the order of tied neighbors)
+    for every target of y at once; predict_proba returns one (n_samples, n_classes)
+    array per target when y is 2D, like MultiOutputClassifier. algorithm and leaf_size
+    are accepted so that existing search spaces keep working, but the neighbors are
+    exact whatever their value. k_max is the number of neighbors computed on a cache
+    miss, set it to the largest n_neighbors of the search.
+    """
+
+    def __init__(self, n_neighbors=5, weights='uniform', algorithm='auto', leaf_size=30, p=2,
+                 metric='minkowski', k_max=29, cache='default'):
+        self.n_neighbors = n_neighbors
+        self.weights = weights
+        self.algorithm = algorithm
+        self.leaf_size = leaf_size
+        self.p = p
+        self.metric = metric
+        self.k_max = k_max
+        self.cache = cache
+
+    def fit(self, X, y):
+        if self.weights not in ('uniform', 'distance'):
+            raise ValueError(f"weights must be 'uniform' or 'distance', got {self.weights!r}")
+
+        self.fit_X_ = check_array(X, dtype=np.float64)
+        self.n_features_in_ = self.fit_X_.shape[1]
+        if hasattr(X, 'columns'):
+            self.feature_names_in_ = np.asarray(X.columns, dtype=object)
+        self.fit_key_ = _digest(self.fit_X_)
+
+        y = np.asarray(y)
+        self.outputs_2d_ = y.ndim == 2
+        y = y.reshape(y.shape[0], -1)
+        if y.shape[0] != self.fit_X_.shape[0]:
+            raise ValueError("X and y have a different number of samples")
+
+        self.classes_, self._y = [], np.empty(y.shape, dtype=np.intp)
+        for k in range(y.shape[1]):
+            classes, self._y[:, k] = np.unique(y[:, k], return_inverse=True)
+            self.classes_.append(classes)
+        if not self.outputs_2d_:
+            self.classes_ = self.classes_[0]
+
+        return self
+
+    def kneighbors(self, X, n_neighbors=None):
+        check_is_fitted(self)
+        n_neighbors = self.n_neighbors if n_neighbors is None else n_neighbors
+        if n_neighbors > self.fit_X_.shape[0]:
+            raise ValueError(f"Expected n_neighbors <= n_samples_fit = {self.fit_X_.shape[0]}, got {n_neighbors}")
+
+        X = check_array(X, dtype=np.float64)
+        graph = get_graph_cache(self.cache).get(self.fit_X_, X, max(n_neighbors, self.k_max or 0),
+                                                self.metric, self.p, fit_key=self.fit_key_)
+        return graph.kneighbors(n_neighbors)
+
+    def predict_proba(self, X):
+        dist, ind = self.kneighbors(X)
+        weights = _get_weights(dist, self.weights)
+
+        classes = self.classes_ if self.outputs_2d_ else [self.classes_]
+        probabilities = []
+        for k, classes_k in enumerate(classes):
+            neighbor_classes = self._y[ind, k]
+            proba = np.stack([(weights * (neighbor_classes == c)).sum(axis=1) for c in range(len(classes_k))],
+                             axis=1)
+            normalizer = proba.sum(axis=1, keepdims=True)
+            normalizer[normalizer == 0.] = 1.
+            probabilities.append(proba / normalizer)
+
+        return probabilities if self.outputs_2d_ else probabilities[0]
+
+    def predict(self, X):
+        probabilities = self.predict_proba(X)
+        if not self.outputs_2d_:
+            return self.classes_.take(probabilities.argmax(axis=1))
+        return np.stack([classes.take(proba.argmax(axis=1))
+                         for classes, proba in zip(self.classes_, probabilities)], axis=1)
+
+
+class GraphKNNImputer(TransformerMixin, BaseEstimator):
+    """
+    KNN imputation with the semantics of sklearn's KNNImputer (nan-euclidean distance,
+    the n_neighbors closest rows having the feature observed, NaN distances weighing
+    zero, the column mean when every distance is NaN), with the donors read from a
+    shared nan-euclidean NeighborGraph of k_max neighbors. A receiver whose k_max
+    neighbors hold fewer than n_neighbors donors of a feature is searched exactly.
+    """
+
+    def __init__(self, n_neighbors=29, weights='distance', k_max=64, cache='default'):
+        self.n_neighbors = n_neighbors
+        self.weights = weights
+        self.k_max = k_max
+        self.cache = cache
+
+    def fit(self, X, y=None):
+        self.fit_X_ = check_array(X, dtype=np.float64, ensure_all_finite='allow-nan')
+        self.mask_fit_X_ = np.isnan(self.fit_X_)
+        self.col_means_ = np.ma.array(self.fit_X_, mask=self.mask_fit_X_).mean(axis=0).filled(np.nan)
+        self.fit_key_ = _digest(self.fit_X_)
+        return self
+
+    def transform(self, X):
+        check_is_fitted(self)
+        X = check_array(X, dtype=np.float64, ensure_all_finite='allow-nan', copy=True)
+        mask = np.isnan(X)
+        receivers_all = np.flatnonzero(mask.any(axis=1))
+        if receivers_all.shape[0] == 0:
+            return X
+
+        graph = get_graph_cache(self.cache).get(self.fit_X_, X[receivers_all], max(self.n_neighbors, self.k_max),
+                                                'nan_euclidean', fit_key=self.fit_key_)
+        position = np.full(X.shape[0], -1)
+        position[receivers_all] = np.arange(receivers_all.shape[0])
+
+        out = X.copy()
+        for col in np.flatnonzero(mask.any(axis=0)):
+            observed = ~self.mask_fit_X_[:, col]
+            n_donors = min(self.n_neighbors, int(observed.sum()))
+            if n_donors == 0:
+                continue
+
+            receivers = np.flatnonzero(mask[:, col])
+            rows = position[receivers]
+            ind, dist = graph.indices[rows], graph.distances[rows]
+
+            #the first n_donors graph neighbors with the feature observed and a defined distance
+            usable = observed[ind] & ~np.isnan(dist)
+            taken = usable & (np.cumsum(usable, axis=1) <= n_donors)
+            n_taken = taken.sum(axis=1)
+
+            #a short slice is final only when the graph holds every training row
+            short = (n_taken < n_donors) & (not graph.complete)
+            for r in np.flatnonzero(short):
+                out[receivers[r], col] = self._impute_exact(X[receivers[r]], col, n_donors)
+
+            sliced = np.flatnonzero(~short)
+            values = np.where(taken[sliced], self.fit_X_[ind[sliced], col], 0.)
+            weights = np.where(taken[sliced], _get_weights(np.where(taken[sliced], dist[sliced], np.nan),
+                                                           self.weights), 0.)
+            total = weights.sum(axis=1)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                imputed = (weights * values).sum(axis=1) / total
+            #receivers with all nan distances impute with the column mean
+            out[receivers[sliced], col] = np.where(n_taken[sliced] == 0, self.col_means_[col], imputed)
+
+        return out
+
+    def _impute_exact(self, row, col, n_donors):
+        donors = np.flatnonzero(~self.mask_fit_X_[:, col])
+        dist = nan_euclidean_distances(row[np.newaxis], self.fit_X_[donors])[0]
+        if np.isnan(dist).all():
+            return self.col_means_[col]
+
+        order = np.argsort(dist, kind='stable')[:n_donors]
+        weights = _get_weights(dist[order][np.newaxis], self.weights)[0]
+        return (weights * self.fit_X_[donors[order], col]).sum() / weights.sum()
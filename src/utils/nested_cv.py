@@ -0,0 +1,245 @@
+import os
+import time
+import warnings
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+from sklearn.base import clone
+from sklearn.metrics import average_precision_score, roc_auc_score
+from sklearn.model_selection import ParameterSampler, check_cv
+from threadpoolctl import threadpool_limits
+
+
+#per-target metrics of the inner searches, averaged over the targets like sklearn's macro scorers
+SCORERS = {'average_precision': average_precision_score, 'roc_auc': roc_auc_score}
+
+#estimator parameters holding a thread count (sklearn, XGBoost)
+THREAD_PARAMS = ('n_jobs', 'nthread')
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS')
+
+
+class SearchSpec:
+    """
+    One model of a nested cross-validation, with the settings of the
+    RandomizedSearchCV it replaces: a multi-output estimator (MultiOutputClassifier,
+    or a Pipeline ending with one), its param_distributions, n_iter, the inner cv
+    and the scoring
+    """
+
+    def __init__(self, estimator, param_distributions, n_iter=10, cv=3, scoring='average_precision',
+                 random_state=None):
+        if scoring not in SCORERS:
+            raise ValueError(f"scoring must be one of {sorted(SCORERS)}, got {scoring!r}")
+        self.estimator = estimator
+        self.param_distributions = param_distributions
+        self.n_iter = n_iter
+        self.cv = cv
+        self.scoring = scoring
+        self.random_state = random_state
+
+    def candidates(self):
+        #sampled as RandomizedSearchCV does, hence the same candidates for every outer fold
+        return list(ParameterSampler(self.param_distributions, self.n_iter, random_state=self.random_state))
+
+
+class ModelResult:
+    """
+    Outcome of a model: candidates, per outer fold inner scores
+    (scores_[outer] has shape (n_candidates, n_inner_folds, n_targets)),
+    best parameters and the positive class probabilities of the refitted
+    best candidate on the outer test fold (n_test_samples, n_targets)
+    """
+
+    def __init__(self, candidates, outer_splits, n_inner, n_targets):
+        self.candidates = candidates
+        self.outer_splits = outer_splits
+        self.scores_ = [np.full((len(candidates), n_inner[k], n_targets), np.nan)
+                        for k in range(len(outer_splits))]
+        self.best_index_ = [None] * len(outer_splits)
+        self.predictions_ = [np.full((test.shape[0], n_targets), np.nan) for _, test in outer_splits]
+
+    @property
+    def best_params_(self):
+        return [self.candidates[i] for i in self.best_index_]
+
+    def mean_test_scores(self, outer):
+        #mean over the targets (macro scorer) of each inner fold, then over the inner folds
+        return self.scores_[outer].mean(axis=2).mean(axis=1)
+
+    @property
+    def cv_results_(self):
+        rows = []
+        for outer in range(len(self.outer_splits)):
+            for i, score in enumerate(self.mean_test_scores(outer)):
+                rows.append({'outer_fold': outer, 'candidate': i, 'params': self.candidates[i],
+                             'mean_test_score': score, 'best': i == self.best_index_[outer]})
+        return pd.DataFrame(rows)
+
+
+def _share(array):
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+#worker side: views on the shared X and y, set once per process by _init_worker
+_shared = {}
+
+
+def _init_worker(X_spec, y_spec, n_threads):
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(n_threads)
+    threadpool_limits(n_threads)
+
+    for key, (name, shape, dtype) in (('X', X_spec), ('y', y_spec)):
+        shm = shared_memory.SharedMemory(name=name)
+        _shared[key + '_shm'] = shm
+        _shared[key] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+def _positive_proba(model, X):
+    proba = model.predict_proba(X)
+    #MultiOutputClassifier returns one (n_samples, 2) array per target
+    if isinstance(proba, list):
+        proba = proba[0]
+    return proba[:, 1]
+
+
+def _run_task(estimator, params, target, train, test, scoring, n_threads):
+    """
+    Fit the estimator on a single target of the train rows; return the inner score
+    (scoring given) or the positive class probabilities of the test rows, with timings
+    """
+    start_wall, start_cpu = time.time(), time.process_time()
+    X, y = _shared['X'], _shared['y']
+
+    model = clone(estimator).set_params(**params)
+    model.set_params(**{name: n_threads for name in model.get_params() if name.split('__')[-1] in THREAD_PARAMS})
+
+    try:
+        model.fit(X[train], y[train][:, [target]])
+        proba = _positive_proba(model, X[test])
+        result = proba if scoring is None else SCORERS[scoring](y[test, target], proba)
+    except Exception:
+        #as RandomizedSearchCV's error_score=np.nan, a failing candidate loses the search
+        if scoring is None:
+            raise
+        result = np.nan
+
+    return result, start_wall, time.time(), time.process_time() - start_cpu
+
+
+class NestedCVExecutor:
+    """
+    Nested cross-validation of several models on one bounded process pool.
+
+    The loops of the modeling notebooks (outer splits, RandomizedSearchCV, MultiOutputClassifier)
+    are flattened into one task graph: a task fits one search candidate on one inner fold
+    for one target, and the refit of the best candidate on an outer training set (one task
+    per target) is scheduled as soon as the inner tasks of that outer fold are done.
+    Every task runs with threads_per_task threads (n_jobs/nthread estimator parameters,
+    BLAS/OpenMP pools), so that n_workers * threads_per_task cores are never oversubscribed.
+    X and y are placed in shared memory once, tasks only carry row indices.
+
+    Since MultiOutputClassifier fits an independent clone per target, the inner scores,
+    best candidates and outer predictions are those of the nested RandomizedSearchCV loops.
+    """
+
+    def __init__(self, outer_cv, n_workers=None, threads_per_task=1, mp_context=None):
+        self.outer_cv = outer_cv
+        self.n_workers = n_workers
+        self.threads_per_task = threads_per_task
+        self.mp_context = mp_context
+
+    def run(self, models, X, y):
+        """
+        models: {name: SearchSpec}; returns ({name: ModelResult}, report), where the report
+        holds the per-model task count, wall time, CPU time and core utilization
+        """
+        X = np.asarray(X)
+        #float64 features (imputation_helpers.FEATURE_DTYPE), or float32 ones, are shared as they are
+        X = np.ascontiguousarray(X, dtype=X.dtype if X.dtype in (np.float32, np.float64) else np.float64)
+        y = np.ascontiguousarray(y)
+        if y.ndim != 2:
+            raise ValueError("y must be a 2D array of targets")
+        n_targets = y.shape[1]
+
+        n_workers = self.n_workers or max(1, (os.cpu_count() or 1) // self.threads_per_task)
+        outer_splits = list(self.outer_cv.split(X, y))
+
+        results, inner_splits, remaining, tasks = {}, {}, {}, []
+        for name, spec in models.items():
+            inner_splits[name] = [[(train[a], train[b]) for a, b in
+                                   check_cv(spec.cv, y[train], classifier=True).split(X[train], y[train])]
+                                  for train, _ in outer_splits]
+            candidates = spec.candidates()
+            results[name] = ModelResult(candidates, outer_splits, [len(s) for s in inner_splits[name]], n_targets)
+
+            for outer in range(len(outer_splits)):
+                remaining[name, outer] = len(candidates) * len(inner_splits[name][outer]) * n_targets
+                for c, params in enumerate(candidates):
+                    for i, (train, test) in enumerate(inner_splits[name][outer]):
+                        for t in range(n_targets):
+                            tasks.append((('score', name, outer, c, i, t),
+                                          (spec.estimator, params, t, train, test, spec.scoring)))
+
+        timings = {name: [] for name in models}
+        X_shm, X_spec = _share(X)
+        y_shm, y_spec = _share(y)
+        start = time.time()
+        try:
+            with ProcessPoolExecutor(max_workers=n_workers, mp_context=self.mp_context, initializer=_init_worker,
+                                     initargs=(X_spec, y_spec, self.threads_per_task)) as pool:
+                running = {pool.submit(_run_task, *args, self.threads_per_task): key for key, args in tasks}
+
+                while running:
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        key = running.pop(future)
+                        kind, name, outer = key[:3]
+                        result, task_start, task_end, cpu = future.result()
+                        timings[name].append((task_start, task_end, cpu))
+                        model = results[name]
+
+                        if kind == 'refit':
+                            model.predictions_[outer][:, key[3]] = result
+                            continue
+
+                        model.scores_[outer][key[3:]] = result
+                        remaining[name, outer] -= 1
+                        if remaining[name, outer]:
+                            continue
+
+                        #inner search of this outer fold completed: refit of the best candidate
+                        mean_scores = model.mean_test_scores(outer)
+                        if np.isnan(mean_scores).any():
+                            warnings.warn(f"{name}: {np.isnan(mean_scores).sum()} candidates failed "
+                                          f"on outer fold {outer}")
+                        best = int(np.argmax(np.where(np.isnan(mean_scores), -np.inf, mean_scores)))
+                        model.best_index_[outer] = best
+
+                        train, test = outer_splits[outer]
+                        for t in range(n_targets):
+                            future = pool.submit(_run_task, models[name].estimator, model.candidates[best], t,
+                                                 train, test, None, self.threads_per_task)
+                            running[future] = ('refit', name, outer, t)
+        finally:
+            for shm in (X_shm, y_shm):
+                shm.close()
+                shm.unlink()
+
+        report = self._report(timings, time.time() - start, n_workers)
+        return results, report
+
+    def _report(self, timings, total_wall, n_workers):
+        cores = n_workers * self.threads_per_task
+        rows = {}
+        for name, times in list(timings.items()) + [('total', sum(timings.values(), []))]:
+            times = np.array(times).reshape(-1, 3)
+            wall = total_wall if name == 'total' else times[:, 1].max() - times[:, 0].min()
+            cpu = times[:, 2].sum()
+            rows[name] = {'tasks': times.shape[0], 'wall_s': wall, 'task_s': (times[:, 1] - times[:, 0]).sum(),
+                          'cpu_s': cpu, 'core_utilization': cpu / (wall * cores) if wall else np.nan}
+        return pd.DataFrame(rows).T.astype({'tasks': int})
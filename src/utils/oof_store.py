@@ -0,0 +1,318 @@
+"""This file includes a persistent store of the out-of-fold predictions of the modeling
+notebooks, so that models can be compared, re-thresholded and stacked without refits.
+
+Every entry is keyed by (dataset hash, fold plan key, model config hash) and is kept in
+OOF_DIR/<dataset>/<plan>/<config>/:
+    proba.npy     float32 array (n_repeats, n_samples, n_targets) of the positive-class
+                  probabilities of every target, NaN where a sample is not tested in a
+                  repeat (e.g. the train rows of a shuffle-split repeat); memory-mapped on load
+    entry.json    model name and config, targets and the splits completed so far
+Splits are written as soon as they are fitted, so an interrupted collect resumes where it
+stopped, and collecting a model already stored costs nothing.
+
+OOFStacker trains a meta-learner per target on the stored probabilities of several models
+(evaluated with inner multilabel folds over the tested rows of every repeat), blend averages them.
+
+e.g.
+    store = OOFStore()
+    plan = get_fold_plan(msss, y)
+    entries = [store.collect(model, X, y, plan, name=name) for name, model in models.items()]
+    stacker = OOFStacker().fit(entries, y)
+    for train_index, test_index, prob_matrix in stacker.splits():
+        ...
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+
+from sklearn.base import clone
+from sklearn.linear_model import LogisticRegression
+from sklearn.utils import _safe_indexing
+
+from .fold_plan import FoldPlan, get_fold_plan
+from .ml_stratifiers import MultilabelStratifiedKFold
+from .paths import ROOT_DIR
+
+
+OOF_DIR = os.path.join(ROOT_DIR, '.pipeline_cache', 'oof')
+PROBA_FILE = 'proba.npy'
+ENTRY_FILE = 'entry.json'
+#hex digits of the keys used as directory names
+KEY_LENGTH = 16
+
+
+def _config(value):
+    #a stable description of an estimator config: nested estimators by class name (their
+    #parameters are listed by get_params(deep=True)), scipy distributions by name and arguments
+    if hasattr(value, 'get_params'):
+        return type(value).__name__
+    if hasattr(value, 'dist') and hasattr(value, 'args'):
+        return f"{value.dist.name}{value.args}{sorted(value.kwds.items())}"
+    if isinstance(value, dict):
+        return {str(key): _config(item) for key, item in sorted(value.items(), key=lambda item: str(item[0]))}
+    if isinstance(value, (list, tuple)):
+        return [_config(item) for item in value]
+    return repr(value)
+
+
+def config_key(estimator):
+    """Hash of the class and of all the (nested) parameters of an estimator"""
+    config = {'class': type(estimator).__name__, 'params': _config(estimator.get_params(deep=True))}
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+def dataset_key(X, y):
+    """Hash of the features (values and column names) and of the labels"""
+    digest = hashlib.sha1()
+    for data in (X, y):
+        if hasattr(data, 'columns'):
+            digest.update(repr(list(data.columns)).encode())
+        values = np.ascontiguousarray(np.asarray(data, dtype=np.float64))
+        digest.update(repr(values.shape).encode())
+        digest.update(values.tobytes())
+    return digest.hexdigest()
+
+
+def plan_key(plan):
+    #plans of unseeded cross validators have no key: their test folds identify them
+    if plan.key is not None:
+        return plan.key
+    return hashlib.sha1(plan.kind.encode() + np.ascontiguousarray(plan.test_folds).tobytes()).hexdigest()
+
+
+def _split_repeats(plan):
+    #repeat of every split of plan.split
+    n_folds = 1 if plan.kind == 'shuffle_split' else plan.n_folds
+    return np.repeat(np.arange(plan.n_repeats), n_folds)
+
+
+def _positive_proba(model, X):
+    proba = model.predict_proba(X)
+    #MultiOutputClassifier returns one (n_samples, 2) array per target
+    if isinstance(proba, list):
+        return np.column_stack([p[:, 1] for p in proba])
+    return proba
+
+
+def _fit_split(estimator, X, y, train, test):
+    model = clone(estimator).fit(_safe_indexing(X, train), _safe_indexing(y, train))
+    return _positive_proba(model, _safe_indexing(X, test)).astype(np.float32)
+
+
+class OOFPredictions:
+    """Stored out-of-fold probabilities of one model on one dataset and fold plan"""
+
+    def __init__(self, path, plan):
+        self.path = path
+        self.plan = plan
+        with open(os.path.join(path, ENTRY_FILE)) as f:
+            self.entry = json.load(f)
+        self.proba = np.load(os.path.join(path, PROBA_FILE), mmap_mode='r')
+
+    @property
+    def name(self):
+        return self.entry['name']
+
+    @property
+    def targets(self):
+        return self.entry['targets']
+
+    @property
+    def complete(self):
+        return len(self.entry['completed']) == self.plan.get_n_splits()
+
+    def splits(self):
+        """(train_index, test_index, prob_matrix) of every completed split, in the order of plan.split"""
+        repeats = _split_repeats(self.plan)
+        completed = set(self.entry['completed'])
+        for split, (train, test) in enumerate(self.plan.split(np.empty((self.plan.n_samples, 0)))):
+            if split in completed:
+                yield train, test, np.asarray(self.proba[repeats[split], test])
+
+    def __repr__(self):
+        return '{}(name={!r}, splits={}/{})'.format(type(self).__name__, self.name,
+                                                   len(self.entry['completed']), self.plan.get_n_splits())
+
+
+class OOFStore:
+    """Out-of-fold predictions stored under root, see the module docstring"""
+
+    def __init__(self, root=OOF_DIR):
+        self.root = root
+
+    def entry_path(self, X, y, plan, estimator):
+        return os.path.join(self.root, dataset_key(X, y)[:KEY_LENGTH], plan_key(plan)[:KEY_LENGTH],
+                            config_key(estimator)[:KEY_LENGTH])
+
+    def collect(self, estimator, X, y, plan, name=None, n_jobs=None, targets=None):
+        """
+        Out-of-fold predictions of estimator on every split of plan (a FoldPlan, or one of the
+        cross validators of ml_stratifiers.py), fitting only the splits not stored yet, n_jobs at a time
+        targets: the names of the columns of y, required if y is an array (there is no default order:
+        the imputed datasets are Hinselmann first, utils/thresholds.TARGETS is Biopsy first)
+        """
+        if targets is None:
+            if not isinstance(y, pd.DataFrame):
+                raise ValueError("targets must be given when y is not a DataFrame")
+            targets = y.columns
+        targets = list(targets)
+        if isinstance(y, pd.DataFrame) and targets != list(y.columns):
+            raise ValueError(f"targets {targets} do not match the columns of y {list(y.columns)}")
+        if np.shape(y)[1:] != (len(targets),):
+            raise ValueError(f"Got {len(targets)} targets for y of shape {np.shape(y)}")
+
+        if not isinstance(plan, FoldPlan):
+            plan = get_fold_plan(plan, y)
+        if plan.n_samples != len(X):
+            raise ValueError('The plan was computed for {} samples, got {} instead.'.format(plan.n_samples, len(X)))
+
+        path = self.entry_path(X, y, plan, estimator)
+        entry_file = os.path.join(path, ENTRY_FILE)
+        if os.path.exists(entry_file):
+            with open(entry_file) as f:
+                entry = json.load(f)
+            if entry['targets'] != targets:
+                raise ValueError(f"{path} stores the targets {entry['targets']}, got {targets}")
+            proba = np.load(os.path.join(path, PROBA_FILE), mmap_mode='r+')
+        else:
+            os.makedirs(path, exist_ok=True)
+            entry = {'name': name or type(estimator).__name__, 'config': _config(estimator.get_params(deep=True)),
+                     'targets': targets, 'n_splits': plan.get_n_splits(), 'completed': []}
+            proba = np.lib.format.open_memmap(os.path.join(path, PROBA_FILE), mode='w+', dtype=np.float32,
+                                              shape=(plan.n_repeats, plan.n_samples, len(targets)))
+            proba[:] = np.nan
+
+        repeats = _split_repeats(plan)
+        todo = [(split, train, test) for split, (train, test) in enumerate(plan.split(X))
+                if split not in entry['completed']]
+        results = Parallel(n_jobs=n_jobs, return_as='generator')(
+            delayed(_fit_split)(estimator, X, y, train, test) for _, train, test in todo)
+
+        for (split, _, test), split_proba in zip(todo, results):
+            proba[repeats[split], test] = split_proba
+            proba.flush()
+            #the split is recorded only once its probabilities are on disk
+            entry['completed'] = sorted(entry['completed'] + [split])
+            with open(entry_file + '.tmp', 'w') as f:
+                json.dump(entry, f, indent=2)
+            os.replace(entry_file + '.tmp', entry_file)
+
+        del proba
+        return OOFPredictions(path, plan)
+
+    def entries(self, X, y, plan):
+        """Every model stored for this dataset and fold plan"""
+        if not isinstance(plan, FoldPlan):
+            plan = get_fold_plan(plan, y)
+        directory = os.path.join(self.root, dataset_key(X, y)[:KEY_LENGTH], plan_key(plan)[:KEY_LENGTH])
+        if not os.path.isdir(directory):
+            return []
+        return [OOFPredictions(os.path.join(directory, config), plan) for config in sorted(os.listdir(directory))
+                if os.path.exists(os.path.join(directory, config, ENTRY_FILE))]
+
+
+def _check_entries(entries):
+    if not entries:
+        raise ValueError("No out-of-fold predictions given")
+    plan, targets = entries[0].plan, entries[0].targets
+    for entry in entries[1:]:
+        if plan_key(entry.plan) != plan_key(plan) or entry.targets != targets:
+            raise ValueError("Out-of-fold predictions of different fold plans or targets cannot be combined")
+    return plan, targets
+
+
+def blend(entries, weights=None):
+    """Weighted average of the stored probabilities, array (n_repeats, n_samples, n_targets)"""
+    _check_entries(entries)
+    weights = np.ones(len(entries)) if weights is None else np.asarray(weights, dtype=np.float64)
+    stacked = np.stack([np.asarray(entry.proba, dtype=np.float64) for entry in entries])
+    return np.tensordot(weights / weights.sum(), stacked, axes=1)
+
+
+class OOFStacker:
+    """
+    Stacking of several stored models: one meta-learner per target, trained on the stored
+    probabilities of the base models (features='target': the probabilities of that target,
+    'all': of every target)
+
+    The meta-learner is evaluated out of fold as well: within every repeat of the plan, the
+    rows tested by the base models are split in inner_cv multilabel stratified folds, giving
+    oof_proba_ with the layout of the stored arrays. meta_learners_ are then fitted on all the tested rows
+    """
+
+    def __init__(self, meta_learner=None, features='target', inner_cv=5, random_state=0):
+        self.meta_learner = meta_learner
+        self.features = features
+        self.inner_cv = inner_cv
+        self.random_state = random_state
+
+    def _design(self, probas, target):
+        #probas: (n_models, n_rows, n_targets)
+        if self.features == 'target':
+            return probas[:, :, target].T
+        if self.features == 'all':
+            return probas.transpose(1, 0, 2).reshape(probas.shape[1], -1)
+        raise ValueError(f"features must be 'target' or 'all', got {self.features!r}")
+
+    def _fit_target(self, X, y):
+        if np.unique(y).shape[0] < 2:
+            #no positive (or no negative) in the training rows: a constant prediction
+            return float(y.mean())
+        learner = LogisticRegression(class_weight='balanced') if self.meta_learner is None else self.meta_learner
+        return clone(learner).fit(X, y)
+
+    @staticmethod
+    def _predict_target(model, X):
+        if isinstance(model, float):
+            return np.full(X.shape[0], model)
+        return model.predict_proba(X)[:, 1]
+
+    def fit(self, entries, y):
+        self.plan_, self.targets_ = _check_entries(entries)
+        self.names_ = [entry.name for entry in entries]
+        y = np.asarray(y[self.targets_] if isinstance(y, pd.DataFrame) else y, dtype=int)
+        probas = np.stack([np.asarray(entry.proba, dtype=np.float64) for entry in entries])
+
+        self.oof_proba_ = np.full(probas.shape[1:], np.nan)
+        inner = MultilabelStratifiedKFold(n_splits=self.inner_cv, shuffle=True, random_state=self.random_state)
+        for repeat in range(probas.shape[1]):
+            #rows tested by every base model in this repeat
+            rows = np.where(~np.isnan(probas[:, repeat]).any(axis=(0, 2)))[0]
+            if rows.shape[0] < self.inner_cv:
+                continue
+            repeat_proba = probas[:, repeat, rows]
+            for train, test in inner.split(rows, y[rows]):
+                for target in range(y.shape[1]):
+                    X = self._design(repeat_proba, target)
+                    model = self._fit_target(X[train], y[rows[train], target])
+                    self.oof_proba_[repeat, rows[test], target] = self._predict_target(model, X[test])
+
+        #final meta-learners on every tested (repeat, row) pair
+        tested = ~np.isnan(probas).any(axis=(0, 3))
+        all_proba = probas[:, tested]
+        all_y = np.broadcast_to(y, tested.shape + (y.shape[1],))[tested]
+        self.meta_learners_ = [self._fit_target(self._design(all_proba, target), all_y[:, target])
+                               for target in range(y.shape[1])]
+        return self
+
+    def predict_proba(self, base_probas):
+        """
+        Stacked probabilities from the probabilities of the base models (in the order of fit)
+        on new samples: a list of (n_samples, n_targets) arrays
+        """
+        probas = np.stack([np.asarray(proba, dtype=np.float64) for proba in base_probas])
+        return np.column_stack([self._predict_target(model, self._design(probas, target))
+                                for target, model in enumerate(self.meta_learners_)])
+
+    def splits(self):
+        """(train_index, test_index, prob_matrix) of the stacked out-of-fold probabilities, as OOFPredictions.splits"""
+        repeats = _split_repeats(self.plan_)
+        for split, (train, test) in enumerate(self.plan_.split(np.empty((self.plan_.n_samples, 0)))):
+            prob_matrix = self.oof_proba_[repeats[split], test]
+            if not np.isnan(prob_matrix).any():
+                yield train, test, prob_matrix
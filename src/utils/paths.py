@@ -0,0 +1,7 @@
+import os
+
+
+#locations inside the repository, so that the scripts run on any machine and from any folder
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DATA_DIR = os.path.join(ROOT_DIR, 'data')
+IMPUTED_DATA_DIR = os.path.join(DATA_DIR, 'data_after_imputation')
@@ -0,0 +1,208 @@
+"""This file includes a one-pass statistics engine for the cleaning decisions of
+data_cleaning.py (zero variance, high missingness, high correlation).
+
+StreamingStatistics accumulates, chunk by chunk, the per-column missing counts, means
+and variances and the full pairwise covariance with pairwise-complete NaN handling
+(the correlation of pandas' DataFrame.corr). Every statistic is kept per pair of
+columns, over the rows where both are observed: count n[i, j], mean[i, j] and second
+moment m2[i, j] of column i, and co-moment[i, j]; the diagonal holds the per-column
+statistics. A chunk is summarized with a few matrix products over its observed mask,
+and two summaries are merged with the parallel Welford update (Chan et al.), so chunks
+or shards can be processed in any order, in parallel, and merged into one result.
+
+e.g.
+    stats = compute_statistics(stream_basic_data_cleaning(), n_jobs=4)
+    stats.drop_sets(targets)    # {'zero_variance': [...], 'high_missingness': [...],
+                                #  'high_correlation': [...], 'redundant': [...]}
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+#variances (and second moments per row) below this are zero up to the rounding of the merged means
+ZERO_VARIANCE_TOL = 1e-12
+
+
+def _as_float_array(chunk, columns):
+    if hasattr(chunk, 'to_numpy'):
+        return chunk[columns].to_numpy(dtype=np.float64, na_value=np.nan)
+    return np.asarray(chunk, dtype=np.float64)
+
+
+class StreamingStatistics:
+    """Mergeable pairwise-complete moments of a fixed list of columns"""
+
+    def __init__(self, columns):
+        self.columns = list(columns)
+        d = len(self.columns)
+        self.n_rows = 0
+        self.n = np.zeros((d, d))
+        self.mean = np.zeros((d, d))
+        self.m2 = np.zeros((d, d))
+        self.comoment = np.zeros((d, d))
+
+    @classmethod
+    def from_chunk(cls, chunk, columns=None):
+        """Moments of a single chunk (a DataFrame, or an array with the given columns)"""
+        columns = list(chunk.columns) if columns is None else list(columns)
+        X = _as_float_array(chunk, columns)
+        stats = cls(columns)
+        if X.shape[0] == 0:
+            return stats
+
+        observed = ~np.isnan(X)
+        O = observed.astype(np.float64)
+        #centering on the chunk column means first keeps the sums of squares well conditioned
+        with np.errstate(invalid='ignore', divide='ignore'):
+            center = np.nansum(X, axis=0) / O.sum(axis=0)
+        Z = np.where(observed, X - np.nan_to_num(center), 0.)
+
+        n = O.T @ O
+        S = Z.T @ O            #S[i, j]: sum of centered column i over the rows where i and j are observed
+        Q = (Z * Z).T @ O
+        P = Z.T @ Z
+        with np.errstate(invalid='ignore', divide='ignore'):
+            pair_mean = np.where(n > 0, S / n, 0.)
+
+        stats.n_rows = X.shape[0]
+        stats.n = n
+        stats.mean = pair_mean + np.nan_to_num(center)[:, np.newaxis]
+        stats.m2 = np.maximum(Q - S * pair_mean, 0.)
+        stats.comoment = P - S * pair_mean.T
+        return stats
+
+    def update(self, chunk):
+        return self.merge(self.from_chunk(chunk, self.columns))
+
+    def merge(self, other):
+        """Fold the moments of other (same columns, disjoint rows) into self"""
+        if other.columns != self.columns:
+            raise ValueError("Statistics over different columns cannot be merged")
+
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        weight = np.divide(self.n * other.n, n, out=np.zeros_like(n), where=n > 0)
+        self.mean = self.mean + delta * np.divide(other.n, n, out=np.zeros_like(n), where=n > 0)
+
+        self.m2 = self.m2 + other.m2 + delta ** 2 * weight
+        self.comoment = self.comoment + other.comoment + delta * delta.T * weight
+        self.n = n
+        self.n_rows += other.n_rows
+        return self
+
+    @property
+    def n_observed(self):
+        return np.diag(self.n)
+
+    @property
+    def missing_fraction(self):
+        return 1. - self.n_observed / self.n_rows if self.n_rows else np.zeros(len(self.columns))
+
+    @property
+    def means(self):
+        return np.diag(self.mean)
+
+    def variance(self, ddof=1):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.n_observed > ddof, np.diag(self.m2) / (self.n_observed - ddof), np.nan)
+
+    def covariance(self, ddof=1):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.n > ddof, self.comoment / (self.n - ddof), np.nan)
+
+    def correlation(self):
+        """Pairwise-complete Pearson correlation (NaN where a column is constant over the pair)"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            corr = self.comoment / np.sqrt(self.m2 * self.m2.T)
+        constant = self.m2 <= ZERO_VARIANCE_TOL * np.maximum(self.n, 1.)
+        corr[(self.n < 2) | constant | constant.T] = np.nan
+        return np.clip(corr, -1., 1.)
+
+    def drop_sets(self, targets=(), missing_threshold=0.90, high_corr=0.80, redundant_corr=0.70):
+        """
+        Columns to drop, in the order of the cleaning steps:
+        zero_variance      columns with zero variance (targets included, as in zero_variance_drop)
+        high_missingness   columns missing in more than missing_threshold of the rows
+        high_correlation   |corr| > high_corr between the remaining features
+        redundant          redundant_corr < |corr| <= high_corr between the features left after that
+        Within a correlated pair the column dropped is the one with the higher mean absolute
+        correlation to the other remaining features; pairs are visited by decreasing |corr|
+        """
+        variance = self.variance()
+        zero_var = [col for col, var in zip(self.columns, variance) if var <= ZERO_VARIANCE_TOL]
+        high_missing = [col for col, fraction in zip(self.columns, self.missing_fraction)
+                        if fraction > missing_threshold and col not in zero_var]
+
+        excluded = set(zero_var) | set(high_missing) | set(targets)
+        features = [i for i, col in enumerate(self.columns) if col not in excluded]
+        corr = np.abs(self.correlation())
+
+        high = self._correlated_drops(corr, features, high_corr, 1.)
+        remaining = [i for i in features if self.columns[i] not in high]
+        redundant = self._correlated_drops(corr, remaining, redundant_corr, high_corr)
+
+        return {'zero_variance': zero_var, 'high_missingness': high_missing,
+                'high_correlation': high, 'redundant': redundant}
+
+    def _correlated_drops(self, corr, features, low, high):
+        sub = corr[np.ix_(features, features)]
+        np.fill_diagonal(sub, np.nan)
+        kept = np.ones(len(features), dtype=bool)
+
+        pairs = [(sub[a, b], a, b) for a in range(len(features)) for b in range(a + 1, len(features))
+                 if low < sub[a, b] <= high]
+        dropped = []
+        for _, a, b in sorted(pairs, key=lambda pair: -pair[0]):
+            if not (kept[a] and kept[b]):
+                continue
+            #mean absolute correlation with the features still kept
+            mean_corr = np.nanmean(np.where(kept, sub[[a, b]], np.nan), axis=1)
+            drop = b if mean_corr[1] >= mean_corr[0] else a
+            kept[drop] = False
+            dropped.append(self.columns[features[drop]])
+
+        return dropped
+
+
+def compute_statistics(chunks, columns=None, n_jobs=None):
+    """
+    Statistics of a stream of chunks (DataFrames, or arrays with the given columns) in a
+    single pass: chunks are summarized on n_jobs threads (the matrix products release the
+    GIL), with at most 2 * n_jobs chunks in flight, and merged in order
+    """
+    chunks = iter(chunks)
+    first = next(chunks, None)
+    if first is None:
+        raise ValueError("No chunk to compute statistics on")
+    columns = list(first.columns) if columns is None else list(columns)
+    stats = StreamingStatistics.from_chunk(first, columns)
+
+    n_jobs = n_jobs or 1
+    if n_jobs == 1:
+        for chunk in chunks:
+            stats.update(chunk)
+        return stats
+
+    with ThreadPoolExecutor(n_jobs) as executor:
+        pending = []
+        for chunk in chunks:
+            pending.append(executor.submit(StreamingStatistics.from_chunk, chunk, columns))
+            if len(pending) >= 2 * n_jobs:
+                stats.merge(pending.pop(0).result())
+        for future in pending:
+            stats.merge(future.result())
+
+    return stats
+
+
+def merge_statistics(shards):
+    """Merge the statistics of shards processed separately (e.g. per site or per process)"""
+    shards = list(shards)
+    if not shards:
+        raise ValueError("No statistics to merge")
+    merged = StreamingStatistics(shards[0].columns)
+    for shard in shards:
+        merged.merge(shard)
+    return merged
@@ -0,0 +1,317 @@
+"""This file includes the telemetry of the preprocessing stages.
+
+The public stage functions of data_cleaning.py, knn_imputation.py,
+median_and_freq_imputation.py and imputation_helpers.py, and IterativeStratification,
+are decorated with ``instrument``. While telemetry is disabled (the default) the
+decorator costs one flag check per call. Once enabled, every call records its wall
+time, CPU time, peak memory delta, input/output shapes and rows/sec in the in-process
+``registry`` and, optionally, as JSON lines in a file. An opt-in sampling profiler
+collects the call stacks of the running stages at a fixed interval.
+
+The peak memory of a stage is sampled (Linux only): a background thread reads the
+resident set size every few milliseconds while stages run, and the delta is the highest
+reading above the one at the start of the stage. Nothing process-wide is reset, so stages
+running concurrently (e.g. on the thread pools of n_jobs) do not disturb each other's
+measurements, but the resident set is the process's: the delta of a stage includes what
+the stages running at the same time allocated, and a spike shorter than the sampling
+interval may be missed.
+
+Telemetry is enabled with ``enable(...)`` or through environment variables:
+    PIPELINE_TELEMETRY=1                  in-process registry only
+    PIPELINE_TELEMETRY=stages.jsonl       registry + JSON lines appended to the file
+    PIPELINE_PROFILE=1                    sampling profiler on as well
+e.g. after a run, ``registry.summary()`` shows which stage regressed.
+"""
+
+import functools
+import inspect
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+
+_state = {'enabled': False, 'jsonl': None, 'profiler': None, 'memory_sampler': None}
+
+#stack of the instrumented calls running in each thread, {thread id: [frame, ...]}, guarded by _lock
+_active = {}
+_lock = threading.Lock()
+
+#seconds between two readings of the resident set size while stages run
+MEMORY_SAMPLE_INTERVAL = 0.005
+
+
+def reset_peak_rss():
+    """
+    Reset the peak resident set size of the process (Linux only); returns whether it worked.
+    Process-wide: meant for whole runs (benchmarks/pipeline_benchmark.py), not for the stages
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _proc_status_mb(field):
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+
+
+def peak_rss_mb():
+    """Peak resident set size in MB: since the last reset_peak_rss on Linux, process lifetime elsewhere"""
+    peak = _proc_status_mb('VmHWM:')
+    if peak is not None:
+        return peak
+    try:
+        import resource
+        #kilobytes on Linux, bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 1024
+    except ImportError:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / 2 ** 20
+
+
+def _shape(obj):
+    #feature_scaling returns (data, scaler): the data is the first element
+    if isinstance(obj, tuple) and obj:
+        obj = obj[0]
+    shape = getattr(obj, 'shape', None)
+    return list(shape) if shape is not None else None
+
+
+class TelemetryRegistry:
+    """In-process store of the stage records and of the profiler samples"""
+
+    def __init__(self):
+        self.records = []
+        self.samples = defaultdict(Counter)
+
+    def add(self, record):
+        with _lock:
+            self.records.append(record)
+        if _state['jsonl'] is not None:
+            with _lock, open(_state['jsonl'], 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+    def clear(self):
+        with _lock:
+            self.records.clear()
+            self.samples.clear()
+
+    def add_sample(self, stage, stack):
+        with _lock:
+            self.samples[stage][stack] += 1
+
+    def to_frame(self):
+        import pandas as pd
+        return pd.DataFrame(self.records)
+
+    def summary(self):
+        """Per-stage totals: calls, wall/CPU time, rows, rows/sec and the largest peak memory delta"""
+        frame = self.to_frame()
+        if frame.empty:
+            return frame
+        summary = frame.groupby('stage').agg(calls=('wall_s', 'size'), wall_s=('wall_s', 'sum'),
+                                             cpu_s=('cpu_s', 'sum'), rows=('rows', 'sum'),
+                                             max_wall_s=('wall_s', 'max'),
+                                             peak_mem_delta_mb=('peak_mem_delta_mb', 'max'))
+        summary['rows_per_s'] = summary['rows'] / summary['wall_s']
+        return summary.sort_values('wall_s', ascending=False)
+
+    def profile(self, stage, top=15):
+        """Functions most often on top of the stack while the stage ran (profiler samples)"""
+        leaves = Counter()
+        with _lock:
+            stacks = list(self.samples.get(stage, {}).items())
+        for stack, count in stacks:
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        return leaves.most_common(top)
+
+    def write_folded(self, path):
+        """Profiler samples as folded stacks (stage;frame;...;frame count), the flame graph input format"""
+        with _lock:
+            samples = [(stage, list(stacks.items())) for stage, stacks in self.samples.items()]
+        with open(path, 'w') as f:
+            for stage, stacks in samples:
+                for stack, count in stacks:
+                    f.write(f"{stage};{stack} {count}\n")
+
+
+registry = TelemetryRegistry()
+
+
+class SamplingProfiler(threading.Thread):
+    """Background thread sampling the Python stack of every thread running an instrumented stage"""
+
+    def __init__(self, interval=0.005):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frames = sys._current_frames()
+            with _lock:
+                running = [(thread_id, stack[-1]['stage']) for thread_id, stack in _active.items() if stack]
+            for thread_id, stage in running:
+                if thread_id not in frames:
+                    continue
+                names = []
+                frame = frames[thread_id]
+                while frame is not None:
+                    code = frame.f_code
+                    names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                registry.add_sample(stage, ';'.join(reversed(names)))
+
+    def stop(self):
+        self.stopped.set()
+
+
+class MemorySampler(threading.Thread):
+    """Background thread raising the peak_mb of every running stage to the current resident set size"""
+
+    def __init__(self, interval=MEMORY_SAMPLE_INTERVAL):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            _sample_rss()
+
+    def stop(self):
+        self.stopped.set()
+
+
+def _sample_rss():
+    rss = _proc_status_mb('VmRSS:')
+    if rss is None:
+        return None
+    with _lock:
+        for stack in _active.values():
+            for frame in stack:
+                if frame['peak_mb'] is not None and rss > frame['peak_mb']:
+                    frame['peak_mb'] = rss
+    return rss
+
+
+def enable(jsonl_path=None, profile=False, interval=0.005):
+    """Start recording the instrumented stages (and sampling their stacks if profile)"""
+    _state['enabled'] = True
+    _state['jsonl'] = jsonl_path
+    if _state['memory_sampler'] is None:
+        _state['memory_sampler'] = MemorySampler()
+        _state['memory_sampler'].start()
+    if profile and _state['profiler'] is None:
+        _state['profiler'] = SamplingProfiler(interval)
+        _state['profiler'].start()
+
+
+def disable():
+    _state['enabled'] = False
+    _state['jsonl'] = None
+    for name in ('profiler', 'memory_sampler'):
+        if _state[name] is not None:
+            _state[name].stop()
+            _state[name] = None
+
+
+def _enter(stage, args, kwargs):
+    data = args[0] if args else next(iter(kwargs.values()), None)
+    rss = _proc_status_mb('VmRSS:')
+    frame = {'stage': stage, 'input_shape': _shape(data), 'rss_before_mb': rss, 'peak_mb': rss,
+             'wall': time.perf_counter(), 'cpu': time.process_time()}
+    with _lock:
+        _active.setdefault(threading.get_ident(), []).append(frame)
+    return frame
+
+
+def _exit(frame, output_shape, rows=None):
+    wall = time.perf_counter() - frame['wall']
+    cpu = time.process_time() - frame['cpu']
+    #a last reading, for the stages shorter than the sampling interval
+    _sample_rss()
+    with _lock:
+        stack = _active[threading.get_ident()]
+        #usually the top one, but a streaming stage may be closed after later calls
+        del stack[next(i for i in range(len(stack) - 1, -1, -1) if stack[i] is frame)]
+        parent = stack[-1]['stage'] if stack else None
+    peak = frame['peak_mb']
+
+    #load_and_basic_data_cleaning takes a file name: its rows are those of the output
+    if rows is None:
+        shape = frame['input_shape'] or output_shape
+        rows = shape[0] if shape else None
+    delta = None if peak is None else peak - frame['rss_before_mb']
+    registry.add({'stage': frame['stage'], 'parent': parent,
+                  'timestamp': time.time(), 'wall_s': wall, 'cpu_s': cpu, 'peak_rss_mb': peak,
+                  'peak_mem_delta_mb': delta, 'input_shape': frame['input_shape'], 'output_shape': output_shape,
+                  'rows': rows, 'rows_per_s': rows / wall if rows and wall else None})
+
+
+def instrument(func):
+    """Record every call of a stage function while telemetry is enabled"""
+    stage = f"{func.__module__}.{func.__qualname__}"
+
+    if inspect.isgeneratorfunction(func):
+        #streaming stages: the time spent producing the chunks, and the rows of all chunks
+        @functools.wraps(func)
+        def generator_wrapper(*args, **kwargs):
+            if not _state['enabled']:
+                yield from func(*args, **kwargs)
+                return
+
+            frame = _enter(stage, (), {})
+            rows, shape, elapsed, cpu_elapsed = 0, None, 0., 0.
+            chunks = func(*args, **kwargs)
+            try:
+                while True:
+                    start, cpu_start = time.perf_counter(), time.process_time()
+                    try:
+                        chunk = next(chunks)
+                    finally:
+                        elapsed += time.perf_counter() - start
+                        cpu_elapsed += time.process_time() - cpu_start
+                    shape = _shape(chunk)
+                    rows += shape[0] if shape else 0
+                    yield chunk
+            except StopIteration:
+                pass
+            finally:
+                #the time spent by the consumer between two chunks is not the stage's
+                frame['wall'] = time.perf_counter() - elapsed
+                frame['cpu'] = time.process_time() - cpu_elapsed
+                _exit(frame, [rows] + shape[1:] if shape else None, rows)
+
+        return generator_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _state['enabled']:
+            return func(*args, **kwargs)
+
+        frame = _enter(stage, args, kwargs)
+        out = None
+        try:
+            out = func(*args, **kwargs)
+            return out
+        finally:
+            _exit(frame, _shape(out))
+
+    return wrapper
+
+
+if os.environ.get('PIPELINE_TELEMETRY'):
+    _target = os.environ['PIPELINE_TELEMETRY']
+    enable(jsonl_path=None if _target == '1' else _target, profile=os.environ.get('PIPELINE_PROFILE') == '1')
@@ -0,0 +1,151 @@
+"""This file includes the dynamic thresholding of the modeling notebooks, run
+for all targets and outer folds at once.
+
+The notebooks call precision_recall_curve for every target of every fold and pick
+the threshold with the best precision among those with recall >= 0.60 (0.5 when the
+best point is the end of the curve, 0.15 when no threshold qualifies). Here every
+(target, fold) column of a stacked probability array is sorted once, the precision
+and recall of all its distinct thresholds come from cumulative sums, and the
+constrained optimum of all columns is taken with masked array reductions.
+The learned thresholds can be saved and loaded for inference (see scoring_service.py).
+"""
+
+import json
+
+import numpy as np
+
+
+#column order of the targets in the modeling notebooks
+TARGETS = ['Biopsy', 'Hinselmann', 'Schiller', 'Citology']
+
+
+def constrained_thresholds(y_true, y_prob, min_recall=0.60, min_precision=0.0, fallback=0.15, end_threshold=0.5):
+    """Best-precision threshold of every column of y_prob (n_samples, n_columns) under
+    recall >= min_recall and precision >= min_precision, with the rules of the notebooks:
+    ties go to the lowest threshold, end_threshold is used when the best point is the end
+    of the precision-recall curve (precision 1, recall 0) and fallback when no point
+    satisfies the constraints. min_recall and min_precision may be per-column arrays.
+    NaN probabilities mark padding rows (folds of different sizes) and are ignored.
+    """
+    y_prob = np.asarray(y_prob, dtype=np.float64)
+    y_true = np.asarray(y_true)
+    if y_prob.ndim != 2 or y_true.shape != y_prob.shape:
+        raise ValueError("y_true and y_prob must be 2D arrays of the same shape")
+    n_samples, n_columns = y_prob.shape
+    min_recall = np.broadcast_to(min_recall, (n_columns,))
+    min_precision = np.broadcast_to(min_precision, (n_columns,))
+
+    #descending scores, the NaN padding ends up at the bottom of every column
+    order = np.argsort(-y_prob, axis=0, kind='stable')
+    scores = np.take_along_axis(y_prob, order, axis=0)
+    observed = ~np.isnan(scores)
+    positives = (np.take_along_axis(y_true, order, axis=0) == 1) & observed
+
+    tps = np.cumsum(positives, axis=0, dtype=np.float64)
+    fps = np.cumsum(observed & ~positives, axis=0, dtype=np.float64)
+
+    #a distinct threshold ends where the next score differs (the curve points of precision_recall_curve)
+    last_of_value = np.ones_like(observed)
+    last_of_value[:-1] = scores[:-1] != scores[1:]
+    last_of_value &= observed
+
+    predicted = tps + fps
+    precision = np.divide(tps, predicted, out=np.zeros_like(tps), where=predicted != 0)
+    n_positives = tps[-1]
+    #without positives the recall is one at every threshold, as in precision_recall_curve
+    recall = np.divide(tps, n_positives, out=np.ones_like(tps), where=n_positives != 0)
+
+    valid = last_of_value & (recall >= min_recall) & (precision >= min_precision)
+    objective = np.where(valid, precision, -np.inf)
+
+    #ties go to the lowest threshold, i.e. the last maximum in descending order
+    best = n_samples - 1 - np.argmax(objective[::-1], axis=0)
+    best_precision = objective.max(axis=0)
+    thresholds = scores[best, np.arange(n_columns)]
+
+    #the end point of the curve (precision 1, recall 0) comes after every threshold and wins only if strictly better
+    end_valid = (min_recall <= 0) & (min_precision <= 1)
+    thresholds = np.where(end_valid & (best_precision < 1), end_threshold, thresholds)
+    return np.where(np.isneginf(best_precision) & ~end_valid, fallback, thresholds)
+
+
+class ThresholdOptimizer:
+    """Constrained decision thresholds for all targets and folds.
+
+    fit takes the stacked true labels and probabilities of the outer folds, with shape
+    (n_samples, n_targets, n_folds) (or (n_samples, n_targets) for a single fold), and
+    stores thresholds_ (n_targets, n_folds). The thresholds used at inference are the
+    per-target median over the folds.
+
+    constraints: {target: {'min_recall': ..., 'min_precision': ...}} overriding
+    min_recall / min_precision for some targets, e.g. {'Biopsy': {'min_precision': 0.20}}
+    """
+
+    def __init__(self, targets=TARGETS, min_recall=0.60, min_precision=0.0, constraints=None,
+                 fallback=0.15, end_threshold=0.5):
+        self.targets = list(targets)
+        self.min_recall = min_recall
+        self.min_precision = min_precision
+        self.constraints = constraints or {}
+        self.fallback = fallback
+        self.end_threshold = end_threshold
+
+        unknown = set(self.constraints) - set(self.targets)
+        if unknown:
+            raise ValueError(f"Constraints given for unknown targets: {sorted(unknown)}")
+
+    def _constraint(self, name):
+        return np.array([self.constraints.get(target, {}).get(name, getattr(self, name))
+                         for target in self.targets])
+
+    @staticmethod
+    def _stack(y):
+        y = np.asarray(y)
+        return y[:, :, np.newaxis] if y.ndim == 2 else y
+
+    def fit(self, y_true, y_prob):
+        y_true, y_prob = self._stack(y_true), self._stack(y_prob)
+        n_samples, n_targets, n_folds = y_prob.shape
+        if n_targets != len(self.targets):
+            raise ValueError(f"Expected {len(self.targets)} targets, got {n_targets}")
+
+        thresholds = constrained_thresholds(
+            y_true.reshape(n_samples, -1), y_prob.reshape(n_samples, -1),
+            min_recall=np.repeat(self._constraint('min_recall'), n_folds),
+            min_precision=np.repeat(self._constraint('min_precision'), n_folds),
+            fallback=self.fallback, end_threshold=self.end_threshold)
+
+        self.thresholds_ = thresholds.reshape(n_targets, n_folds)
+        self.threshold_ = np.median(self.thresholds_, axis=1)
+        return self
+
+    def predict(self, y_prob):
+        """Binary predictions: a stacked (n_samples, n_targets, n_folds) array is thresholded
+        fold by fold with thresholds_, a (n_samples, n_targets) matrix with the inference thresholds
+        """
+        y_prob = np.asarray(y_prob)
+        if y_prob.ndim == 3:
+            return (y_prob >= self.thresholds_).astype(int)
+        return (y_prob >= self.threshold_).astype(int)
+
+    def as_dict(self):
+        #the {target: threshold} mapping of ScoringBundle
+        return dict(zip(self.targets, self.threshold_.tolist()))
+
+    def save(self, path):
+        state = {'targets': self.targets, 'min_recall': self.min_recall, 'min_precision': self.min_precision,
+                 'constraints': self.constraints, 'fallback': self.fallback, 'end_threshold': self.end_threshold,
+                 'thresholds': self.thresholds_.tolist(), 'threshold': self.threshold_.tolist()}
+        with open(path, 'w') as f:
+            json.dump(state, f, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            state = json.load(f)
+
+        optimizer = cls(state['targets'], state['min_recall'], state['min_precision'], state['constraints'],
+                        state['fallback'], state['end_threshold'])
+        optimizer.thresholds_ = np.array(state['thresholds'])
+        optimizer.threshold_ = np.array(state['threshold'])
+        return optimizer